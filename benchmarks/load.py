@@ -0,0 +1,533 @@
+"""A load and soak test of `SplitTestMiddleware` and `CohortManager` under
+concurrency.
+
+A synthetic population of clients, some logged in and some anonymous, makes
+requests from many threads (and optionally processes) to a view which reads
+the user's cohorts. Requests go either straight to Django's WSGI handler or,
+with `--server`, over HTTP to Django's threaded development server. Every
+request counts its database queries, so the report covers the session and
+authentication middleware as well as the split test middleware.
+
+The report gives the throughput, the p50/p95/p99 latency, the queries per
+request, the errors (e.g. `Assignment` insert conflicts or a locked SQLite
+database) and the database connections opened. With `--report-interval`, it's
+also printed periodically along with the process's peak memory, to spot
+leaks in a long soak test.
+
+The database is created from scratch in a temporary SQLite file by default.
+A PostgreSQL database can be given with `--database postgres://...`; it must
+be a scratch database, as it's flushed first. The cache is always the locmem
+cache, so each process has its own, as in a preforking server.
+
+Run from the repository root with e.g.:
+
+    python -m benchmarks.load --clients 1000 --login-ratio 0.3 --split-tests 20 \\
+        --threads 16 --duration 60
+    python -m benchmarks.load --processes 4 --duration 3600 --report-interval 60
+    python -m benchmarks.load --server --database postgres://localhost/split_tests_load
+"""
+
+import argparse
+import math
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+from collections import Counter
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+from urllib.request import HTTPCookieProcessor, build_opener
+
+from django.db import connection
+from django.http import HttpResponse, JsonResponse
+from django.urls import path
+
+
+# The resolution of the latency histogram: each bucket is 1% wider than the
+# last, so percentiles are accurate to 1% in constant memory.
+HISTOGRAM_BASE = 1.01
+
+QUERIES_HEADER = "X-Load-Queries"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.load", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument("--clients", type=int, default=500, help="Clients per process.")
+    parser.add_argument(
+        "--login-ratio", type=float, default=0.3, help="The fraction of clients logged in."
+    )
+    parser.add_argument(
+        "--accounts",
+        type=int,
+        default=None,
+        help=(
+            "The number of user accounts the logged in clients share. Fewer accounts than"
+            " logged in clients makes concurrent assignments of the same user, contending on"
+            " `Assignment` inserts. Defaults to one per logged in client."
+        ),
+    )
+    parser.add_argument("--split-tests", type=int, default=10, help="Active split tests.")
+    parser.add_argument("--cohorts", type=int, default=2, help="Cohorts per split test.")
+    parser.add_argument("--threads", type=int, default=8, help="Threads per process.")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="Processes, each with its own clients, threads and cache. Not with --server.",
+    )
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to run for.")
+    parser.add_argument(
+        "--churn",
+        type=float,
+        default=0.0,
+        help=(
+            "The probability that a client clears its cookies before a request, so that new"
+            " sessions keep being assigned."
+        ),
+    )
+    parser.add_argument(
+        "--report-interval",
+        type=float,
+        default=None,
+        help="Print the results every this many seconds, as well as at the end.",
+    )
+    parser.add_argument(
+        "--database",
+        default=None,
+        help=(
+            "A SQLite path or a postgres:// URL of a scratch database, which is flushed."
+            " Defaults to a temporary SQLite file."
+        ),
+    )
+    parser.add_argument(
+        "--server",
+        action="store_true",
+        help="Send requests over HTTP to Django's threaded development server.",
+    )
+    parser.add_argument(
+        "--conn-max-age",
+        type=int,
+        default=0,
+        help="The `CONN_MAX_AGE` of the database connections. Defaults to 0, as in Django.",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="The random seed.")
+    args = parser.parse_args(argv)
+    if args.server and args.processes != 1:
+        parser.error("--processes can't be used with --server.")
+    if not 0 <= args.login_ratio <= 1:
+        parser.error("--login-ratio must be between 0 and 1.")
+    if args.accounts is not None and args.accounts < 1 and args.login_ratio:
+        parser.error("--accounts must be positive when clients log in.")
+    return args
+
+
+def get_database_settings(database, conn_max_age=0):
+    if database is None:
+        database = os.path.join(tempfile.mkdtemp(prefix="split-tests-load-"), "db.sqlite3")
+    if not database.startswith(("postgres://", "postgresql://")):
+        # Wait for locks rather than failing straight away, as a server's
+        # requests would.
+        return {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": database,
+            "CONN_MAX_AGE": conn_max_age,
+            "OPTIONS": {"timeout": 20},
+        }
+    url = urlsplit(database)
+    return {
+        "ENGINE": "django.db.backends.postgresql",
+        "CONN_MAX_AGE": conn_max_age,
+        "NAME": url.path.lstrip("/"),
+        "USER": url.username or "",
+        "PASSWORD": url.password or "",
+        "HOST": url.hostname or "",
+        "PORT": url.port or "",
+    }
+
+
+def configure(args):
+    import django
+
+    from django.conf import settings
+
+    settings.configure(
+        ALLOWED_HOSTS=["*"],
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+        DATABASES={"default": get_database_settings(args.database, args.conn_max_age)},
+        DEBUG=False,
+        DEFAULT_AUTO_FIELD="django.db.models.BigAutoField",
+        INSTALLED_APPS=[
+            "django.contrib.auth",
+            "django.contrib.contenttypes",
+            "django.contrib.sessions",
+            "django.contrib.sites",
+            "split_tests",
+        ],
+        MIDDLEWARE=[
+            "benchmarks.load.QueryCountMiddleware",
+            "django.contrib.sessions.middleware.SessionMiddleware",
+            "django.contrib.auth.middleware.AuthenticationMiddleware",
+            "split_tests.middleware.SplitTestMiddleware",
+        ],
+        ROOT_URLCONF="benchmarks.load",
+        SECRET_KEY="load-test",
+        SESSION_ENGINE="django.contrib.sessions.backends.cache",
+        SITE_ID=1,
+        USE_TZ=True,
+    )
+    django.setup()
+
+
+class QueryCountMiddleware:
+    """Add the number of queries a request made to the response."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = 0
+
+        def count_query(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_query):
+            response = self.get_response(request)
+        response[QUERIES_HEADER] = str(queries)
+        return response
+
+
+def index(request):
+    # Read every cohort, as views using split tests would.
+    slug_map = request.user.split_test_slug_map
+    return JsonResponse({slug: slug_map[slug] for slug in list(slug_map)})
+
+
+def log_in(request, user_id):
+    from django.contrib.auth import get_user_model, login
+
+    user = get_user_model().objects.get(pk=user_id)
+    login(request, user, backend="django.contrib.auth.backends.ModelBackend")
+    return HttpResponse()
+
+
+urlpatterns = [path("", index), path("login/<int:user_id>/", log_in)]
+
+
+def create_population(args):
+    from django.contrib.auth import get_user_model
+    from django.contrib.auth.hashers import make_password
+    from django.contrib.sites.models import Site
+    from django.core.management import call_command
+
+    from split_tests.models import Cohort, SplitTest
+
+    call_command("migrate", verbosity=0)
+    call_command("flush", interactive=False, verbosity=0)
+
+    site, _ = Site.objects.get_or_create(pk=1, defaults={"domain": "testserver"})
+    for i in range(args.split_tests):
+        # Creating each row rebuilds the snapshot, as in the admin.
+        split_test = SplitTest.objects.create(
+            name=f"Split test {i}", slug=f"split-test-{i}", site=site, is_active=True
+        )
+        for j in range(args.cohorts):
+            Cohort.objects.create(
+                split_test=split_test,
+                name=f"Cohort {j}",
+                slug=f"cohort-{j}",
+                weight=1,
+                is_active=True,
+            )
+
+    logged_in = round(args.clients * args.login_ratio) * args.processes
+    accounts = args.accounts if args.accounts is not None else logged_in
+    User = get_user_model()
+    password = make_password(None)
+    User.objects.bulk_create(
+        [User(username=f"user-{i}", password=password) for i in range(accounts)],
+        batch_size=1_000,
+    )
+    return list(User.objects.order_by("pk").values_list("pk", flat=True))
+
+
+class WSGIClient:
+    """A client which calls Django's WSGI handler in this process."""
+
+    def __init__(self):
+        from django.test import Client
+
+        self.client = Client()
+
+    def get(self, path):
+        from django.db import close_old_connections
+
+        # The test client doesn't close connections when a request starts
+        # and finishes, as the WSGI handler does.
+        close_old_connections()
+        try:
+            response = self.client.get(path)
+        finally:
+            close_old_connections()
+        return response.status_code, response.get(QUERIES_HEADER)
+
+    def clear_cookies(self):
+        self.client.cookies.clear()
+
+
+class HTTPClient:
+    """A client which sends requests to a server over HTTP."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.cookies = CookieJar()
+        self.opener = build_opener(HTTPCookieProcessor(self.cookies))
+
+    def get(self, path):
+        try:
+            with self.opener.open(self.base_url + path) as response:
+                response.read()
+                return response.status, response.headers.get(QUERIES_HEADER)
+        except HTTPError as e:
+            return e.code, e.headers.get(QUERIES_HEADER)
+
+    def clear_cookies(self):
+        self.cookies.clear()
+
+
+class VirtualClient:
+    def __init__(self, client, user_id):
+        self.client = client
+        # The ID of the user the client logs in as, or `None`.
+        self.user_id = user_id
+
+    def log_in(self):
+        if self.user_id is not None:
+            self.client.get(f"/login/{self.user_id}/")
+
+
+class Stats:
+    """Request counts and a latency histogram, which can be merged."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = Counter()
+        self.queries = 0
+        self.max_queries = 0
+        self.histogram = Counter()
+        self.duration = 0.0
+        self.connections_opened = 0
+
+    def add(self, latency, status, queries, error=None):
+        self.requests += 1
+        self.histogram[int(math.log(max(latency, 1e-6) * 1e6, HISTOGRAM_BASE))] += 1
+        if error is not None:
+            self.errors[error] += 1
+        elif status >= 400:
+            self.errors[f"HTTP {status}"] += 1
+        if queries is not None:
+            queries = int(queries)
+            self.queries += queries
+            self.max_queries = max(self.max_queries, queries)
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.errors.update(other.errors)
+        self.queries += other.queries
+        self.max_queries = max(self.max_queries, other.max_queries)
+        self.histogram.update(other.histogram)
+        self.duration = max(self.duration, other.duration)
+        self.connections_opened += other.connections_opened
+
+    def percentile(self, fraction):
+        """Return the latency, in milliseconds, below which `fraction` of the
+        requests completed.
+        """
+        target = fraction * self.requests
+        seen = 0
+        for bucket in sorted(self.histogram):
+            seen += self.histogram[bucket]
+            if seen >= target:
+                return HISTOGRAM_BASE ** (bucket + 1) / 1e3
+        return math.nan
+
+    def report(self, label=""):
+        if not self.requests:
+            return f"{label}no requests"
+        errors = sum(self.errors.values())
+        lines = [
+            f"{label}{self.requests:,} requests in {self.duration:.1f}s:"
+            f" {self.requests / self.duration:,.1f} req/s",
+            f"  latency: p50 {self.percentile(0.5):.2f}ms, p95 {self.percentile(0.95):.2f}ms,"
+            f" p99 {self.percentile(0.99):.2f}ms",
+            f"  queries: {self.queries / self.requests:.2f}/request, max {self.max_queries}",
+            f"  errors:  {errors:,}"
+            + "".join(f"\n    {count:,} x {error}" for error, count in self.errors.most_common()),
+        ]
+        return "\n".join(lines)
+
+
+def get_peak_memory():
+    """Return the process's peak resident memory in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_thread(clients, args, deadline, stats, lock, rng):
+    from django.db import close_old_connections
+
+    local_stats = Stats()
+    start = time.perf_counter()
+    try:
+        while time.perf_counter() < deadline:
+            virtual_client = rng.choice(clients)
+            if args.churn and rng.random() < args.churn:
+                virtual_client.client.clear_cookies()
+                virtual_client.log_in()
+            started_at = time.perf_counter()
+            try:
+                status, queries = virtual_client.client.get("/")
+            except Exception as e:
+                local_stats.add(time.perf_counter() - started_at, 500, None, type(e).__name__)
+            else:
+                local_stats.add(time.perf_counter() - started_at, status, queries)
+
+            # Merge the stats regularly, so they can be reported periodically.
+            if local_stats.requests == 100:
+                local_stats.duration = time.perf_counter() - start
+                with lock:
+                    stats.merge(local_stats)
+                local_stats = Stats()
+    finally:
+        local_stats.duration = time.perf_counter() - start
+        with lock:
+            stats.merge(local_stats)
+        close_old_connections()
+
+
+def run_process(args, user_ids, base_url, index, results=None):
+    from django.db.backends.signals import connection_created
+
+    connections_opened = 0
+
+    def count_connection(**kwargs):
+        nonlocal connections_opened
+        connections_opened += 1
+
+    connection_created.connect(count_connection, weak=False)
+
+    rng = random.Random(args.seed + index)
+    logged_in = round(args.clients * args.login_ratio)
+    clients = []
+    for i in range(args.clients):
+        client = HTTPClient(base_url) if base_url else WSGIClient()
+        user_id = user_ids[(index * logged_in + i) % len(user_ids)] if i < logged_in else None
+        clients.append(VirtualClient(client, user_id))
+    for client in clients:
+        client.log_in()
+
+    # Each thread has its own clients, as a client's cookies aren't thread
+    # safe.
+    chunks = [clients[i :: args.threads] for i in range(args.threads)]
+    stats = Stats()
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+    threads = [
+        threading.Thread(
+            target=run_thread,
+            args=(chunk, args, deadline, stats, lock, random.Random(rng.random())),
+            daemon=True,
+        )
+        for chunk in chunks
+        if chunk
+    ]
+    for thread in threads:
+        thread.start()
+
+    if args.report_interval is not None:
+        label = f"[process {index}] " if args.processes > 1 else ""
+        while time.perf_counter() + args.report_interval < deadline:
+            time.sleep(args.report_interval)
+            with lock:
+                report = stats.report(label)
+            print(f"{report}\n  peak memory: {get_peak_memory():,.1f} MiB", flush=True)
+    for thread in threads:
+        thread.join()
+
+    stats.connections_opened = connections_opened
+    if results is not None:
+        results.put(stats)
+    return stats
+
+
+def start_server():
+    """Start Django's threaded development server and return its URL."""
+    from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+    from django.core.wsgi import get_wsgi_application
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = ThreadedWSGIServer(("127.0.0.1", 0), QuietHandler, allow_reuse_address=False)
+    server.set_app(get_wsgi_application())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    return f"http://{host}:{port}"
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure(args)
+    user_ids = create_population(args)
+    base_url = start_server() if args.server else None
+
+    print(
+        f"{args.processes} process(es) x {args.threads} threads x {args.clients:,} clients,"
+        f" {args.login_ratio:.0%} logged in as {len(user_ids):,} accounts,"
+        f" {args.split_tests} split tests x {args.cohorts} cohorts,"
+        f" {'HTTP server' if args.server else 'WSGI handler'},"
+        f" {connection.vendor}",
+        flush=True,
+    )
+
+    if args.processes == 1:
+        results = [run_process(args, user_ids, base_url, 0)]
+    else:
+        from django.db import connections
+
+        # Forked processes mustn't share the database connections used to
+        # create the population.
+        connections.close_all()
+        context = multiprocessing.get_context("fork")
+        queue = context.Queue()
+        processes = [
+            context.Process(target=run_process, args=(args, user_ids, None, index, queue))
+            for index in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        results = [queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+    total = Stats()
+    for stats in results:
+        total.merge(stats)
+    print(total.report("Total: "))
+    print(f"  database connections opened: {total.connections_opened:,}")
+    print(f"  peak memory: {get_peak_memory():,.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Compare the session encodings of assignments for 10, 50 and 100 active
+split tests.
+
+Reports the size of the session data serialized as JSON, as Django's session
+backends do, and the time taken to serialize and deserialize it, including
+decoding the assignments against the snapshot. The formats are:
+
+- `uuid`: the default dict of split test UUIDs to cohort UUIDs, with the slug
+  map kept in the session's state.
+- `compact`: the string of cohort short IDs stored with `SESSION_COMPACT`.
+
+Run from the repository root with:
+
+    python -m benchmarks.session_size
+"""
+
+import json
+import timeit
+
+from uuid import uuid4
+
+from split_tests.sessions import decode_assignments, encode_assignments
+from split_tests.snapshot import Snapshot
+
+
+SPLIT_TEST_COUNTS = (10, 50, 100)
+COHORTS_PER_SPLIT_TEST = 3
+
+
+def make_snapshot(split_tests):
+    return Snapshot.from_rows(
+        [(str(uuid4()), f"split-test-{i}") for i in range(split_tests)],
+        [
+            (str(uuid4()), f"cohort-{j}", i, 1)
+            for i in range(split_tests)
+            for j in range(COHORTS_PER_SPLIT_TEST)
+        ],
+    )
+
+
+def make_session(snapshot, compact):
+    assignments = {
+        split_test.uuid: snapshot.cohorts[split_test.cohorts.start].uuid
+        for split_test in snapshot.split_tests
+    }
+    slug_map = {
+        snapshot.split_tests[cohort.split_test].slug: cohort.slug
+        for cohort in map(snapshot.get_cohort, assignments.values())
+    }
+    return {
+        "split_tests": encode_assignments(assignments, snapshot) if compact else assignments,
+        "split_tests_state": [snapshot.version, uuid4().hex, None if compact else slug_map],
+    }
+
+
+def dumps(session):
+    return json.dumps(session, separators=(",", ":")).encode("latin-1")
+
+
+def loads(data, snapshot):
+    session = json.loads(data)
+    value = session["split_tests"]
+    if isinstance(value, str):
+        decode_assignments(value, snapshot)
+    return session
+
+
+def time_per_call(function):
+    number, _ = timeit.Timer(function).autorange()
+    return min(timeit.repeat(function, number=number, repeat=5)) / number
+
+
+def main():
+    print(f"{'tests':>6} {'format':<8} {'size (B)':>10} {'dumps (us)':>11} {'loads (us)':>11}")
+    for split_tests in SPLIT_TEST_COUNTS:
+        snapshot = make_snapshot(split_tests)
+        for name, compact in (("uuid", False), ("compact", True)):
+            session = make_session(snapshot, compact)
+            data = dumps(session)
+            dumps_time = time_per_call(lambda: dumps(session)) * 1_000_000
+            loads_time = time_per_call(lambda: loads(data, snapshot)) * 1_000_000
+            print(
+                f"{split_tests:>6} {name:<8} {len(data):>10,} {dumps_time:>11,.1f}"
+                f" {loads_time:>11,.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
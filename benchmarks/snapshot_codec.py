@@ -0,0 +1,86 @@
+"""Compare the snapshot codec with pickle for 10, 100 and 1,000 active split
+tests.
+
+Reports the encoded size and the time taken to decode the cached data, which
+every request paid for when it read it from the cache. The formats are:
+
+- `pickle-maps`: the five sets and dicts the cache manager used to store under
+  separate keys, each decoded with pickle.
+- `pickle`: a `Snapshot`, decoded with pickle.
+- `codec`: a `Snapshot`, decoded with `split_tests.codec`.
+- `codec+zlib`: as above, with the body compressed.
+
+Unpickling the maps is the quickest, as it doesn't build the snapshot's records
+and lookups. A snapshot is only decoded once per process each time it changes,
+though, rather than on every request as the maps were.
+
+Run from the repository root with:
+
+    python -m benchmarks.snapshot_codec
+"""
+
+import pickle
+import timeit
+
+from uuid import uuid4
+
+from split_tests import codec
+from split_tests.snapshot import Snapshot
+
+
+SPLIT_TEST_COUNTS = (10, 100, 1_000)
+COHORTS_PER_SPLIT_TEST = 3
+
+
+def make_snapshot(split_tests):
+    return Snapshot.from_rows(
+        [(str(uuid4()), f"split-test-{i}") for i in range(split_tests)],
+        [
+            (str(uuid4()), f"cohort-{j}", i, 1)
+            for i in range(split_tests)
+            for j in range(COHORTS_PER_SPLIT_TEST)
+        ],
+    )
+
+
+def dump_maps(snapshot):
+    maps = (
+        set(snapshot.split_test_active_uuids),
+        dict(snapshot.split_test_uuid_slug_map),
+        set(snapshot.cohort_active_uuids),
+        dict(snapshot.cohort_uuid_slug_map),
+        dict(snapshot.cohort_uuid_split_test_uuid_map),
+    )
+    return [pickle.dumps(m, pickle.HIGHEST_PROTOCOL) for m in maps]
+
+
+def load_maps(data):
+    return [pickle.loads(d) for d in data]
+
+
+FORMATS = {
+    "pickle-maps": (dump_maps, load_maps),
+    "pickle": (lambda s: pickle.dumps(s, pickle.HIGHEST_PROTOCOL), pickle.loads),
+    "codec": (lambda s: codec.encode(s, compress_threshold=None), codec.decode),
+    "codec+zlib": (lambda s: codec.encode(s, compress_threshold=0), codec.decode),
+}
+
+
+def time_per_call(function, data):
+    number, _ = timeit.Timer(lambda: function(data)).autorange()
+    return min(timeit.repeat(lambda: function(data), number=number, repeat=5)) / number
+
+
+def main():
+    print(f"{'tests':>6} {'format':<11} {'size (B)':>10} {'decode (us)':>12}")
+    for split_tests in SPLIT_TEST_COUNTS:
+        snapshot = make_snapshot(split_tests)
+        for name, (dump, load) in FORMATS.items():
+            data = dump(snapshot)
+            size = sum(map(len, data)) if isinstance(data, list) else len(data)
+            decode_time = time_per_call(load, data) * 1_000_000
+            print(f"{split_tests:>6} {name:<11} {size:>10,} {decode_time:>12,.1f}")
+
+
+if __name__ == "__main__":
+    main()
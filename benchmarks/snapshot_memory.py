@@ -0,0 +1,101 @@
+"""Measure the memory used by the cached split test data per 1,000 split tests.
+
+Compares the five sets and dicts the cache manager used to build with the
+compact `Snapshot` which replaced them. Both are built from the same rows a
+database query would return (`UUID` objects and fresh slug strings). Run from
+the repository root with:
+
+    python -m benchmarks.snapshot_memory
+"""
+
+import gc
+import tracemalloc
+
+from uuid import uuid4
+
+from split_tests.snapshot import Snapshot
+
+
+SPLIT_TESTS = 1_000
+COHORTS_PER_SPLIT_TEST = 3
+
+
+def make_rows():
+    split_test_rows = [(i, uuid4(), f"split-test-{i}") for i in range(SPLIT_TESTS)]
+    cohort_rows = [
+        (uuid4(), f"cohort-{j}", split_test_id, split_test_uuid)
+        for split_test_id, split_test_uuid, _ in split_test_rows
+        for j in range(COHORTS_PER_SPLIT_TEST)
+    ]
+    return split_test_rows, cohort_rows
+
+
+def fresh(value):
+    """Return a new copy of a string, as each database row would."""
+    return "".join(value)
+
+
+def build_maps(split_test_rows, cohort_rows):
+    """Build the maps as `SplitTestCacheManager.update()` used to."""
+    split_test_active_uuids = set()
+    split_test_uuid_slug_map = {}
+    cohort_active_uuids = set()
+    cohort_uuid_slug_map = {}
+    cohort_uuid_split_test_uuid_map = {}
+    for _, split_test_uuid, split_test_slug in split_test_rows:
+        split_test_uuid = str(split_test_uuid)
+        split_test_active_uuids.add(split_test_uuid)
+        split_test_uuid_slug_map[split_test_uuid] = fresh(split_test_slug)
+    for cohort_uuid, cohort_slug, _, split_test_uuid in cohort_rows:
+        cohort_uuid = str(cohort_uuid)
+        split_test_uuid = str(split_test_uuid)
+        cohort_active_uuids.add(cohort_uuid)
+        cohort_uuid_slug_map[cohort_uuid] = fresh(cohort_slug)
+        cohort_uuid_split_test_uuid_map[cohort_uuid] = split_test_uuid
+    return (
+        split_test_active_uuids,
+        split_test_uuid_slug_map,
+        cohort_active_uuids,
+        cohort_uuid_slug_map,
+        cohort_uuid_split_test_uuid_map,
+    )
+
+
+def build_snapshot(split_test_rows, cohort_rows):
+    """Build the snapshot as `SplitTestCacheManager.update()` does."""
+    split_test_indexes = {}
+    snapshot_split_test_rows = []
+    for split_test_id, split_test_uuid, split_test_slug in split_test_rows:
+        split_test_indexes[split_test_id] = len(snapshot_split_test_rows)
+        snapshot_split_test_rows.append((str(split_test_uuid), fresh(split_test_slug)))
+    snapshot_cohort_rows = [
+        (str(cohort_uuid), fresh(cohort_slug), split_test_indexes[split_test_id], 1)
+        for cohort_uuid, cohort_slug, split_test_id, _ in cohort_rows
+    ]
+    return Snapshot.from_rows(snapshot_split_test_rows, snapshot_cohort_rows)
+
+
+def measure(build, *args):
+    gc.collect()
+    tracemalloc.start()
+    result = build(*args)
+    # A full collection also empties the free lists, which would otherwise
+    # hold on to the builders' temporary tuples.
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current
+
+
+def main():
+    rows = make_rows()
+    maps = measure(build_maps, *rows)
+    snapshot = measure(build_snapshot, *rows)
+    print(f"{SPLIT_TESTS:,} split tests with {COHORTS_PER_SPLIT_TEST} cohorts each")
+    print(f"  maps:     {maps / 1024:10,.1f} KiB")
+    print(f"  snapshot: {snapshot / 1024:10,.1f} KiB ({snapshot / maps:.0%})")
+
+
+if __name__ == "__main__":
+    main()
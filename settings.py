@@ -11,7 +11,13 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": "db.sqlite3",
-    }
+    },
+    # A read replica, which shares the default database in tests.
+    "replica": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": "db.sqlite3",
+        "TEST": {"MIRROR": "default"},
+    },
 }
 DEBUG = True
 INSTALLED_APPS = [
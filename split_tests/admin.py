@@ -1,7 +1,10 @@
-from django.contrib import admin
-from django.utils.translation import gettext_lazy as _
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import PAGE_VAR, ChangeList
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _, ngettext
 
-from .models import Cohort, SplitTest
+from .models import Assignment, Cohort, Layer, SplitTest
+from .paginator import EstimatedCountPaginator
 
 
 class CohortInline(admin.TabularInline):
@@ -14,10 +17,12 @@ class CohortInline(admin.TabularInline):
         "uuid",
         "is_active",
         "weight",
+        "bandit_weight",
+        "deleted_at",
     )
     prepopulated_fields = {"slug": ("name",)}
-    # Allow the form to show the `uuid` field despite it being `editable=False`.
-    readonly_fields = ("uuid",)
+    # Allow the form to show these fields despite them being `editable=False`.
+    readonly_fields = ("uuid", "bandit_weight", "deleted_at")
 
     def get_readonly_fields(self, request, obj=None):
         if obj:
@@ -35,6 +40,128 @@ class CohortInline(admin.TabularInline):
             return self.prepopulated_fields
 
 
+# The query string parameter holding the ID the assignments list continues
+# after.
+CURSOR_VAR = "before"
+
+
+class AssignmentChangeList(ChangeList):
+    """A change list which pages through assignments by ID.
+
+    Each page's "Next" link lists the assignments before its last ID, which
+    the database finds with the primary key index however deep the page is,
+    rather than by skipping every earlier row with an `OFFSET`.
+    """
+
+    def __init__(self, request, *args, **kwargs):
+        cursor = request.GET.get(CURSOR_VAR, "")
+        self.cursor = int(cursor) if cursor.isdigit() else None
+        super().__init__(request, *args, **kwargs)
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_queryset(self, request, exclude_parameters=None):
+        queryset = super().get_queryset(request, exclude_parameters)
+        if self.cursor is not None:
+            queryset = queryset.filter(id__lt=self.cursor)
+        return queryset
+
+    @cached_property
+    def next_query_string(self):
+        """The query string of the page after this one, or `None` if this is
+        the last page.
+        """
+        results = list(self.result_list)
+        if len(results) < self.list_per_page:
+            return None
+        return self.get_query_string({CURSOR_VAR: results[-1].pk}, [PAGE_VAR])
+
+
+@admin.register(Assignment)
+class AssignmentAdmin(admin.ModelAdmin):
+    # The assignments table can be very large, so avoid counting it, loading
+    # every user or cohort into a dropdown, and sorting or filtering on
+    # unindexed columns.
+    list_display = (
+        "id",
+        "user",
+        "cohort",
+        "split_test",
+        "assigned_at",
+    )
+    list_filter = ("cohort__split_test",)
+    list_select_related = ("user", "cohort__split_test")
+    ordering = ("-id",)
+    paginator = EstimatedCountPaginator
+    raw_id_fields = ("user", "cohort")
+    show_full_result_count = False
+    sortable_by = ()
+
+    fields = (
+        "user",
+        "cohort",
+        "assigned_at",
+    )
+    readonly_fields = ("assigned_at",)
+
+    def get_changelist(self, request, **kwargs):
+        return AssignmentChangeList
+
+    @admin.display(description=_("split test"))
+    def split_test(self, obj):
+        return obj.cohort.split_test
+
+
+@admin.register(Layer)
+class LayerAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "name",
+        "slug",
+        "uuid",
+        "site",
+        "created_at",
+        "modified_at",
+    )
+    list_filter = ("site",)
+    ordering = ("-created_at",)
+    search_fields = (
+        "name",
+        "slug",
+        "uuid",
+    )
+
+    fields = (
+        "name",
+        "slug",
+        "uuid",
+        "site",
+    )
+    prepopulated_fields = {"slug": ("name",)}
+    readonly_fields = ("uuid",)
+
+    def get_readonly_fields(self, request, obj=None):
+        if obj:
+            # Make `slug` and `site` read-only when editing an existing object.
+            return self.readonly_fields + (
+                "slug",
+                "site",
+            )
+        return self.readonly_fields
+
+    def get_prepopulated_fields(self, request, obj=None):
+        if obj:
+            # Since `slug` is read-only when editing an existing object, we
+            # need to remove it from the prepopulated fields to prevent a
+            # KeyError.
+            return {}
+        else:
+            return self.prepopulated_fields
+
+
 @admin.register(SplitTest)
 class SplitTestAdmin(admin.ModelAdmin):
     date_hierarchy = "created_at"
@@ -44,13 +171,19 @@ class SplitTestAdmin(admin.ModelAdmin):
         "slug",
         "uuid",
         "site",
+        "layer",
         "is_active",
+        "starts_at",
+        "ends_at",
         "created_at",
         "modified_at",
+        "deleted_at",
     )
     list_filter = (
         "is_active",
         "site",
+        "layer",
+        "deleted_at",
     )
     ordering = ("-created_at",)
     search_fields = (
@@ -72,18 +205,50 @@ class SplitTestAdmin(admin.ModelAdmin):
                 ],
             },
         ),
+        (
+            _("Schedule"),
+            {
+                "fields": ["starts_at", "ends_at"],
+            },
+        ),
+        (
+            _("Layer"),
+            {
+                "fields": ["layer", "layer_allocation", "layer_bucket_start"],
+            },
+        ),
+        (
+            _("Targeting"),
+            {
+                "fields": ["targeting"],
+            },
+        ),
+        (
+            _("Adaptive allocation"),
+            {
+                "fields": ["bandit_goal"],
+            },
+        ),
         (
             _("Meta data"),
             {
                 "classes": ("collapse",),
-                "fields": ("id", "created_at", "modified_at"),
+                "fields": ("id", "created_at", "modified_at", "deleted_at"),
             },
         ),
     )
     inlines = (CohortInline,)
     prepopulated_fields = {"slug": ("name",)}
     # Force the inclusion of these fields in the form so they can be displayed.
-    readonly_fields = ("id", "uuid", "created_at", "modified_at")
+    readonly_fields = (
+        "id",
+        "uuid",
+        "layer_bucket_start",
+        "created_at",
+        "modified_at",
+        "deleted_at",
+    )
+    actions = ("mark_for_purge",)
 
     def get_readonly_fields(self, request, obj=None):
         if obj:
@@ -102,3 +267,36 @@ class SplitTestAdmin(admin.ModelAdmin):
             return {}
         else:
             return self.prepopulated_fields
+
+    def get_deleted_objects(self, objs, request):
+        # Deleting a split test only marks it for purging, so don't collect
+        # its (potentially millions of) assignments for the confirmation page.
+        return (
+            [str(obj) for obj in objs],
+            {self.model._meta.verbose_name_plural: len(objs)},
+            set(),
+            [],
+        )
+
+    def delete_queryset(self, request, queryset):
+        # Call each split test's `delete` so they're marked for purging
+        # rather than deleted with their assignments.
+        for split_test in queryset:
+            split_test.delete()
+
+    @admin.action(description=_("Mark selected inactive split tests for purging"))
+    def mark_for_purge(self, request, queryset):
+        marked = 0
+        for split_test in queryset.filter(is_active=False, deleted_at__isnull=True):
+            split_test.delete()
+            marked += 1
+        self.message_user(
+            request,
+            ngettext(
+                "%(count)d split test was marked for purging by the purge_split_tests command.",
+                "%(count)d split tests were marked for purging by the purge_split_tests command.",
+                marked,
+            )
+            % {"count": marked},
+            messages.SUCCESS,
+        )
@@ -1,7 +1,24 @@
 from django.apps import AppConfig
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import post_delete, post_save
 from django.utils.translation import gettext_lazy as _
 
 
 class SplitTestsConfig(AppConfig):
     name = "split_tests"
     verbose_name = _("split tests")
+
+    def ready(self):
+        from .signals import invalidate_user_assignments, persist_assignments_on_login
+
+        user_logged_in.connect(
+            persist_assignments_on_login, dispatch_uid="split_tests_persist_assignments_on_login"
+        )
+
+        Assignment = self.get_model("Assignment")
+        for signal in (post_save, post_delete):
+            signal.connect(
+                invalidate_user_assignments,
+                sender=Assignment,
+                dispatch_uid="split_tests_invalidate_user_assignments",
+            )
@@ -0,0 +1,114 @@
+"""Adaptive allocation: multi-armed bandits which shift a split test's users
+towards its best performing cohorts as results come in.
+
+A split test with a `bandit_goal` assigns new users with weights computed
+from the running totals of that goal (see `split_tests.results`) rather than
+its cohorts' fixed weights. `update_bandit_weights` is meant to be run
+periodically, e.g. by the `update_bandit_weights` command: it stores the
+weights on the cohorts and swaps them into the current snapshot without
+rebuilding it, so requests still make a single weighted pick and never
+compute any statistics themselves.
+"""
+
+from itertools import groupby
+
+from .managers import COHORT_ASSIGNMENT_ORDERING
+from .models import Cohort, SplitTest
+from .results import _import_numpy, get_totals
+
+
+THOMPSON_SAMPLING = "thompson_sampling"
+EPSILON_GREEDY = "epsilon_greedy"
+STRATEGIES = (THOMPSON_SAMPLING, EPSILON_GREEDY)
+
+# The total of each split test's bandit weights, i.e. the resolution of its
+# allocation.
+WEIGHT_SCALE = 10_000
+
+
+def thompson_sampling(np, totals, rng, samples=10_000):
+    """Return the probability that each cohort has the highest mean, given an
+    array of `(count, total, total_of_squares)` rows.
+
+    Each cohort's mean is drawn `samples` times from a normal approximation
+    of its posterior, and each cohort is weighted by how often it wins.
+    """
+    count, total, total_of_squares = totals.T
+    mean = total / count
+    variance = np.maximum(total_of_squares - count * mean**2, 0.0) / (count - 1)
+    # A tiny variance breaks ties between cohorts with no spread (e.g. no
+    # conversions yet) at random rather than in favour of the first.
+    std_error = np.sqrt(np.maximum(variance, 1e-12) / count)
+    draws = rng.normal(mean, std_error, size=(samples, len(mean)))
+    wins = np.bincount(draws.argmax(axis=1), minlength=len(mean))
+    return wins / samples
+
+
+def epsilon_greedy(np, totals, epsilon=0.1):
+    """Return a share of `1 - epsilon` for the cohort(s) with the highest
+    mean, plus an equal share of `epsilon` for every cohort, given an array
+    of `(count, total, total_of_squares)` rows.
+    """
+    count, total, _ = totals.T
+    mean = total / count
+    is_best = mean == mean.max()
+    return epsilon / len(mean) + (1 - epsilon) * is_best / is_best.sum()
+
+
+def get_bandit_weights(
+    np, totals, strategy=THOMPSON_SAMPLING, rng=None, epsilon=0.1, min_count=100, samples=10_000
+):
+    """Return a list of integer weights summing to about `WEIGHT_SCALE` for
+    the cohorts with the given `(count, total, total_of_squares)` totals.
+
+    Until every cohort has `min_count` values, the cohorts are weighted
+    equally so that none is written off on too little data.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown bandit strategy {strategy!r}.")
+    if (totals[:, 0] < max(min_count, 2)).any():
+        shares = np.full(len(totals), 1 / len(totals))
+    elif strategy == THOMPSON_SAMPLING:
+        shares = thompson_sampling(np, totals, rng or np.random.default_rng(), samples)
+    else:
+        shares = epsilon_greedy(np, totals, epsilon)
+    return np.rint(shares * WEIGHT_SCALE).astype(int).tolist()
+
+
+def update_bandit_weights(strategy=THOMPSON_SAMPLING, seed=None, **kwargs):
+    """Compute the weights of the active cohorts of every active split test
+    with a bandit goal, store them and serve them from the current snapshot.
+
+    Keyword arguments are passed to `get_bandit_weights`. Return a dict of
+    the cohorts' UUIDs to their new weights.
+    """
+    np = _import_numpy()
+    rng = np.random.default_rng(seed)
+
+    cohorts = (
+        Cohort.objects.filter(is_active=True, split_test__is_active=True)
+        .exclude(split_test__bandit_goal="")
+        .select_related("split_test")
+        .order_by("split_test_id", *COHORT_ASSIGNMENT_ORDERING)
+        .only("id", "uuid", "bandit_weight", "split_test__bandit_goal")
+    )
+    changed = []
+    weights = {}
+    for _, split_test_cohorts in groupby(cohorts, key=lambda cohort: cohort.split_test_id):
+        split_test_cohorts = list(split_test_cohorts)
+        goal = split_test_cohorts[0].split_test.bandit_goal
+        totals = np.array(get_totals([cohort.id for cohort in split_test_cohorts], goal), float)
+        for cohort, weight in zip(
+            split_test_cohorts, get_bandit_weights(np, totals, strategy, rng, **kwargs)
+        ):
+            if cohort.bandit_weight != weight:
+                cohort.bandit_weight = weight
+                changed.append(cohort)
+            weights[str(cohort.uuid)] = weight
+
+    # `bulk_update` doesn't call `Cohort.save`, so the snapshot isn't rebuilt
+    # from the database; only the weights in the current one are replaced.
+    Cohort.objects.bulk_update(changed, ["bandit_weight"])
+    if changed:
+        SplitTest.cache.set_cohort_weights(weights)
+    return weights
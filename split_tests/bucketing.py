@@ -0,0 +1,135 @@
+from bisect import bisect_right
+from hashlib import sha256
+from itertools import accumulate, repeat
+
+
+# The number of buckets each layer's traffic is divided into. A split test's
+# `layer_allocation` is a percentage, so each bucket is one percent.
+LAYER_BUCKETS = 100
+
+
+def get_bucket(salt, unit_id, buckets=LAYER_BUCKETS):
+    """Return a stable bucket in `range(buckets)` for the given salt and unit
+    ID.
+
+    The salt (e.g. a layer UUID) ensures a user's bucket in one layer is
+    independent of their bucket in any other.
+    """
+    digest = sha256(f"{salt}:{unit_id}".encode()).digest()
+    return int.from_bytes(digest[:8], "big") % buckets
+
+
+def build_bucket_ranges(ranges, buckets=LAYER_BUCKETS):
+    """Return a tuple of `(upper_bounds, split_tests)` for a layer.
+
+    `ranges` is an iterable of `(split_test, start, allocation, is_active)`
+    tuples, where `split_test` identifies the split test (e.g. its UUID or
+    index) and owns `allocation` buckets from `start`. The ranges are stored
+    rather than derived from each other, so changing or removing one split
+    test never moves users between the others in the layer. Inactive tests
+    and any unallocated buckets map to `None`.
+
+    Split tests without any buckets (e.g. without a start, as the layer was
+    full) keep an empty range, which is never picked, so that they are still
+    excluded for every user in the layer. Overlapping ranges are truncated.
+    """
+    upper_bounds = []
+    split_tests = []
+    unplaced = []
+    lower_bound = 0
+    for split_test, start, allocation, is_active in sorted(ranges, key=_get_range_start):
+        split_test = split_test if is_active else None
+        if start is None:
+            unplaced.append(split_test)
+            continue
+        upper_bound = max(min(start + allocation, buckets), lower_bound)
+        start = min(max(start, lower_bound), upper_bound)
+        if start > lower_bound:
+            upper_bounds.append(start)
+            split_tests.append(None)
+        upper_bounds.append(upper_bound)
+        split_tests.append(split_test)
+        lower_bound = upper_bound
+    if unplaced:
+        if lower_bound < buckets:
+            upper_bounds.append(buckets)
+            split_tests.append(None)
+        upper_bounds.extend(repeat(buckets, len(unplaced)))
+        split_tests.extend(unplaced)
+    return tuple(upper_bounds), tuple(split_tests)
+
+
+def _get_range_start(bucket_range):
+    start = bucket_range[1]
+    return (start is None, start or 0)
+
+
+def find_bucket_start(ranges, allocation, buckets=LAYER_BUCKETS):
+    """Return the first bucket from which `allocation` buckets are free, given
+    the `(start, allocation)` of the ranges already allocated, or `None` if
+    there's no such gap.
+    """
+    start = 0
+    for range_start, range_allocation in sorted(ranges):
+        if range_start - start >= allocation:
+            return start
+        start = max(start, range_start + range_allocation)
+    if buckets - start >= allocation:
+        return start
+    return None
+
+
+def get_free_buckets(ranges, start=None, buckets=LAYER_BUCKETS):
+    """Return the number of free buckets from `start`, given the
+    `(start, allocation)` of the ranges already allocated, or the size of the
+    largest gap between them if `start` is `None`.
+    """
+    if start is not None:
+        if any(s <= start < s + a for s, a in ranges):
+            return 0
+        return max(min((s for s, _ in ranges if s > start), default=buckets) - start, 0)
+    largest_gap = 0
+    lower_bound = 0
+    for range_start, range_allocation in sorted(ranges):
+        largest_gap = max(largest_gap, range_start - lower_bound)
+        lower_bound = max(lower_bound, range_start + range_allocation)
+    return max(largest_gap, buckets - lower_bound)
+
+
+def pick_split_test_uuid(bucket_ranges, bucket):
+    """Return the UUID of the split test which owns `bucket`, or `None`."""
+    upper_bounds, split_test_uuids = bucket_ranges
+    index = bisect_right(upper_bounds, bucket)
+    if index < len(split_test_uuids):
+        return split_test_uuids[index]
+    return None
+
+
+def get_excluded_split_test_uuids(layer_bucket_ranges, unit_id):
+    """Return the UUIDs of the layered split tests the unit ID isn't bucketed
+    into, given the bucket ranges of each layer.
+    """
+    excluded_uuids = set()
+    for layer_uuid, bucket_ranges in layer_bucket_ranges.items():
+        selected_uuid = pick_split_test_uuid(bucket_ranges, get_bucket(layer_uuid, unit_id))
+        _, split_test_uuids = bucket_ranges
+        excluded_uuids.update(
+            split_test_uuid
+            for split_test_uuid in split_test_uuids
+            if split_test_uuid is not None and split_test_uuid != selected_uuid
+        )
+    return excluded_uuids
+
+
+def pick_weighted(salt, unit_id, weights):
+    """Return the index of the weight picked for the given salt and unit ID,
+    or `None` if every weight is zero.
+
+    Each index is picked for a share of unit IDs proportional to its weight,
+    and the same unit ID always picks the same index while the weights don't
+    change.
+    """
+    upper_bounds = list(accumulate(weights))
+    if not upper_bounds or upper_bounds[-1] <= 0:
+        return None
+    return bisect_right(upper_bounds, get_bucket(salt, unit_id, upper_bounds[-1]))
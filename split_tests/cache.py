@@ -1,14 +1,12 @@
 NEVER = None
 
 
-SPLIT_TEST_ACTIVE_UUIDS_KEY = (
-    "split_tests:managers:split_test_cache_manager:split_test_active_uuids"
-)
-SPLIT_TEST_UUID_SLUG_MAP_KEY = (
-    "split_tests:managers:split_test_cache_manager:split_test_uuid_slug_map"
-)
-COHORT_ACTIVE_UUIDS_KEY = "split_tests:managers:split_test_cache_manager:cohort_active_uuids"
-COHORT_UUID_SLUG_MAP_KEY = "split_tests:managers:split_test_cache_manager:cohort_uuid_slug_map"
-COHORT_UUID_SPLIT_TEST_UUID_MAP_KEY = (
-    "split_tests:managers:split_test_cache_manager:cohort_uuid_split_test_uuid_map"
-)
+SNAPSHOT_KEY = "split_tests:managers:split_test_cache_manager:snapshot"
+SNAPSHOT_VERSION_KEY = "split_tests:managers:split_test_cache_manager:snapshot_version"
+
+USER_ASSIGNMENTS_KEY = "split_tests:managers:cohort_manager:user_assignments:{user_id}"
+# Set while a user's assignments must be read from the primary database.
+USER_PINNED_KEY = "split_tests:managers:cohort_manager:user_pinned:{user_id}"
+
+# The Redis pub/sub channel used to announce new snapshot versions.
+SNAPSHOT_CHANNEL = "split_tests:snapshot"
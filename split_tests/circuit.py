@@ -0,0 +1,132 @@
+"""A circuit breaker around the cache calls made by the app, so that a slow
+or unavailable cache degrades split testing rather than every request.
+
+Once `failure_threshold` consecutive cache calls have failed or taken longer
+than `slow_call_threshold` seconds, the circuit opens: cache calls fail
+immediately with `CircuitOpenError`, the last known snapshot is served and
+no new assignments are made from the database. After `reset_timeout`
+seconds, a single call is let through to test the cache, closing the circuit
+if it succeeds.
+"""
+
+import logging
+import threading
+import time
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .config import SETTINGS_NAME, get_app_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class CacheUnavailable(Exception):
+    """A cache call failed or was skipped."""
+
+
+class CircuitOpenError(CacheUnavailable):
+    """A cache call was skipped because the circuit is open."""
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, slow_call_threshold=0.25):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call_threshold = slow_call_threshold
+
+        self.failures = 0
+        # The `time.monotonic()` the circuit was opened at, or `None` if it's
+        # closed.
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        """Return whether calls are currently being skipped."""
+        opened_at = self.opened_at
+        return opened_at is not None and time.monotonic() - opened_at < self.reset_timeout
+
+    def call(self, func, *args, **kwargs):
+        """Return `func(*args, **kwargs)`, raising `CacheUnavailable` if the
+        call fails and `CircuitOpenError` if it's skipped.
+        """
+        if self.opened_at is not None:
+            with self._lock:
+                if self.is_open():
+                    raise CircuitOpenError("The split test cache circuit is open.")
+                # Let this call test the cache, and keep skipping the others
+                # until it's done.
+                self.opened_at = time.monotonic()
+
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self._record_failure()
+            raise CacheUnavailable("The split test cache call failed.") from e
+
+        if time.monotonic() - start > self.slow_call_threshold:
+            # The result is still good, but the next caller might not be so
+            # lucky.
+            self._record_failure()
+        else:
+            self._record_success()
+        return result
+
+    def _record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning(
+                        "The split test cache circuit opened after %d failed or slow calls.",
+                        self.failures,
+                    )
+                self.opened_at = time.monotonic()
+
+    def _record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info("The split test cache circuit closed.")
+            self.failures = 0
+            self.opened_at = None
+
+
+_circuit_breaker = None
+
+
+def get_circuit_breaker():
+    """Return the circuit breaker configured by `CACHE_CIRCUIT_BREAKER`, or
+    `None` if it's disabled.
+    """
+    global _circuit_breaker
+    if _circuit_breaker is None:
+        options = get_app_settings()["CACHE_CIRCUIT_BREAKER"]
+        if options is None:
+            return None
+        _circuit_breaker = CircuitBreaker(**options)
+    return _circuit_breaker
+
+
+@receiver(setting_changed)
+def _reset_circuit_breaker(setting, **kwargs):
+    global _circuit_breaker
+    if setting == SETTINGS_NAME:
+        _circuit_breaker = None
+
+
+def call_cache(func, *args, **kwargs):
+    """Return `func(*args, **kwargs)` through the circuit breaker, if it's
+    enabled.
+    """
+    circuit_breaker = get_circuit_breaker()
+    if circuit_breaker is None:
+        return func(*args, **kwargs)
+    return circuit_breaker.call(func, *args, **kwargs)
+
+
+def is_cache_available():
+    """Return whether the circuit breaker is disabled or closed."""
+    circuit_breaker = get_circuit_breaker()
+    return circuit_breaker is None or not circuit_breaker.is_open()
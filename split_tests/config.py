@@ -6,13 +6,71 @@ SETTINGS_NAME = "DJANGO_SPLIT_TESTS"
 
 
 DEFAULTS = {
+    # Options for the circuit breaker around cache calls (see
+    # `split_tests.circuit.CircuitBreaker`), or `None` to disable it.
+    "CACHE_CIRCUIT_BREAKER": None,
     "COOKIE_DOMAIN": None,
     "COOKIE_MAX_AGE": 31_536_000,  # 1 year in seconds.
     "COOKIE_PREFIX": "dst:",
     "COOKIE_SECURE": True,
     "COOKIE_HTTPONLY": False,
     "COOKIE_SAMESITE": "Lax",
+    # Seconds the split test document may be cached for by clients and CDNs.
+    "DOCUMENT_MAX_AGE": 60,
+    # Flush buffered exposures once there are this many, or the oldest is this
+    # many seconds old.
+    "EXPOSURE_BATCH_SIZE": 500,
+    "EXPOSURE_FLUSH_INTERVAL": 5.0,
+    # The fraction of units whose exposures are logged, overridden per split
+    # test slug by `EXPOSURE_SAMPLE_RATES`.
+    "EXPOSURE_SAMPLE_RATE": 1.0,
+    "EXPOSURE_SAMPLE_RATES": {},
+    # The session key of the split tests the user has been exposed to.
+    "EXPOSURE_SESSION_KEY": "split_tests_exposed",
+    # The class exposures are written with, or `None` to disable logging them.
+    "EXPOSURE_SINK": None,
+    # Keyword arguments for the `EXPOSURE_SINK` class.
+    "EXPOSURE_SINK_OPTIONS": {},
+    # The alias of a read replica for snapshot rebuilds and assignment
+    # lookups, or `None` to read from the primary database.
+    "READ_DATABASE": None,
+    # Seconds to read a user's assignments from the primary database for
+    # after they change, until the replica has caught up.
+    "READ_YOUR_WRITES_TIMEOUT": 10,
+    # Add the middleware's timings to the `Server-Timing` header, and log
+    # them for this fraction of requests.
+    "SERVER_TIMING": False,
+    "SERVER_TIMING_LOG_SAMPLE_RATE": 0.0,
+    # Store the session's assignments as a string of short cohort IDs rather
+    # than a dict of UUIDs (see `split_tests.sessions`).
+    "SESSION_COMPACT": False,
     "SESSION_KEY": "split_tests",
+    # The session key of the snapshot version and unit ID the session's
+    # assignments were last checked against, which lets later requests skip
+    # checking them again.
+    "SESSION_STATE_KEY": "split_tests_state",
+    # Compress cached snapshots larger than this many bytes, or never if `None`.
+    # Compressing slows down decoding, so it's only worth it for stores with a
+    # size limit (e.g. memcached's 1 MiB) or a slow network.
+    "SNAPSHOT_COMPRESS_THRESHOLD": None,
+    # A local file the last known snapshot is kept in, for processes to fall
+    # back to if the cache is unavailable, or `None`.
+    "SNAPSHOT_FALLBACK_PATH": None,
+    # Rebuild the snapshot in a background thread in each process at least
+    # this often, in seconds, or never if `None`.
+    "SNAPSHOT_REFRESH_INTERVAL": None,
+    "SNAPSHOT_STORE": "split_tests.stores.CacheSnapshotStore",
+    # Keyword arguments for the `SNAPSHOT_STORE` class.
+    "SNAPSHOT_STORE_OPTIONS": {},
+    # Seconds to cache each user's assignments for.
+    "USER_ASSIGNMENTS_CACHE_TIMEOUT": 86_400,  # 1 day in seconds.
+    # The number of users whose assignments are also kept in each process, or
+    # 0 to disable. Entries expire after `USER_ASSIGNMENTS_LRU_TTL` seconds, as
+    # changes made by other processes aren't seen until then.
+    "USER_ASSIGNMENTS_LRU_SIZE": 0,
+    "USER_ASSIGNMENTS_LRU_TTL": 60,
+    # Must not start with `COOKIE_PREFIX`, which is reserved for cohort cookies.
+    "UNIT_ID_COOKIE_NAME": "dst_uid",
 }
 
 
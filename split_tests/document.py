@@ -0,0 +1,80 @@
+"""A JSON document describing the active split tests, for assigning users
+outside of Django (e.g. in an edge worker in front of a CDN).
+
+A unit ID is the user's `UNIT_ID_COOKIE_NAME` cookie, or a new random ID
+which must then be set in that cookie. Each split test and cohort is picked
+with the hash described by `hash`:
+
+    bucket(salt, unit_id, n) =
+        int.from_bytes(sha256(f"{salt}:{unit_id}")[:8], "big") % n
+
+1. For each layer, the user's bucket is `bucket(layer.uuid, unit_id,
+   layer_buckets)`. The split test of the first range whose upper bound is
+   greater than the bucket is selected, and every other split test in the
+   layer is skipped. A `null` split test means none is selected.
+2. For each remaining split test, the cohort is the first whose cumulative
+   weight is greater than `bucket(split_test.uuid, unit_id, total_weight)`,
+   with the cohorts in the order given.
+
+Split tests with `targeting` rules (see `split_tests.targeting`) only apply
+to users who match them. A worker which can't evaluate the rules (e.g. group
+membership) should leave those split tests to the middleware.
+
+The cohort UUID is then set in the `cookies.cohort_prefix` + split test UUID
+cookie, which the middleware validates and trusts.
+"""
+
+import json
+
+from .bucketing import LAYER_BUCKETS
+from .config import get_app_settings
+
+
+HASH_SPEC = {
+    "algorithm": "sha256",
+    "message": "{salt}:{unit_id}",
+    "digest_bytes": 8,
+    "byteorder": "big",
+}
+
+
+def build_document(snapshot):
+    """Return the document for the given snapshot as a JSON-serialisable
+    dict.
+    """
+    app_settings = get_app_settings()
+    return {
+        "version": snapshot.version,
+        "expires_at": snapshot.expires_at,
+        "hash": HASH_SPEC,
+        "layer_buckets": LAYER_BUCKETS,
+        "cookies": {
+            "unit_id": app_settings["UNIT_ID_COOKIE_NAME"],
+            "cohort_prefix": app_settings["COOKIE_PREFIX"],
+            "max_age": app_settings["COOKIE_MAX_AGE"],
+            "domain": app_settings["COOKIE_DOMAIN"],
+            "secure": app_settings["COOKIE_SECURE"],
+            "httponly": app_settings["COOKIE_HTTPONLY"],
+            "samesite": app_settings["COOKIE_SAMESITE"],
+        },
+        "split_tests": [
+            {
+                "uuid": split_test.uuid,
+                "slug": split_test.slug,
+                "targeting": json.loads(snapshot.get_targeting(split_test.uuid) or "[]"),
+                "cohorts": [
+                    {"uuid": cohort.uuid, "slug": cohort.slug, "weight": cohort.weight}
+                    for cohort in snapshot.get_cohorts(split_test.uuid)
+                ],
+            }
+            for split_test in snapshot.split_tests
+        ],
+        "layers": [
+            {
+                "uuid": layer.uuid,
+                "upper_bounds": layer.upper_bounds,
+                "split_tests": layer.split_test_uuids,
+            }
+            for layer in snapshot.layers
+        ],
+    }
@@ -0,0 +1,321 @@
+"""Exposure logging: recording which users actually saw each split test.
+
+The middleware logs an exposure the first time in a session that a view
+reads the user's cohort from `request.user.split_test_slug_map`, for a
+sample of users per split test. Exposures are buffered in each process and
+written in batches by the configured sink from a background thread, either
+straight to the database or to JSON Lines files which the `load_exposures`
+command imports later.
+"""
+
+import atexit
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from datetime import UTC, datetime
+from pathlib import Path
+from typing import NamedTuple
+
+from django.utils.module_loading import import_string
+
+from .bucketing import get_bucket
+from .config import get_app_settings
+from .threads import BackgroundThread, closing_old_connections
+
+
+logger = logging.getLogger(__name__)
+
+# The resolution of the sample rates.
+SAMPLE_BUCKETS = 10_000
+
+
+class ExposureEvent(NamedTuple):
+    cohort_uuid: str
+    # The ID of the authenticated user, or `None`.
+    user_id: int | None
+    unit_id: str
+    # A POSIX timestamp.
+    exposed_at: float
+
+
+class ExposureBuffer:
+    """Buffer exposures in memory and write them to `sink` in batches.
+
+    The buffer is flushed once it holds `batch_size` exposures or the oldest
+    is `flush_interval` seconds old, by a background thread started in each
+    process when the first exposure is added, so that requests never wait
+    for the sink. It's also flushed when the process exits.
+    """
+
+    def __init__(self, sink, batch_size=500, flush_interval=5.0):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._events = []
+        self._first_added_at = None
+        self._lock = threading.Lock()
+        self._thread = BackgroundThread(self.run, "split-tests-exposure-buffer")
+        self._wake = threading.Event()
+        atexit.register(self.flush)
+
+    def add(self, event):
+        """Buffer an exposure, waking the background thread if the buffer is
+        due to be flushed.
+        """
+        with self._lock:
+            if not self._events:
+                self._first_added_at = time.monotonic()
+            self._events.append(event)
+        self.ensure_started()
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        """Wake the background thread if the buffer is full or its oldest
+        exposure is too old.
+        """
+        if self.is_due():
+            self._wake.set()
+
+    def is_due(self):
+        """Return whether the buffer is full or its oldest exposure is too
+        old.
+        """
+        events = self._events
+        return bool(events) and (
+            len(events) >= self.batch_size
+            or time.monotonic() - self._first_added_at >= self.flush_interval
+        )
+
+    def ensure_started(self):
+        """Start the background thread if it isn't running in this process."""
+        self._thread.ensure_started()
+
+    def run(self):
+        """Flush the buffer whenever it's due."""
+        while True:
+            # Wake up at least once per interval to flush old exposures
+            # without waiting for a request.
+            self._wake.wait(self.flush_interval or None)
+            self._wake.clear()
+            if not self.is_due():
+                # Let the sink complete files which have been open too long,
+                # even while no exposures are being logged.
+                rotate_if_due = getattr(self.sink, "rotate_if_due", None)
+                if rotate_if_due is not None:
+                    rotate_if_due()
+                continue
+            with closing_old_connections():
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("Failed to write exposures.")
+
+    def flush(self):
+        """Write every buffered exposure to the sink."""
+        with self._lock:
+            events, self._events = self._events, []
+        # Write outside of the lock so other threads can keep logging.
+        if events:
+            self.sink.write(events)
+
+
+class DatabaseExposureSink:
+    """Write exposures to the `Exposure` table with bulk inserts."""
+
+    def __init__(self, batch_size=1_000):
+        self.batch_size = batch_size
+
+    def write(self, events):
+        """Insert the exposures, skipping those of deleted cohorts."""
+        from .models import Cohort, Exposure
+
+        cohort_ids = {
+            str(uuid): cohort_id
+            for uuid, cohort_id in Cohort.objects.filter(
+                uuid__in={event.cohort_uuid for event in events}
+            ).values_list("uuid", "id")
+        }
+        Exposure.objects.bulk_create(
+            (
+                Exposure(
+                    cohort_id=cohort_ids[event.cohort_uuid],
+                    user_id=event.user_id,
+                    unit_id=event.unit_id,
+                    exposed_at=datetime.fromtimestamp(event.exposed_at, UTC),
+                )
+                for event in events
+                if event.cohort_uuid in cohort_ids
+            ),
+            batch_size=self.batch_size,
+        )
+
+
+class JSONLinesExposureSink:
+    """Append exposures to a JSON Lines file in `directory`, one per process.
+
+    Once the file reaches `max_bytes`, has been open for `max_age` seconds,
+    or the process exits, it's renamed to end in `.jsonl` and a new file is
+    started; only renamed files are complete, and only those are imported by
+    `load_exposures`. Files left behind by processes which were killed are
+    completed by `complete_abandoned_files`.
+    """
+
+    suffix = ".jsonl"
+    partial_suffix = ".jsonl.part"
+
+    def __init__(self, directory, max_bytes=16 * 1024 * 1024, max_age=300.0):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        self._file = None
+        self._opened_at = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def write(self, events):
+        """Append the exposures to the current file, rotating it if full."""
+        lines = "".join(
+            json.dumps(event._asdict(), separators=(",", ":")) + "\n" for event in events
+        )
+        with self._lock:
+            if self._file is None:
+                # Each file is named after the process writing it, so that
+                # processes never write to the same file.
+                name = f"exposures-{socket.gethostname()}-{os.getpid()}-{time.time_ns()}"
+                self._file = open(self.directory / f"{name}{self.partial_suffix}", "a")
+                self._opened_at = time.monotonic()
+            self._file.write(lines)
+            self._file.flush()
+            if self._file.tell() >= self.max_bytes or self._is_old():
+                self._rotate()
+
+    def rotate_if_due(self):
+        """Complete the current file if it's been open for `max_age` seconds."""
+        with self._lock:
+            if self._file is not None and self._is_old():
+                self._rotate()
+
+    def close(self):
+        """Complete the current file."""
+        with self._lock:
+            if self._file is not None:
+                self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        path = self._file.name
+        os.replace(path, path.removesuffix(self.partial_suffix) + self.suffix)
+        self._file = None
+
+    def _is_old(self):
+        return self.max_age is not None and time.monotonic() - self._opened_at >= self.max_age
+
+
+def complete_abandoned_files(directory):
+    """Complete the partial files in `directory` whose writing process on this
+    host no longer exists (e.g. because it was killed), and return their new
+    paths.
+
+    Files written on other hosts are left alone, as there's no telling
+    whether their processes are still running.
+    """
+    hostname = socket.gethostname()
+    completed = []
+    partial_suffix = JSONLinesExposureSink.partial_suffix
+    for path in Path(directory).glob(f"exposures-*{partial_suffix}"):
+        # Files are named `exposures-{hostname}-{pid}-{time}`.
+        name, _, _ = path.name.removesuffix(partial_suffix).rpartition("-")
+        name, _, pid = name.rpartition("-")
+        if name != f"exposures-{hostname}" or not pid.isdigit() or is_running(int(pid)):
+            continue
+        completed_path = path.with_name(
+            path.name.removesuffix(partial_suffix) + JSONLinesExposureSink.suffix
+        )
+        os.replace(path, completed_path)
+        completed.append(completed_path)
+    return completed
+
+
+def is_running(pid):
+    """Return whether a process with the given ID exists on this host."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists, but belongs to another user.
+        pass
+    return True
+
+
+def read_exposure_file(path):
+    """Yield the exposures in a JSON Lines file written by
+    `JSONLinesExposureSink`.
+    """
+    with open(path) as f:
+        for line in f:
+            # A file abandoned by a killed process may end part way through
+            # a line.
+            if not line.endswith("\n"):
+                break
+            yield ExposureEvent(**json.loads(line))
+
+
+def get_exposure_buffer():
+    """Return a buffer for the configured exposure sink, or `None` if
+    exposure logging is disabled.
+    """
+    app_settings = get_app_settings()
+    if app_settings["EXPOSURE_SINK"] is None:
+        return None
+    sink_class = import_string(app_settings["EXPOSURE_SINK"])
+    return ExposureBuffer(
+        sink_class(**app_settings["EXPOSURE_SINK_OPTIONS"]),
+        batch_size=app_settings["EXPOSURE_BATCH_SIZE"],
+        flush_interval=app_settings["EXPOSURE_FLUSH_INTERVAL"],
+    )
+
+
+def is_sampled(split_test_uuid, split_test_slug, unit_id):
+    """Return whether the exposures of the unit ID to the split test are
+    logged, according to the split test's sample rate.
+
+    The same units are always sampled, so a user's exposures are either all
+    logged or none are.
+    """
+    app_settings = get_app_settings()
+    sample_rate = app_settings["EXPOSURE_SAMPLE_RATES"].get(
+        split_test_slug, app_settings["EXPOSURE_SAMPLE_RATE"]
+    )
+    if sample_rate >= 1:
+        return True
+    bucket = get_bucket(f"exposure:{split_test_uuid}", unit_id, SAMPLE_BUCKETS)
+    return bucket < sample_rate * SAMPLE_BUCKETS
+
+
+class ExposureTrackingDict(dict):
+    """A dict of split test slugs to cohort slugs which calls
+    `on_access(split_test_slug)` whenever a cohort is looked up.
+    """
+
+    __slots__ = ("on_access",)
+
+    def __init__(self, data, on_access):
+        super().__init__(data)
+        self.on_access = on_access
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.on_access(key)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
@@ -1,9 +1,47 @@
 from django.utils.translation import gettext_lazy as _
 
 
+SPLIT_TEST = {
+    "deleted_at": _(
+        "When the split test was deleted. Deleted split tests are purged, along with their"
+        " assignments, by the purge_split_tests management command."
+    ),
+    "layer": _(
+        "Split tests in the same layer are mutually exclusive; each user is eligible for at most one"
+        " of them."
+    ),
+    "layer_allocation": _(
+        "The percentage of the layer's users who are eligible for this split test. Only used when a"
+        " layer is selected."
+    ),
+    "layer_bucket_start": _(
+        "The first of the layer's buckets allocated to this split test. It's kept when the other"
+        " split tests in the layer change, so that their users don't move."
+    ),
+    "starts_at": _("If set, the split test only starts at this time. It must also be active."),
+    "ends_at": _("If set, the split test ends at this time."),
+    "targeting": _(
+        "A list of rules, all of which a user must match to be eligible for this split test, e.g."
+        ' [{"user": "is_staff", "not": true}, {"group": "beta"}]. Leave empty to include everyone.'
+    ),
+    "bandit_goal": _(
+        "If set, the cohorts' weights are adapted to their results for this goal by the"
+        " update_bandit_weights management command, rather than being fixed."
+    ),
+}
+
+
 COHORT = {
+    "deleted_at": _(
+        "When the cohort was deleted. Deleted cohorts are purged, along with their assignments, by"
+        " the purge_split_tests management command."
+    ),
     "weight": _(
         "Enter any positive integer.\n\nFor example, if you want two cohorts with a 75%/25% split, you could enter 75 for"
         " the first cohort and 25 for the second, or 3 for the first cohort and 1 for the second."
-    )
+    ),
+    "bandit_weight": _(
+        "The weight computed by the update_bandit_weights management command, used instead of the"
+        " weight while the split test has a bandit goal."
+    ),
 }
@@ -0,0 +1,58 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class LRUCache:
+    """A bounded, thread-safe, in-process cache which evicts the least
+    recently used entry once it holds `maxsize` entries.
+
+    Entries also expire `ttl` seconds after they're set, if given, as the
+    cache can't see changes made by other processes.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Return the value for `key`, or `default` if it's missing or has
+        expired.
+        """
+        with self._lock:
+            try:
+                expires_at, value = self._entries[key]
+            except KeyError:
+                return default
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Set the value for `key`, evicting the least recently used entry if
+        the cache is full.
+        """
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Remove `key` from the cache, if it's present."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove every entry from the cache."""
+        with self._lock:
+            self._entries.clear()
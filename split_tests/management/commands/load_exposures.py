@@ -0,0 +1,48 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ...exposures import (
+    DatabaseExposureSink,
+    JSONLinesExposureSink,
+    complete_abandoned_files,
+    read_exposure_file,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Import the completed JSON Lines files written by JSONLinesExposureSink into the"
+        " exposures table, deleting each file once it's imported. Files left partially written"
+        " by processes on this host which no longer exist are completed and imported too."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory", help="The directory the exposure files are written to.")
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1_000,
+            help="The number of exposures to insert at a time. Defaults to 1000.",
+        )
+
+    def handle(self, *args, **options):
+        directory = Path(options["directory"])
+        if not directory.is_dir():
+            raise CommandError(f"{directory} is not a directory.")
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be a positive integer.")
+
+        for path in complete_abandoned_files(directory):
+            self.stdout.write(f"Completed {path.name}, whose process no longer exists.")
+
+        sink = DatabaseExposureSink(batch_size=options["batch_size"])
+        for path in sorted(directory.glob(f"*{JSONLinesExposureSink.suffix}")):
+            # Import each file in a single transaction, so that a failed
+            # import can safely be run again.
+            with transaction.atomic():
+                events = list(read_exposure_file(path))
+                sink.write(events)
+            path.unlink()
+            self.stdout.write(f"Imported {len(events)} exposure(s) from {path.name}.")
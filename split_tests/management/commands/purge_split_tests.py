@@ -0,0 +1,75 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import Cohort, SplitTest
+from ...purge import purge_assignments, purge_cohort, purge_split_test
+
+
+class Command(BaseCommand):
+    help = (
+        "Archive and delete, in small chunks, the assignments of split tests and cohorts which"
+        " have been deleted, then delete the split tests and cohorts themselves."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--archive-dir",
+            help="The directory to archive the assignments to, as one gzipped CSV per split test.",
+        )
+        parser.add_argument(
+            "--no-archive",
+            action="store_true",
+            help="Delete the assignments without archiving them.",
+        )
+        parser.add_argument(
+            "--inactive",
+            action="store_true",
+            help=(
+                "Also archive and delete the assignments of inactive split tests which haven't"
+                " been deleted, keeping the split tests themselves."
+            ),
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1_000,
+            help="The number of assignments to delete at a time. Defaults to 1000.",
+        )
+        parser.add_argument(
+            "--delay",
+            type=float,
+            default=0.1,
+            help="The number of seconds to pause between chunks. Defaults to 0.1.",
+        )
+
+    def handle(self, *args, **options):
+        archive_dir = options["archive_dir"]
+        if archive_dir is None and not options["no_archive"]:
+            raise CommandError("Either --archive-dir or --no-archive is required.")
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be a positive integer.")
+
+        kwargs = {
+            "archive_dir": archive_dir,
+            "chunk_size": options["chunk_size"],
+            "delay": options["delay"],
+        }
+
+        # Split tests which were deleted and then re-activated are kept.
+        for split_test in SplitTest.objects.filter(deleted_at__isnull=False, is_active=False):
+            deleted = purge_split_test(split_test, **kwargs)
+            self.stdout.write(f"Purged {split_test.slug} and {deleted} assignment(s).")
+
+        # Cohorts of split tests which are kept.
+        cohorts = Cohort.objects.filter(deleted_at__isnull=False, is_active=False).select_related(
+            "split_test"
+        )
+        for cohort in cohorts:
+            deleted = purge_cohort(cohort, **kwargs)
+            self.stdout.write(
+                f"Purged {cohort.split_test.slug}/{cohort.slug} and {deleted} assignment(s)."
+            )
+
+        if options["inactive"]:
+            for split_test in SplitTest.objects.filter(deleted_at__isnull=True, is_active=False):
+                deleted = purge_assignments(split_test, **kwargs)
+                self.stdout.write(f"Purged {deleted} assignment(s) of {split_test.slug}.")
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import SplitTest
+from ...refresh import SnapshotRefresher
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the snapshot of active split tests in a loop, so that requests never wait for"
+        " it to be rebuilt."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=60.0,
+            help=(
+                "The number of seconds between rebuilds, if no split test starts or ends"
+                " sooner. Defaults to 60."
+            ),
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Rebuild the snapshot once and exit.",
+        )
+
+    def handle(self, *args, **options):
+        if options["interval"] <= 0:
+            raise CommandError("--interval must be a positive number.")
+
+        refresher = SnapshotRefresher(SplitTest.cache, options["interval"])
+        if options["once"]:
+            snapshot = refresher.refresh()
+            if snapshot is None:
+                raise CommandError("Failed to refresh the split test snapshot.")
+            self.stdout.write(f"Refreshed snapshot {snapshot.version}.")
+            return
+
+        try:
+            refresher.run()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...bandit import STRATEGIES, THOMPSON_SAMPLING, update_bandit_weights
+
+
+class Command(BaseCommand):
+    help = (
+        "Update the weights of the cohorts of split tests with a bandit goal from their results."
+        " Run it periodically, e.g. every few minutes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--strategy",
+            choices=STRATEGIES,
+            default=THOMPSON_SAMPLING,
+            help="How to weight the cohorts. Defaults to thompson_sampling.",
+        )
+        parser.add_argument(
+            "--epsilon",
+            type=float,
+            default=0.1,
+            help=(
+                "The share of users split equally between the cohorts, with epsilon_greedy."
+                " Defaults to 0.1."
+            ),
+        )
+        parser.add_argument(
+            "--min-count",
+            type=int,
+            default=100,
+            help=(
+                "The number of values every cohort needs before the weights adapt to them."
+                " Defaults to 100."
+            ),
+        )
+        parser.add_argument(
+            "--samples",
+            type=int,
+            default=10_000,
+            help="The number of draws per cohort, with thompson_sampling. Defaults to 10000.",
+        )
+
+    def handle(self, *args, **options):
+        if not 0 <= options["epsilon"] <= 1:
+            raise CommandError("--epsilon must be between 0 and 1.")
+        if options["samples"] < 1:
+            raise CommandError("--samples must be a positive number.")
+
+        weights = update_bandit_weights(
+            options["strategy"],
+            epsilon=options["epsilon"],
+            min_count=options["min_count"],
+            samples=options["samples"],
+        )
+        self.stdout.write(f"Updated the weights of {len(weights)} cohort(s).")
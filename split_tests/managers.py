@@ -1,128 +1,563 @@
+import logging
+import math
+import time
+
+from contextlib import suppress
+from dataclasses import replace
+from itertools import islice
 from random import choices
 
 from django.contrib.sites.models import Site
 from django.core.cache import cache
-from django.db.models import Exists, Manager, OuterRef
+from django.db import router
+from django.db.models import Case, Exists, F, Manager, Min, OuterRef, Q, When
+from django.utils import timezone
+
+from . import cache as cache_config, codec, targeting
+from .bucketing import build_bucket_ranges, get_bucket, pick_split_test_uuid, pick_weighted
+from .circuit import CacheUnavailable, call_cache
+from .config import get_app_settings
+from .lru import LRUCache
+from .snapshot import Snapshot
+from .stores import get_snapshot_store, write_atomically
+from .timing import count_cache_call
+
+
+logger = logging.getLogger(__name__)
 
-from . import cache as cache_config
+# The order in which a split test's cohorts are picked from, both by
+# `CohortManager` and in snapshots.
+COHORT_ASSIGNMENT_ORDERING = ("-weight", "id")
+
+# The weight cohorts are assigned with: the weight computed by
+# `bandit.update_bandit_weights` if their split test has a bandit goal, or
+# their own.
+ASSIGNMENT_WEIGHT = Case(
+    When(Q(split_test__bandit_goal="") | Q(bandit_weight__isnull=True), then=F("weight")),
+    default=F("bandit_weight"),
+)
 
 
 class SplitTestCacheManager(Manager):
     """A Manager for the SplitTest model which keeps caches of active
     split tests and cohorts in memory for performance reasons.
+
+    The snapshot is stored in the configured snapshot store (the cache by
+    default) alongside its version, and each process keeps the last snapshot
+    it decoded. Reading the snapshot only fetches the small version unless the
+    snapshot has changed.
     """
 
-    def update(self):
-        """Update the caches of active split tests and cohorts UUIDs and slugs."""
-        split_test_active_uuids = set()
-        split_test_uuid_slug_map = {}
-        cohort_active_uuids = set()
-        cohort_uuid_slug_map = {}
-        cohort_uuid_split_test_uuid_map = {}
+    def __init__(self):
+        super().__init__()
+        self.local_snapshot = None
+        # An optional `SnapshotRefresher` which rebuilds the snapshot in the
+        # background.
+        self.refresher = None
+        self._store = None
+
+    @property
+    def store(self):
+        """The snapshot store, created from the app settings when first used."""
+        if self._store is None:
+            self.store = get_snapshot_store()
+        return self._store
+
+    @store.setter
+    def store(self, store):
+        self._store = store
+        # Stores which can push new versions to us (e.g. Redis) let us swap
+        # the local snapshot before any request asks for it.
+        store.subscribe(self._on_new_version)
 
+    def update(self, using=None):
+        """Update the cached snapshot of active split tests, cohorts and layers
+        and return it.
+
+        The snapshot is read from the `using` database, or the primary one by
+        default so that the changes of a model being saved are included.
+        """
         current_site = Site.objects.get_current()
+        now = timezone.now()
         Cohort = self.model._meta.get_field("cohorts").related_model
         active_cohorts = Cohort.objects.filter(split_test_id=OuterRef("id"), is_active=True)
         split_tests = (
             self.get_queryset()
+            .using(using)
             # The `Exists` check is more performant than filtering on
             # `cohorts__is_active=True` and then later calling `distinct()`.
-            .filter(Exists(active_cohorts), is_active=True, site=current_site)
-            .values_list("id", "uuid", "slug")
-        )
-        split_test_ids = []
-        for split_test_id, split_test_uuid, split_test_slug in split_tests:
-            split_test_uuid = str(split_test_uuid)
-
-            split_test_ids.append(split_test_id)
-            split_test_active_uuids.add(split_test_uuid)
-            split_test_uuid_slug_map[split_test_uuid] = split_test_slug
-
-        if split_test_ids:
-            cohorts = Cohort.objects.filter(
-                split_test_id__in=split_test_ids, is_active=True
-            ).values_list("uuid", "slug", "split_test__uuid")
-            for cohort_uuid, cohort_slug, split_test_uuid in cohorts:
-                cohort_uuid = str(cohort_uuid)
-                split_test_uuid = str(split_test_uuid)
-
-                cohort_active_uuids.add(cohort_uuid)
-                cohort_uuid_slug_map[cohort_uuid] = cohort_slug
-                cohort_uuid_split_test_uuid_map[cohort_uuid] = split_test_uuid
-
-        cache.set(
-            cache_config.SPLIT_TEST_ACTIVE_UUIDS_KEY,
-            split_test_active_uuids,
-            timeout=cache_config.NEVER,
-        )
-        cache.set(
-            cache_config.SPLIT_TEST_UUID_SLUG_MAP_KEY,
-            split_test_uuid_slug_map,
-            timeout=cache_config.NEVER,
+            .filter(
+                Exists(active_cohorts),
+                Q(starts_at__isnull=True) | Q(starts_at__lte=now),
+                Q(ends_at__isnull=True) | Q(ends_at__gt=now),
+                is_active=True,
+                site=current_site,
+            )
+            .values_list("id", "uuid", "slug", "targeting")
         )
-        cache.set(
-            cache_config.COHORT_ACTIVE_UUIDS_KEY,
-            cohort_active_uuids,
-            timeout=cache_config.NEVER,
+        split_test_rows = []
+        split_test_indexes = {}
+        targeting_rows = []
+        for split_test_id, split_test_uuid, split_test_slug, rules in split_tests:
+            if rules:
+                targeting_rows.append((len(split_test_rows), targeting.dumps(rules)))
+            split_test_indexes[split_test_id] = len(split_test_rows)
+            split_test_rows.append((str(split_test_uuid), split_test_slug))
+
+        cohort_rows = []
+        if split_test_indexes:
+            # Cohorts must be in a stable order, as the deterministic
+            # assignment in `bucketing.pick_weighted` depends on it.
+            cohorts = (
+                Cohort.objects.using(using)
+                .filter(split_test_id__in=split_test_indexes, is_active=True)
+                .order_by("split_test_id", *COHORT_ASSIGNMENT_ORDERING)
+                .values_list("uuid", "slug", "split_test_id", ASSIGNMENT_WEIGHT)
+            )
+            for cohort_uuid, cohort_slug, split_test_id, weight in cohorts:
+                cohort_rows.append(
+                    (str(cohort_uuid), cohort_slug, split_test_indexes[split_test_id], weight)
+                )
+
+        # Each split test keeps the buckets stored with it, whether it's
+        # active or not, so stopping one test doesn't move users between the
+        # others.
+        layered_split_tests = (
+            self.get_queryset()
+            .using(using)
+            .filter(layer__isnull=False, site=current_site)
+            .order_by("layer_id", "id")
+            .values_list("layer__uuid", "id", "layer_bucket_start", "layer_allocation")
         )
-        cache.set(
-            cache_config.COHORT_UUID_SLUG_MAP_KEY,
-            cohort_uuid_slug_map,
-            timeout=cache_config.NEVER,
+        layer_ranges = {}
+        for layer_uuid, split_test_id, start, allocation in layered_split_tests:
+            layer_ranges.setdefault(str(layer_uuid), []).append(
+                (
+                    split_test_indexes.get(split_test_id),
+                    start,
+                    allocation,
+                    split_test_id in split_test_indexes,
+                )
+            )
+        layer_rows = []
+        for layer_uuid, ranges in layer_ranges.items():
+            layer_rows.append((layer_uuid, *build_bucket_ranges(ranges)))
+
+        # The snapshot expires when the next scheduled split test starts or
+        # ends, so requests never need to check the schedule themselves.
+        transitions = (
+            self.get_queryset()
+            .using(using)
+            .filter(is_active=True, site=current_site)
+            .aggregate(
+                next_start=Min("starts_at", filter=Q(starts_at__gt=now)),
+                next_end=Min("ends_at", filter=Q(ends_at__gt=now)),
+            )
         )
-        cache.set(
-            cache_config.COHORT_UUID_SPLIT_TEST_UUID_MAP_KEY,
-            cohort_uuid_split_test_uuid_map,
-            timeout=cache_config.NEVER,
+        transition_times = [t for t in transitions.values() if t is not None]
+        expires_at = min(transition_times).timestamp() if transition_times else None
+
+        snapshot = Snapshot.from_rows(
+            split_test_rows, cohort_rows, layer_rows, targeting_rows, expires_at=expires_at
         )
+        self.set_snapshot(snapshot)
+        return snapshot
+
+    def rebuild(self):
+        """Rebuild the snapshot from `READ_DATABASE`, e.g. when a request finds
+        it missing from the store or expired rather than because it has
+        changed. The refresher rebuilds it from the primary database instead.
+        """
+        return self.update(using=get_app_settings()["READ_DATABASE"])
 
-        return (
-            split_test_active_uuids,
-            split_test_uuid_slug_map,
-            cohort_active_uuids,
-            cohort_uuid_slug_map,
-            cohort_uuid_split_test_uuid_map,
+    def set_cohort_weights(self, weights):
+        """Replace the weights of cohorts in the current snapshot, given a
+        dict of cohort UUIDs to weights, and return the new snapshot.
+
+        This lets weights computed elsewhere (e.g. by a bandit) be served
+        without rebuilding the snapshot from the database. If the stored
+        snapshot changed since it was read (e.g. a split test was saved), it's
+        rebuilt instead, so the change isn't overwritten; the weights must
+        already be in the database for the rebuild to include them.
+        """
+        snapshot = self.snapshot()
+        cohorts = tuple(
+            cohort._replace(weight=weights[cohort.uuid]) if cohort.uuid in weights else cohort
+            for cohort in snapshot.cohorts
         )
+        if cohorts == snapshot.cohorts:
+            return snapshot
+        try:
+            stored_version = call_cache(self.store.get_version)
+        except CacheUnavailable:
+            stored_version = None
+        if stored_version != snapshot.version:
+            return self.update()
+        snapshot = replace(snapshot, cohorts=cohorts, version=None)
+        self.set_snapshot(snapshot)
+        return snapshot
+
+    def set_snapshot(self, snapshot):
+        """Store the snapshot and use it in this process.
+
+        If the store is unavailable, the snapshot is only used in this
+        process.
+        """
+        data = codec.encode(snapshot, get_app_settings()["SNAPSHOT_COMPRESS_THRESHOLD"])
+        timeout = cache_config.NEVER
+        if snapshot.expires_at is not None:
+            timeout = max(math.ceil(snapshot.expires_at - time.time()), 1)
+        try:
+            call_cache(self.store.set, data, snapshot.version, timeout)
+        except CacheUnavailable:
+            logger.warning("Failed to store split test snapshot %s.", snapshot.version)
+        self.local_snapshot = snapshot
+        self._write_fallback(data)
+
+    def snapshot(self):
+        """Return the snapshot of active split tests, cohorts and layers from
+        the store.
+
+        If the stored snapshot is missing or has expired, it's rebuilt, unless
+        a refresher is running in this process, in which case it's woken to
+        rebuild the snapshot and the local one is returned in the meantime.
+        If the store is unavailable, the last known snapshot is returned.
+        """
+        refresher = self.refresher
+        if refresher is not None:
+            refresher.ensure_started()
+
+        try:
+            return self._get_snapshot()
+        except CacheUnavailable:
+            return self._get_last_known_snapshot()
+
+    def _get_snapshot(self):
+        version = call_cache(self.store.get_version)
+        if version is None:
+            return self._rebuild(self.local_snapshot)
+
+        snapshot = self.local_snapshot
+        if snapshot is None or snapshot.version != version:
+            snapshot = self._fetch()
+        if snapshot is None or snapshot.is_expired(time.time()):
+            return self._rebuild(snapshot or self.local_snapshot)
+        return snapshot
+
+    def _rebuild(self, stale_snapshot):
+        refresher = self.refresher
+        if stale_snapshot is not None and refresher is not None and refresher.is_running():
+            refresher.wake()
+            return stale_snapshot
+        return self.rebuild()
+
+    def _fetch(self):
+        """Return the stored snapshot and use it in this process, or return
+        `None` if it's missing or was stored in a format this version of the
+        app doesn't support.
+        """
+        data = call_cache(self.store.get)
+        try:
+            snapshot = codec.decode(data)
+        except ValueError:
+            return None
+        self.local_snapshot = snapshot
+        self._write_fallback(data)
+        return snapshot
+
+    def _get_last_known_snapshot(self):
+        """Return this process's snapshot, or the one in the
+        `SNAPSHOT_FALLBACK_PATH` file, or rebuild it if neither is current.
+        """
+        now = time.time()
+        snapshot = self.local_snapshot
+        if snapshot is None or snapshot.is_expired(now):
+            snapshot = self._read_fallback()
+        if snapshot is None or snapshot.is_expired(now):
+            snapshot = self.rebuild()
+        return snapshot
+
+    def _read_fallback(self):
+        path = get_app_settings()["SNAPSHOT_FALLBACK_PATH"]
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            snapshot = codec.decode(data)
+        except ValueError:
+            return None
+        self.local_snapshot = snapshot
+        return snapshot
+
+    def _write_fallback(self, data):
+        path = get_app_settings()["SNAPSHOT_FALLBACK_PATH"]
+        if path is None:
+            return
+        try:
+            write_atomically(path, data)
+        except OSError:
+            logger.exception("Failed to write the split test snapshot to %s.", path)
+
+    def _on_new_version(self, version):
+        local_snapshot = self.local_snapshot
+        if local_snapshot is None or local_snapshot.version != version:
+            self._fetch()
 
     def split_test_active_uuids(self):
-        """Return a set of UUIDs for all active SplitTests from the cache."""
-        split_test_active_uuids = cache.get(cache_config.SPLIT_TEST_ACTIVE_UUIDS_KEY)
-        if split_test_active_uuids is None:
-            split_test_active_uuids, _, _, _, _ = self.update()
-        return split_test_active_uuids
+        """Return a read-only, set-like view of the UUIDs of all active
+        SplitTests from the cache.
+        """
+        return self.snapshot().split_test_active_uuids
 
     def split_test_uuid_slug_map(self):
-        """Return a dict mapping UUIDs to slugs for all active SplitTests from the cache."""
-        split_test_uuid_slug_map = cache.get(cache_config.SPLIT_TEST_UUID_SLUG_MAP_KEY)
-        if split_test_uuid_slug_map is None:
-            _, split_test_uuid_slug_map, _, _, _ = self.update()
-        return split_test_uuid_slug_map
+        """Return a read-only mapping of UUIDs to slugs for all active
+        SplitTests from the cache.
+        """
+        return self.snapshot().split_test_uuid_slug_map
 
     def cohort_active_uuids(self):
-        """Return a set of UUIDs for all active Cohorts from the cache."""
-        cohort_active_uuids = cache.get(cache_config.COHORT_ACTIVE_UUIDS_KEY)
-        if cohort_active_uuids is None:
-            _, _, cohort_active_uuids, _, _ = self.update()
-        return cohort_active_uuids
+        """Return a read-only, set-like view of the UUIDs of all active Cohorts
+        from the cache.
+        """
+        return self.snapshot().cohort_active_uuids
 
     def cohort_uuid_slug_map(self):
-        """Return a dict mapping UUIDs to slugs for all active Cohorts from the cache."""
-        cohort_uuid_slug_map = cache.get(cache_config.COHORT_UUID_SLUG_MAP_KEY)
-        if cohort_uuid_slug_map is None:
-            _, _, _, cohort_uuid_slug_map, _ = self.update()
-        return cohort_uuid_slug_map
+        """Return a read-only mapping of UUIDs to slugs for all active Cohorts
+        from the cache.
+        """
+        return self.snapshot().cohort_uuid_slug_map
 
     def cohort_uuid_split_test_uuid_map(self):
-        """Return a dict mapping Cohort UUIDs to SplitTest UUIDs from the cache."""
-        cohort_uuid_split_test_uuid_map = cache.get(
-            cache_config.COHORT_UUID_SPLIT_TEST_UUID_MAP_KEY
-        )
-        if cohort_uuid_split_test_uuid_map is None:
-            _, _, _, _, cohort_uuid_split_test_uuid_map = self.update()
-        return cohort_uuid_split_test_uuid_map
+        """Return a read-only mapping of Cohort UUIDs to SplitTest UUIDs from
+        the cache.
+        """
+        return self.snapshot().cohort_uuid_split_test_uuid_map
+
+    def layer_bucket_ranges(self):
+        """Return a read-only mapping of Layer UUIDs to their bucket ranges
+        from the cache.
+        """
+        return self.snapshot().layer_bucket_ranges
 
 
 class CohortManager(Manager):
+    def __init__(self):
+        super().__init__()
+        self._local_user_assignments = None
+
+    @property
+    def local_user_assignments(self):
+        """The in-process LRU cache of user assignments, or `None` if it's
+        disabled.
+        """
+        if self._local_user_assignments is None:
+            app_settings = get_app_settings()
+            if not app_settings["USER_ASSIGNMENTS_LRU_SIZE"]:
+                return None
+            self._local_user_assignments = LRUCache(
+                app_settings["USER_ASSIGNMENTS_LRU_SIZE"], app_settings["USER_ASSIGNMENTS_LRU_TTL"]
+            )
+        return self._local_user_assignments
+
+    def get_user_assignments(self, user):
+        """Return a dict of split test UUIDs to a tuple of the UUIDs of the
+        cohorts the given user is assigned to, oldest first.
+
+        The assignments are read from the database in a single query and
+        cached until they change. Inactive cohorts are included, so callers
+        must check the cohorts against the active ones.
+        """
+        key = cache_config.USER_ASSIGNMENTS_KEY.format(user_id=user.pk)
+        local_user_assignments = self.local_user_assignments
+        if local_user_assignments is not None:
+            assignments = local_user_assignments.get(key)
+            if assignments is not None:
+                return assignments
+
+        count_cache_call()
+        try:
+            assignments = call_cache(cache.get, key)
+        except CacheUnavailable:
+            assignments = None
+
+        if assignments is None:
+            rows = (
+                self.get_queryset()
+                .using(self.get_read_database(user.pk))
+                .filter(assignments__user=user)
+                .order_by("assignments__assigned_at", "assignments__id")
+                .values_list("split_test__uuid", "uuid")
+            )
+            grouped = {}
+            for split_test_uuid, cohort_uuid in rows:
+                grouped.setdefault(str(split_test_uuid), []).append(str(cohort_uuid))
+            assignments = {uuid: tuple(cohort_uuids) for uuid, cohort_uuids in grouped.items()}
+            count_cache_call()
+            with suppress(CacheUnavailable):
+                call_cache(
+                    cache.set,
+                    key,
+                    assignments,
+                    timeout=get_app_settings()["USER_ASSIGNMENTS_CACHE_TIMEOUT"],
+                )
+
+        if local_user_assignments is not None:
+            local_user_assignments.set(key, assignments)
+        return assignments
+
+    def invalidate_user_assignments(self, *user_ids):
+        """Remove the cached assignments of the users with the given IDs.
+
+        If there's a `READ_DATABASE`, the users' assignments are also read
+        from the primary database for the next `READ_YOUR_WRITES_TIMEOUT`
+        seconds, until the replica has caught up with the change.
+        """
+        keys = [cache_config.USER_ASSIGNMENTS_KEY.format(user_id=user_id) for user_id in user_ids]
+        try:
+            call_cache(cache.delete_many, keys)
+        except CacheUnavailable:
+            logger.warning("Failed to invalidate the cached assignments of %d user(s).", len(keys))
+        if self._local_user_assignments is not None:
+            for key in keys:
+                self._local_user_assignments.delete(key)
+
+        app_settings = get_app_settings()
+        if app_settings["READ_DATABASE"] is not None:
+            pins = {
+                cache_config.USER_PINNED_KEY.format(user_id=user_id): True for user_id in user_ids
+            }
+            with suppress(CacheUnavailable):
+                call_cache(cache.set_many, pins, timeout=app_settings["READ_YOUR_WRITES_TIMEOUT"])
+
+    def get_read_database(self, user_id=None):
+        """Return the alias of the database to read assignments from, or
+        `None` for the default routing.
+
+        This is the `READ_DATABASE`, unless the assignments of the user with
+        the given ID have just changed and might not have reached it yet.
+        """
+        read_database = get_app_settings()["READ_DATABASE"]
+        if read_database is None or user_id is None:
+            return read_database
+        try:
+            is_pinned = call_cache(
+                cache.get, cache_config.USER_PINNED_KEY.format(user_id=user_id), False
+            )
+        except CacheUnavailable:
+            # Err on the side of reading the user's own writes.
+            is_pinned = True
+        return None if is_pinned else read_database
+
+    def iter_cohort_slugs(self, user_ids, split_test_uuid, chunk_size=1_000, assign=False):
+        """Yield a `(user_id, cohort_slug)` pair for each of the given user IDs
+        in the split test with the given UUID, in the same order.
+
+        The user IDs are read `chunk_size` at a time and each chunk's
+        assignments are looked up in a single query, so any number of users
+        can be streamed from e.g. `values_list("id", flat=True).iterator()`.
+        The cohort slug is `None` for users without an active cohort, unless
+        `assign` is true, in which case they're assigned to the cohort the
+        middleware would pick for them with a single bulk insert per chunk.
+
+        Only users the middleware would assign are assigned: none while the
+        split test isn't in the snapshot (e.g. before it starts), and only
+        those whose layer bucket selects it if it's in a layer. Split tests
+        with targeting rules, which depend on each request, can't be
+        assigned and raise a ValueError.
+        """
+        is_eligible = self._get_eligibility(split_test_uuid) if assign else None
+        return self._iter_cohort_slugs(user_ids, split_test_uuid, chunk_size, is_eligible)
+
+    def _get_eligibility(self, split_test_uuid):
+        """Return a function of a user ID which returns whether the middleware
+        would assign the user to the split test with the given UUID, or `None`
+        if it wouldn't assign anyone.
+
+        Raise a ValueError if the split test has targeting rules.
+        """
+        SplitTest = self.model._meta.get_field("split_test").related_model
+        snapshot = SplitTest.cache.snapshot()
+        split_test_uuid = str(split_test_uuid)
+        if snapshot.get_split_test(split_test_uuid) is None:
+            return None
+        if split_test_uuid in snapshot.targeting_predicates:
+            raise ValueError(
+                f"Users can't be assigned to split test {split_test_uuid} outside of a request,"
+                " as it has targeting rules."
+            )
+
+        for layer_uuid, bucket_ranges in snapshot.layer_bucket_ranges.items():
+            if split_test_uuid in bucket_ranges[1]:
+                break
+        else:
+            return lambda user_id: True
+
+        def is_eligible(user_id):
+            bucket = get_bucket(layer_uuid, str(user_id))
+            return pick_split_test_uuid(bucket_ranges, bucket) == split_test_uuid
+
+        return is_eligible
+
+    def _iter_cohort_slugs(self, user_ids, split_test_uuid, chunk_size, is_eligible):
+        read_database = self.get_read_database()
+        cohorts = list(
+            self.get_queryset()
+            .using(read_database)
+            .filter(is_active=True, split_test__uuid=split_test_uuid, split_test__is_active=True)
+            .order_by(*COHORT_ASSIGNMENT_ORDERING)
+            .annotate(assignment_weight=ASSIGNMENT_WEIGHT)
+            .only("id", "slug")
+        )
+        cohort_slugs = {cohort.id: cohort.slug for cohort in cohorts}
+        weights = [cohort.assignment_weight for cohort in cohorts]
+        Assignment = self.model._meta.get_field("assignments").related_model
+        # Assignments written within the replica's lag would look missing,
+        # and the users assigned a second time, so read them from the
+        # database they're written to when assigning.
+        if is_eligible is None:
+            assignments_database = read_database
+        else:
+            assignments_database = router.db_for_write(Assignment)
+
+        user_ids = iter(user_ids)
+        while chunk := list(islice(user_ids, chunk_size)):
+            assigned = {}
+            if cohorts:
+                rows = (
+                    Assignment.objects.using(assignments_database)
+                    .filter(user_id__in=chunk, cohort_id__in=cohort_slugs)
+                    .order_by("assigned_at", "id")
+                    .values_list("user_id", "cohort_id")
+                )
+                for user_id, cohort_id in rows:
+                    # Users keep their oldest active cohort, as in
+                    # `get_for_user_and_split_test`.
+                    assigned.setdefault(user_id, cohort_id)
+
+            if is_eligible is not None and cohorts:
+                new_assignments = []
+                for user_id in chunk:
+                    if user_id in assigned or not is_eligible(user_id):
+                        continue
+                    index = pick_weighted(str(split_test_uuid), str(user_id), weights)
+                    if index is not None:
+                        assigned[user_id] = cohorts[index].id
+                        new_assignments.append(
+                            Assignment(cohort_id=cohorts[index].id, user_id=user_id)
+                        )
+                if new_assignments:
+                    Assignment.objects.bulk_create(new_assignments, ignore_conflicts=True)
+                    # `bulk_create` doesn't send `post_save`.
+                    self.invalidate_user_assignments(*(a.user_id for a in new_assignments))
+
+            for user_id in chunk:
+                cohort_id = assigned.get(user_id)
+                yield user_id, None if cohort_id is None else cohort_slugs[cohort_id]
+
     def get_for_user_and_split_test(self, user, split_test_uuid):
         """Return a cohort for the given user and split test UUID.
 
@@ -134,6 +569,7 @@ class CohortManager(Manager):
         if user.is_authenticated:
             cohort = (
                 self.get_queryset()
+                .using(self.get_read_database(user.pk))
                 .filter(
                     is_active=True,
                     users=user,
@@ -150,28 +586,44 @@ class CohortManager(Manager):
         return cohort
 
     def _assign_cohort(self, user, split_test_uuid):
-        """Assign a random active cohort given user and split test UUID.
+        """Assign an active cohort given user and split test UUID.
 
-        If the user is authenticated, update the cohort's user list.
+        If the user is authenticated, the cohort is picked deterministically
+        from their primary key, as the middleware and edge workers do (see
+        `bucketing.pick_weighted`), and the cohort's user list is updated.
+        Otherwise, the cohort is picked at random.
         """
         cohorts = list(
             self.get_queryset()
+            .using(self.get_read_database())
             .filter(is_active=True, split_test__uuid=split_test_uuid, split_test__is_active=True)
-            .order_by("-weight")
+            .order_by(*COHORT_ASSIGNMENT_ORDERING)
+            .annotate(assignment_weight=ASSIGNMENT_WEIGHT)
         )
         if not cohorts:
             return None
 
-        # Make a weighted random choice.
-        weights = [c.weight for c in cohorts]
-        try:
-            cohort = choices(cohorts, weights)[0]
-        except ValueError:
-            # Handle the case where all cohorts have a weight of 0.
-            return None
+        weights = [c.assignment_weight for c in cohorts]
+        if user.is_authenticated:
+            index = pick_weighted(str(split_test_uuid), str(user.pk), weights)
+            if index is None:
+                # Handle the case where all cohorts have a weight of 0.
+                return None
+            cohort = cohorts[index]
+        else:
+            # Make a weighted random choice.
+            try:
+                cohort = choices(cohorts, weights)[0]
+            except ValueError:
+                # Handle the case where all cohorts have a weight of 0.
+                return None
 
         if cohort and user.is_authenticated:
-            # Use get_or_create to avoid an IntegrityError.
-            cohort.assignments.get_or_create(user=user)
+            # Write to the primary database, even if the cohort was read from
+            # a replica. Use get_or_create to avoid an IntegrityError.
+            Assignment = self.model._meta.get_field("assignments").related_model
+            Assignment.objects.db_manager(router.db_for_write(Assignment)).get_or_create(
+                cohort_id=cohort.id, user=user
+            )
 
         return cohort
@@ -1,5 +1,22 @@
+import logging
+import time
+
+from functools import partial
+from random import random
+from uuid import uuid4
+
+from .bucketing import get_excluded_split_test_uuids, pick_weighted
+from .circuit import is_cache_available
 from .config import get_app_settings
+from .exposures import ExposureEvent, ExposureTrackingDict, get_exposure_buffer, is_sampled
 from .models import Cohort, SplitTest
+from .refresh import SnapshotRefresher
+from .sessions import get_session_assignments, set_session_assignments
+from .targeting import TargetingContext, get_untargeted_split_test_uuids
+from .timing import NULL_TIMINGS, Timings, current_timings
+
+
+logger = logging.getLogger(__name__)
 
 
 class SplitTestMiddleware:
@@ -15,77 +32,337 @@ class SplitTestMiddleware:
         self.cookie_prefix = app_settings["COOKIE_PREFIX"]
         self.cookie_samesite = app_settings["COOKIE_SAMESITE"]
         self.cookie_secure = app_settings["COOKIE_SECURE"]
+        self.exposure_session_key = app_settings["EXPOSURE_SESSION_KEY"]
+        self.server_timing = app_settings["SERVER_TIMING"]
+        self.server_timing_log_sample_rate = app_settings["SERVER_TIMING_LOG_SAMPLE_RATE"]
+        self.session_compact = app_settings["SESSION_COMPACT"]
         self.session_key = app_settings["SESSION_KEY"]
+        self.session_state_key = app_settings["SESSION_STATE_KEY"]
+        self.unit_id_cookie_name = app_settings["UNIT_ID_COOKIE_NAME"]
+
+        self.exposures = get_exposure_buffer()
+
+        refresh_interval = app_settings["SNAPSHOT_REFRESH_INTERVAL"]
+        if refresh_interval is not None and SplitTest.cache.refresher is None:
+            SplitTest.cache.refresher = SnapshotRefresher(SplitTest.cache, refresh_interval)
 
         self.get_response = get_response
 
     def __call__(self, request):
-        self.split_test_active_uuids = SplitTest.cache.split_test_active_uuids()
-        self.split_test_uuid_slug_map = SplitTest.cache.split_test_uuid_slug_map()
-        self.cohort_active_uuids = SplitTest.cache.cohort_active_uuids()
-        self.cohort_uuid_slug_map = SplitTest.cache.cohort_uuid_slug_map()
-        self.cohort_uuid_split_test_uuid_map = SplitTest.cache.cohort_uuid_split_test_uuid_map()
+        timings = Timings() if self.server_timing else NULL_TIMINGS
 
-        self.check_cohort_assignments(request)
+        with timings.track():
+            # The middleware is shared by every thread, so the snapshot is
+            # passed to each method rather than kept on it, and the whole
+            # request uses the same one.
+            with timings.measure("snapshot"):
+                snapshot = SplitTest.cache.snapshot()
+
+            if snapshot.split_test_active_uuids:
+                self.check_cohort_assignments(request, snapshot)
+            else:
+                self.clear_cohort_assignments(request, snapshot)
 
         response = self.get_response(request)
 
-        self.update_split_test_cookies(request, response)
+        with timings.track():
+            with timings.measure("set-cookies"):
+                self.update_split_test_cookies(request, response, snapshot)
+
+            if self.exposures is not None:
+                with timings.measure("exposures"):
+                    self.exposures.flush_if_due()
+
+        if timings is not NULL_TIMINGS:
+            self.report_timings(request, response, timings)
 
         return response
 
-    def check_cohort_assignments(self, request):
+    def report_timings(self, request, response, timings):
+        """Add the timings to the response's `Server-Timing` header, and log
+        them for a sample of requests.
+        """
+        header = timings.header()
+        if response.has_header("Server-Timing"):
+            header = f"{response['Server-Timing']}, {header}"
+        response["Server-Timing"] = header
+
+        if random() < self.server_timing_log_sample_rate:
+            logger.info(
+                "Split test middleware timings for %s: %s",
+                request.path,
+                timings.as_dict(),
+                extra={"split_test_timings": timings.as_dict()},
+            )
+
+    def check_cohort_assignments(self, request, snapshot):
         """Check if the current user (authenticated or not) is assigned to an
         active cohort for each active split test and ensure they are set in the
         current session.
         """
-        # Ensure that the split tests session key exists.
-        if self.session_key not in request.session:
-            request.session[self.session_key] = {}
+        timings = current_timings.get()
+
+        with timings.measure("session"):
+            slug_map = self.get_checked_slug_map(request, snapshot)
+        if slug_map is not None:
+            self.set_split_test_slug_map(request, snapshot, slug_map)
+            return
+
+        with timings.measure("session"):
+            assignments = self.get_assignments(request, snapshot)
 
-        self.remove_inactive_split_tests_from_session(request)
+        with timings.measure("layers"):
+            eligible_uuids = self.get_eligible_split_test_uuids(request, snapshot)
 
-        # Ensure that the session has an active cohort set for each active
+        with timings.measure("targeting"):
+            split_test_uuids = self.get_targeted_split_test_uuids(request, snapshot, eligible_uuids)
+
+        with timings.measure("remove-inactive"):
+            self.remove_inactive_split_tests_from_session(request, snapshot, split_test_uuids)
+
+        cohort_active_uuids = snapshot.cohort_active_uuids
+
+        # The authenticated user's assignments, fetched when first needed.
+        user_assignments = None
+        # While the cache is unavailable, authenticated users' assignments
+        # aren't read or made, to keep their queries off the database.
+        skip_user_assignments = request.user.is_authenticated and not is_cache_available()
+
+        # Ensure that the session has an active cohort set for each eligible
         # split test.
-        for split_test_uuid in self.split_test_active_uuids:
+        for split_test_uuid in split_test_uuids:
             # Skip split tests that already have an active cohort assigned.
             if (
-                split_test_uuid in request.session[self.session_key]
-                and request.session[self.session_key][split_test_uuid] in self.cohort_active_uuids
+                split_test_uuid in assignments
+                and assignments[split_test_uuid] in cohort_active_uuids
             ):
                 continue
 
-            cohort_uuid = self.get_cohort_uuid_from_cookie(request, split_test_uuid)
+            with timings.measure("cookies"):
+                cohort_uuid = self.get_cohort_uuid_from_cookie(request, snapshot, split_test_uuid)
+
+            if not cohort_uuid and skip_user_assignments:
+                continue
+
+            # Check the authenticated user's cached assignments before falling
+            # back to the database.
+            if not cohort_uuid and request.user.is_authenticated:
+                with timings.measure("user-assignments"):
+                    if user_assignments is None:
+                        user_assignments = Cohort.objects.get_user_assignments(request.user)
+                    cohort_uuid = self.get_active_cohort_uuid(
+                        snapshot, user_assignments.get(split_test_uuid, ())
+                    )
 
             # Get an active cohort UUID for the user from the current split test. If
             # the user is authenticated, this will check the database for an
-            # active assignment, otherwise it will assign them a new one.
+            # active assignment, otherwise it will assign them a new one from
+            # the snapshot, as an edge worker using the published document
+            # would.
             if not cohort_uuid:
-                cohort = Cohort.objects.get_for_user_and_split_test(request.user, split_test_uuid)
-                if cohort:
-                    cohort_uuid = str(cohort.uuid)
+                with timings.measure("assign"):
+                    if request.user.is_authenticated:
+                        cohort = Cohort.objects.get_for_user_and_split_test(
+                            request.user, split_test_uuid
+                        )
+                        if cohort:
+                            cohort_uuid = str(cohort.uuid)
+                    else:
+                        cohort_uuid = self.pick_cohort_uuid(
+                            snapshot, split_test_uuid, self.get_unit_id(request)
+                        )
 
             # Set the new cohort in the session.
             if cohort_uuid:
-                request.session[self.session_key][split_test_uuid] = cohort_uuid
+                assignments[split_test_uuid] = cohort_uuid
                 request.session.modified = True
 
-        self.update_user_split_test_cohort_slug_map(request)
+        with timings.measure("session"):
+            self.set_assignments(request, snapshot, assignments)
+
+        slug_map = self.update_user_split_test_cohort_slug_map(request, snapshot)
+
+        # Record that the session's assignments are complete for this
+        # snapshot, unless some couldn't be made (e.g. while the cache is
+        # unavailable), along with the split tests the user was only excluded
+        # from by their targeting rules. Compact sessions don't repeat their
+        # assignments as slugs, and decode them again instead.
+        if all(split_test_uuid in assignments for split_test_uuid in split_test_uuids):
+            state = [
+                snapshot.version,
+                self.get_current_unit_id(request),
+                None if self.session_compact else slug_map,
+                sorted(eligible_uuids - split_test_uuids),
+            ]
+            if request.session.get(self.session_state_key) != state:
+                request.session[self.session_state_key] = state
+        elif self.session_state_key in request.session:
+            del request.session[self.session_state_key]
+
+    def get_checked_slug_map(self, request, snapshot):
+        """Return the slug map of the session's assignments if they've already
+        been checked against the current snapshot for the current unit ID, or
+        `None` if they must be checked.
+
+        Targeting rules depend on more than the unit ID (e.g. headers), so the
+        rules of the split tests the user is assigned to, or was only excluded
+        from by its rules, are checked again; the others aren't. Sessions
+        whose assignments aren't in the configured encoding are always
+        checked, to rewrite them.
+        """
+        state = request.session.get(self.session_state_key)
+        if (
+            state is None
+            or len(state) != 4
+            or state[0] != snapshot.version
+            or state[1] != self.get_current_unit_id(request)
+            or isinstance(request.session.get(self.session_key), str) != self.session_compact
+        ):
+            return None
+        if snapshot.targeting_predicates and not self.matches_targeting(
+            request, snapshot, state[3]
+        ):
+            return None
+        if state[2] is None:
+            return self.get_slug_map(snapshot, self.get_assignments(request, snapshot))
+        return state[2]
+
+    def matches_targeting(self, request, snapshot, excluded_uuids):
+        """Return whether the current request still matches the targeting
+        rules of the split tests the session is assigned to, and still doesn't
+        match those of the split tests it was excluded from by their rules.
+        """
+        assignments = self.get_assignments(request, snapshot)
+        context = TargetingContext(request, snapshot.targeting_group_names)
+        for split_test_uuid, predicate in snapshot.targeting_predicates.items():
+            if split_test_uuid in assignments:
+                if not predicate(request, context):
+                    return False
+            elif split_test_uuid in excluded_uuids and predicate(request, context):
+                return False
+        return True
+
+    def get_assignments(self, request, snapshot):
+        """Return the current session's `{split_test_uuid: cohort_uuid}`
+        assignments, in either encoding (see `split_tests.sessions`).
+        """
+        return get_session_assignments(request, self.session_key, snapshot)
+
+    def set_assignments(self, request, snapshot, assignments):
+        """Store the assignments in the current session, in the configured
+        encoding.
+        """
+        set_session_assignments(
+            request, self.session_key, snapshot, assignments, self.session_compact
+        )
+
+    def clear_cohort_assignments(self, request, snapshot):
+        """Remove every assignment from the session, when there are no active
+        split tests, without creating a session if there isn't one.
+        """
+        if request.session.get(self.session_key):
+            request.session[self.session_key] = "" if self.session_compact else {}
+        if self.session_state_key in request.session:
+            del request.session[self.session_state_key]
+        self.set_split_test_slug_map(request, snapshot, {})
+
+    def get_eligible_split_test_uuids(self, request, snapshot):
+        """Return the UUIDs of the active split tests the current user is
+        eligible for.
+
+        Split tests outside of any layer apply to every user. Within each
+        layer, a single hash of the user's unit ID picks at most one split
+        test from the layer's precomputed bucket ranges.
+        """
+        layer_bucket_ranges = snapshot.layer_bucket_ranges
+        if not layer_bucket_ranges:
+            return snapshot.split_test_active_uuids
+
+        excluded_uuids = get_excluded_split_test_uuids(
+            layer_bucket_ranges, self.get_unit_id(request)
+        )
+        return snapshot.split_test_active_uuids - excluded_uuids
+
+    def get_targeted_split_test_uuids(self, request, snapshot, split_test_uuids):
+        """Return the given split test UUIDs, less those whose targeting rules
+        the current request doesn't match.
+
+        The rules were compiled with the snapshot, and any groups they check
+        are read with a single query the first time one is needed.
+        """
+        targeting_predicates = snapshot.targeting_predicates
+        if not targeting_predicates:
+            return split_test_uuids
+
+        excluded_uuids = get_untargeted_split_test_uuids(
+            request, split_test_uuids, targeting_predicates, snapshot.targeting_group_names
+        )
+        return split_test_uuids - excluded_uuids if excluded_uuids else split_test_uuids
+
+    def pick_cohort_uuid(self, snapshot, split_test_uuid, unit_id):
+        """Return the UUID of the active cohort picked for the unit ID in the
+        given split test, or `None` if there isn't one.
+        """
+        cohorts = snapshot.get_cohorts(split_test_uuid)
+        index = pick_weighted(split_test_uuid, unit_id, [cohort.weight for cohort in cohorts])
+        if index is None:
+            return None
+        return cohorts[index].uuid
+
+    def get_current_unit_id(self, request):
+        """Return the ID the current user is bucketed by, or `None` if an
+        anonymous user doesn't have one yet.
+        """
+        if request.user.is_authenticated:
+            return str(request.user.pk)
+        return getattr(request, "split_test_unit_id", None) or request.COOKIES.get(
+            self.unit_id_cookie_name
+        )
+
+    def get_unit_id(self, request):
+        """Return the ID used to bucket the current user into layers and
+        cohorts.
+
+        Authenticated users are bucketed by their primary key so that they see
+        the same split tests on every device. Anonymous users are bucketed by a
+        random ID which is persisted in a cookie.
+        """
+        if request.user.is_authenticated:
+            return str(request.user.pk)
+
+        unit_id = getattr(request, "split_test_unit_id", None) or request.COOKIES.get(
+            self.unit_id_cookie_name
+        )
+        if not unit_id:
+            unit_id = uuid4().hex
+        # Keep track of the ID so that `update_split_test_cookies` can persist
+        # it.
+        request.split_test_unit_id = unit_id
+        return unit_id
+
+    def remove_inactive_split_tests_from_session(self, request, snapshot, split_test_uuids=None):
+        """Remove inactive split test UUIDs from the current session.
+
+        If `split_test_uuids` is given, also remove any split tests that are
+        not in it (e.g. those the user is not eligible for in their layer).
+        """
+        if split_test_uuids is None:
+            split_test_uuids = snapshot.split_test_active_uuids
+
+        assignments = self.get_assignments(request, snapshot)
 
-    def remove_inactive_split_tests_from_session(self, request):
-        """Remove inactive split test UUIDs from the current session."""
         # We need two loops as you can't alter a dict's size whilst iterating
         # over it.
         keys_to_delete = set()
-        for split_test_uuid in request.session[self.session_key].keys():
-            if split_test_uuid not in self.split_test_active_uuids:
+        for split_test_uuid in assignments.keys():
+            if split_test_uuid not in split_test_uuids:
                 keys_to_delete.add(split_test_uuid)
 
         for split_test_uuid in keys_to_delete:
-            del request.session[self.session_key][split_test_uuid]
+            del assignments[split_test_uuid]
             request.session.modified = True
 
-    def get_cohort_uuid_from_cookie(self, request, split_test_uuid):
+    def get_cohort_uuid_from_cookie(self, request, snapshot, split_test_uuid):
         """Return the UUID of the active cohort assigned to the user for the
         given split test UUID.
         """
@@ -94,52 +371,126 @@ class SplitTestMiddleware:
             cohort_uuid = request.COOKIES[cookie_key]
             # Ensure that the cohort is still active and belongs to split test.
             if (
-                cohort_uuid in self.cohort_active_uuids
-                and self.cohort_uuid_split_test_uuid_map.get(cohort_uuid) == split_test_uuid
+                cohort_uuid in snapshot.cohort_active_uuids
+                and snapshot.cohort_uuid_split_test_uuid_map.get(cohort_uuid) == split_test_uuid
             ):
                 return cohort_uuid
         return None
 
-    def update_user_split_test_cohort_slug_map(self, request):
+    def get_active_cohort_uuid(self, snapshot, cohort_uuids):
+        """Return the first of the given cohort UUIDs which is active, or
+        `None`.
+        """
+        cohort_active_uuids = snapshot.cohort_active_uuids
+        for cohort_uuid in cohort_uuids:
+            if cohort_uuid in cohort_active_uuids:
+                return cohort_uuid
+        return None
+
+    def update_user_split_test_cohort_slug_map(self, request, snapshot):
         """Update the current session's user object with a map of split test
         and cohort slugs.
 
         This map allows us to check the user's cohort assignments via their
-        slugs rather than looping the cached object maps.
+        slugs rather than looping the cached object maps. Return the map.
         """
-        slug_map = {}
+        slug_map = self.get_slug_map(snapshot, self.get_assignments(request, snapshot))
+        self.set_split_test_slug_map(request, snapshot, slug_map)
+        return slug_map
 
-        split_tests_assignments = request.session[self.session_key]
-        for split_test_uuid, cohort_uuid in split_tests_assignments.items():
+    def get_slug_map(self, snapshot, assignments):
+        """Return a map of split test slugs to cohort slugs for the
+        assignments' active split tests and cohorts.
+        """
+        split_test_uuid_slug_map = snapshot.split_test_uuid_slug_map
+        cohort_uuid_slug_map = snapshot.cohort_uuid_slug_map
+        slug_map = {}
+        for split_test_uuid, cohort_uuid in assignments.items():
             try:
-                slug_map[self.split_test_uuid_slug_map[split_test_uuid]] = (
-                    self.cohort_uuid_slug_map[cohort_uuid]
-                )
+                split_test_slug = split_test_uuid_slug_map[split_test_uuid]
+                slug_map[split_test_slug] = cohort_uuid_slug_map[cohort_uuid]
             except KeyError:
                 continue
+        return slug_map
+
+    def set_split_test_slug_map(self, request, snapshot, slug_map):
+        """Set the map of split test slugs to cohort slugs on the current
+        session's user object.
+        """
+        if self.exposures is not None:
+            # Log an exposure whenever a view reads a cohort from the map.
+            slug_map = ExposureTrackingDict(slug_map, partial(self.log_exposure, request, snapshot))
+        else:
+            # Views may change their user's map without changing the one
+            # kept in the session.
+            slug_map = dict(slug_map)
 
         request.user.split_test_slug_map = slug_map
 
-    def update_split_test_cookies(self, request, response):
+    def log_exposure(self, request, snapshot, split_test_slug):
+        """Log that the current user has been exposed to their cohort of the
+        split test with the given slug, unless they already have been this
+        session or aren't sampled.
+        """
+        split_test_uuid = snapshot.split_test_slug_uuid_map[split_test_slug]
+        cohort_uuid = self.get_assignments(request, snapshot)[split_test_uuid]
+
+        # The exposures are kept in the same encoding as the assignments.
+        exposed = get_session_assignments(request, self.exposure_session_key, snapshot)
+        if exposed.get(split_test_uuid) == cohort_uuid:
+            return
+        exposed[split_test_uuid] = cohort_uuid
+        request.session.modified = True
+        set_session_assignments(
+            request, self.exposure_session_key, snapshot, exposed, self.session_compact
+        )
+
+        unit_id = self.get_unit_id(request)
+        if not is_sampled(split_test_uuid, split_test_slug, unit_id):
+            return
+        user_id = request.user.pk if request.user.is_authenticated else None
+        self.exposures.add(ExposureEvent(cohort_uuid, user_id, unit_id, time.time()))
+
+    def update_split_test_cookies(self, request, response, snapshot):
         """Set cookies to track the user's cohort assignment for each split
         test.
         """
+        unit_id = getattr(request, "split_test_unit_id", None)
+        if unit_id and request.COOKIES.get(self.unit_id_cookie_name) != unit_id:
+            response.set_cookie(
+                self.unit_id_cookie_name,
+                value=unit_id,
+                max_age=self.cookie_max_age,
+                domain=self.cookie_domain,
+                secure=self.cookie_secure,
+                httponly=self.cookie_httponly,
+                samesite=self.cookie_samesite,
+            )
+
         if self.session_key not in request.session:
             return
 
+        assignments = self.get_assignments(request, snapshot)
+
         # Delete existing cohort cookies to ensure any stale assignments are
         # removed.
         for cookie_key in request.COOKIES:
-            if cookie_key.startswith(self.cookie_prefix):
+            if (
+                cookie_key.startswith(self.cookie_prefix)
+                and cookie_key.removeprefix(self.cookie_prefix) not in assignments
+            ):
                 response.delete_cookie(
                     cookie_key,
                     domain=self.cookie_domain,
                     samesite=self.cookie_samesite,
                 )
 
-        # Set cookies for split test cohort assignments.
-        for split_test, cohort in request.session[self.session_key].items():
+        # Set cookies for split test cohort assignments, unless the request
+        # already has them.
+        for split_test, cohort in assignments.items():
             cookie_key = f"{self.cookie_prefix}{split_test}"
+            if request.COOKIES.get(cookie_key) == str(cohort):
+                continue
             response.set_cookie(
                 cookie_key,
                 value=str(cohort),
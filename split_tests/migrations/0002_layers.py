@@ -0,0 +1,81 @@
+# Generated by Django 6.0.1 on 2026-10-19 07:18
+
+import uuid
+
+import django.core.validators
+import django.db.models.deletion
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("sites", "0002_alter_domain_unique"),
+        ("split_tests", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="splittest",
+            name="layer_allocation",
+            field=models.PositiveSmallIntegerField(
+                default=0,
+                help_text="The percentage of the layer's users who are eligible for this split test. Only used when a layer is selected.",
+                validators=[django.core.validators.MaxValueValidator(100)],
+                verbose_name="layer allocation",
+            ),
+        ),
+        migrations.CreateModel(
+            name="Layer",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("name", models.CharField(max_length=50, verbose_name="name")),
+                ("slug", models.SlugField(verbose_name="slug")),
+                (
+                    "uuid",
+                    models.UUIDField(
+                        db_index=True, default=uuid.uuid4, editable=False, verbose_name="UUID"
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True, verbose_name="created at")),
+                ("modified_at", models.DateTimeField(auto_now=True, verbose_name="modified at")),
+                (
+                    "site",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="split_test_layers",
+                        to="sites.site",
+                        verbose_name="site",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "layer",
+                "verbose_name_plural": "layers",
+            },
+        ),
+        migrations.AddField(
+            model_name="splittest",
+            name="layer",
+            field=models.ForeignKey(
+                blank=True,
+                help_text="Split tests in the same layer are mutually exclusive; each user is eligible for at most one of them.",
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="split_tests",
+                to="split_tests.layer",
+                verbose_name="layer",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="layer",
+            constraint=models.UniqueConstraint(
+                fields=("site", "slug"), name="unique_layer_site_slug"
+            ),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 6.0.1 on 2026-10-19 07:34
+
+import django.db.models.deletion
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("split_tests", "0002_layers"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="cohort",
+            name="split_test",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="cohorts",
+                to="split_tests.splittest",
+                verbose_name="split test",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="assignment",
+            index=models.Index(
+                fields=["user", "cohort", "assigned_at"], name="assignment_user_lookup_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="cohort",
+            index=models.Index(
+                condition=models.Q(("is_active", True)),
+                fields=["split_test", "-weight"],
+                name="cohort_assign_idx",
+            ),
+        ),
+    ]
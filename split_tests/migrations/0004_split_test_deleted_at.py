@@ -0,0 +1,24 @@
+# Generated by Django 6.0.1 on 2026-10-19 07:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("split_tests", "0003_lookup_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="splittest",
+            name="deleted_at",
+            field=models.DateTimeField(
+                blank=True,
+                db_index=True,
+                editable=False,
+                help_text="When the split test was deleted. Deleted split tests are purged, along with their assignments, by the purge_split_tests management command.",
+                null=True,
+                verbose_name="deleted at",
+            ),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 6.0.1 on 2026-10-19 07:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("split_tests", "0004_split_test_deleted_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="splittest",
+            name="ends_at",
+            field=models.DateTimeField(
+                blank=True,
+                help_text="If set, the split test ends at this time.",
+                null=True,
+                verbose_name="ends at",
+            ),
+        ),
+        migrations.AddField(
+            model_name="splittest",
+            name="starts_at",
+            field=models.DateTimeField(
+                blank=True,
+                help_text="If set, the split test only starts at this time. It must also be active.",
+                null=True,
+                verbose_name="starts at",
+            ),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 6.0.1 on 2026-10-19 07:52
+
+import django.db.models.deletion
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("split_tests", "0005_split_test_schedule"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="GoalStatistics",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("goal", models.SlugField(verbose_name="goal")),
+                ("count", models.PositiveBigIntegerField(default=0, verbose_name="count")),
+                ("total", models.FloatField(default=0.0, verbose_name="total")),
+                (
+                    "total_of_squares",
+                    models.FloatField(default=0.0, verbose_name="total of squares"),
+                ),
+                ("modified_at", models.DateTimeField(auto_now=True, verbose_name="modified at")),
+                (
+                    "cohort",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="goal_statistics",
+                        to="split_tests.cohort",
+                        verbose_name="cohort",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "goal statistics",
+                "verbose_name_plural": "goal statistics",
+                "constraints": [
+                    models.UniqueConstraint(fields=("cohort", "goal"), name="unique_cohort_goal")
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 6.0.1 on 2026-10-19 07:53
+
+import django.db.models.deletion
+import django.utils.timezone
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("split_tests", "0006_goal_statistics"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Exposure",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("unit_id", models.CharField(max_length=64, verbose_name="unit ID")),
+                (
+                    "exposed_at",
+                    models.DateTimeField(
+                        default=django.utils.timezone.now, verbose_name="exposed at"
+                    ),
+                ),
+                (
+                    "cohort",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="exposures",
+                        to="split_tests.cohort",
+                        verbose_name="cohort",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="split_test_exposures",
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="user",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "exposure",
+                "verbose_name_plural": "exposures",
+            },
+        ),
+    ]
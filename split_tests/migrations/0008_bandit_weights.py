@@ -0,0 +1,32 @@
+# Generated by Django 6.0.1 on 2026-10-19 08:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("split_tests", "0007_exposures"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="cohort",
+            name="bandit_weight",
+            field=models.PositiveSmallIntegerField(
+                blank=True,
+                editable=False,
+                help_text="The weight computed by the update_bandit_weights management command, used instead of the weight while the split test has a bandit goal.",
+                null=True,
+                verbose_name="bandit weight",
+            ),
+        ),
+        migrations.AddField(
+            model_name="splittest",
+            name="bandit_goal",
+            field=models.SlugField(
+                blank=True,
+                help_text="If set, the cohorts' weights are adapted to their results for this goal by the update_bandit_weights management command, rather than being fixed.",
+                verbose_name="bandit goal",
+            ),
+        ),
+    ]
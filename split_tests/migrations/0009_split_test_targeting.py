@@ -0,0 +1,22 @@
+# Generated by Django 6.0.1 on 2026-10-19 08:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("split_tests", "0008_bandit_weights"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="splittest",
+            name="targeting",
+            field=models.JSONField(
+                blank=True,
+                default=list,
+                help_text='A list of rules, all of which a user must match to be eligible for this split test, e.g. [{"user": "is_staff", "not": true}, {"group": "beta"}]. Leave empty to include everyone.',
+                verbose_name="targeting",
+            ),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 6.0.1 on 2026-10-19 09:02
+
+from django.db import migrations, models
+
+
+def set_layer_bucket_starts(apps, schema_editor):
+    """Store the buckets each layered split test had when they were derived
+    from the allocations of the split tests before it in the layer.
+    """
+    SplitTest = apps.get_model("split_tests", "SplitTest")
+    starts = {}
+    for split_test in SplitTest.objects.filter(layer__isnull=False).order_by("layer_id", "id"):
+        start = starts.get(split_test.layer_id, 0)
+        if split_test.layer_allocation and start < 100:
+            split_test.layer_bucket_start = start
+            split_test.save(update_fields=["layer_bucket_start"])
+        starts[split_test.layer_id] = min(start + split_test.layer_allocation, 100)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("split_tests", "0009_split_test_targeting"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="splittest",
+            name="layer_bucket_start",
+            field=models.PositiveSmallIntegerField(
+                blank=True,
+                editable=False,
+                help_text="The first of the layer's buckets allocated to this split test. It's kept when the other split tests in the layer change, so that their users don't move.",
+                null=True,
+                verbose_name="layer bucket start",
+            ),
+        ),
+        migrations.RunPython(set_layer_bucket_starts, migrations.RunPython.noop),
+    ]
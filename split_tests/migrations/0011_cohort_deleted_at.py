@@ -0,0 +1,24 @@
+# Generated by Django 6.0.1 on 2026-10-19 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("split_tests", "0010_split_test_layer_bucket_start"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="cohort",
+            name="deleted_at",
+            field=models.DateTimeField(
+                blank=True,
+                db_index=True,
+                editable=False,
+                help_text="When the cohort was deleted. Deleted cohorts are purged, along with their assignments, by the purge_split_tests management command.",
+                null=True,
+                verbose_name="deleted at",
+            ),
+        ),
+    ]
@@ -2,12 +2,50 @@ import uuid
 
 from django.conf import settings
 from django.contrib.sites.models import Site
-from django.core.validators import MinValueValidator
+from django.core.exceptions import ValidationError
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from . import help_text
+from .bucketing import LAYER_BUCKETS, find_bucket_start, get_free_buckets
 from .managers import CohortManager, SplitTestCacheManager
+from .targeting import TargetingError, compile_rules
+
+
+class Layer(models.Model):
+    name = models.CharField(_("name"), max_length=50)
+    slug = models.SlugField(_("slug"), max_length=50)
+    uuid = models.UUIDField(_("UUID"), default=uuid.uuid4, db_index=True, editable=False)
+    site = models.ForeignKey(
+        Site,
+        on_delete=models.CASCADE,
+        related_name="split_test_layers",
+        verbose_name=_("site"),
+    )
+
+    created_at = models.DateTimeField(_("created at"), auto_now_add=True)
+    modified_at = models.DateTimeField(_("modified at"), auto_now=True)
+
+    class Meta:
+        verbose_name = _("layer")
+        verbose_name_plural = _("layers")
+
+        constraints = (
+            models.UniqueConstraint(fields=("site", "slug"), name="unique_layer_site_slug"),
+        )
+
+    def __str__(self):
+        return f"{self.name}"
+
+    def __repr__(self):
+        return f"<Layer: id={self.id} name={self.name} slug={self.slug} uuid={self.uuid}>"
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        SplitTest.cache.update()
+        return result
 
 
 class SplitTest(models.Model):
@@ -21,9 +59,51 @@ class SplitTest(models.Model):
         related_name="split_tests",
         verbose_name=_("site"),
     )
+    layer = models.ForeignKey(
+        Layer,
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        related_name="split_tests",
+        verbose_name=_("layer"),
+        help_text=help_text.SPLIT_TEST["layer"],
+    )
+    layer_allocation = models.PositiveSmallIntegerField(
+        _("layer allocation"),
+        default=0,
+        help_text=help_text.SPLIT_TEST["layer_allocation"],
+        validators=[MaxValueValidator(LAYER_BUCKETS)],
+    )
+    layer_bucket_start = models.PositiveSmallIntegerField(
+        _("layer bucket start"),
+        blank=True,
+        null=True,
+        editable=False,
+        help_text=help_text.SPLIT_TEST["layer_bucket_start"],
+    )
+    starts_at = models.DateTimeField(
+        _("starts at"), blank=True, null=True, help_text=help_text.SPLIT_TEST["starts_at"]
+    )
+    ends_at = models.DateTimeField(
+        _("ends at"), blank=True, null=True, help_text=help_text.SPLIT_TEST["ends_at"]
+    )
+    targeting = models.JSONField(
+        _("targeting"), default=list, blank=True, help_text=help_text.SPLIT_TEST["targeting"]
+    )
+    bandit_goal = models.SlugField(
+        _("bandit goal"), max_length=50, blank=True, help_text=help_text.SPLIT_TEST["bandit_goal"]
+    )
 
     created_at = models.DateTimeField(_("created at"), auto_now_add=True)
     modified_at = models.DateTimeField(_("modified at"), auto_now=True)
+    deleted_at = models.DateTimeField(
+        _("deleted at"),
+        blank=True,
+        null=True,
+        db_index=True,
+        editable=False,
+        help_text=help_text.SPLIT_TEST["deleted_at"],
+    )
 
     objects = models.Manager()
     cache = SplitTestCacheManager()
@@ -40,20 +120,110 @@ class SplitTest(models.Model):
     def __repr__(self):
         return f"<SplitTest: id={self.id} name={self.name} slug={self.slug} uuid={self.uuid}>"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # A split test moved to another layer is given buckets there.
+        if "layer_id" in instance.__dict__:
+            instance._loaded_layer_id = instance.layer_id
+        return instance
+
+    def clean(self):
+        if self.starts_at and self.ends_at and self.ends_at <= self.starts_at:
+            raise ValidationError({"ends_at": _("The end must be after the start.")})
+        if self.layer_id is not None:
+            self.clean_layer_allocation()
+        try:
+            compile_rules(self.targeting)
+        except TargetingError as e:
+            raise ValidationError({"targeting": str(e)}) from e
+
+    def clean_layer_allocation(self):
+        """Ensure that a layered split test has some of the layer's buckets,
+        and that they don't overlap those of the other split tests in the
+        layer.
+        """
+        if not self.layer_allocation:
+            raise ValidationError(
+                {"layer_allocation": _("A split test in a layer needs an allocation.")}
+            )
+        ranges = self.get_other_layer_ranges()
+        start = self.get_layer_bucket_start()
+        if start is None:
+            fits = find_bucket_start(ranges, self.layer_allocation) is not None
+        else:
+            fits = get_free_buckets(ranges, start) >= self.layer_allocation
+        if not fits:
+            raise ValidationError(
+                {
+                    "layer_allocation": _("The layer only has %(available)s%% free for this test.")
+                    % {"available": get_free_buckets(ranges, start)}
+                }
+            )
+
+    def get_layer_bucket_start(self):
+        """Return the first of the layer's buckets allocated to the split test,
+        or `None` if it has none in its current layer.
+        """
+        if self.layer_id != getattr(self, "_loaded_layer_id", self.layer_id):
+            return None
+        return self.layer_bucket_start
+
+    def get_other_layer_ranges(self):
+        """Return the `(start, allocation)` of the buckets allocated to the
+        other split tests in the layer.
+        """
+        # Inactive and deleted split tests keep their buckets, so they count
+        # too.
+        return list(
+            SplitTest.objects.filter(layer_id=self.layer_id, layer_bucket_start__isnull=False)
+            .exclude(pk=self.pk)
+            .values_list("layer_bucket_start", "layer_allocation")
+        )
+
     def save(self, *args, **kwargs):
+        if self.layer_id is None or not self.layer_allocation:
+            layer_bucket_start = None
+        else:
+            layer_bucket_start = self.get_layer_bucket_start()
+            if layer_bucket_start is None:
+                layer_bucket_start = find_bucket_start(
+                    self.get_other_layer_ranges(), self.layer_allocation
+                )
+        if layer_bucket_start != self.layer_bucket_start:
+            self.layer_bucket_start = layer_bucket_start
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = {*kwargs["update_fields"], "layer_bucket_start"}
+        # Re-activating a deleted split test cancels its purge.
+        if self.is_active and self.deleted_at is not None:
+            self.deleted_at = None
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = {*kwargs["update_fields"], "deleted_at"}
         super().save(*args, **kwargs)
+        self._loaded_layer_id = self.layer_id
         SplitTest.cache.update()
 
     def delete(self, *args, **kwargs):
-        result = super().delete(*args, **kwargs)
-        SplitTest.cache.update()
-        return result
+        """Deactivate the split test and mark it for purging.
+
+        Deleting a split test cascades to all of its assignments, which can
+        lock the assignments table for a long time. Instead, the
+        `purge_split_tests` command archives and deletes them in small chunks
+        before deleting the split test itself.
+        """
+        self.is_active = False
+        self.deleted_at = timezone.now()
+        self.save(update_fields=["is_active", "deleted_at", "modified_at"])
+        return 0, {}
 
 
 class Cohort(models.Model):
     split_test = models.ForeignKey(
         SplitTest,
         on_delete=models.CASCADE,
+        # The `unique_split_test_slug` and `cohort_assign_idx` indexes both
+        # start with the split test.
+        db_index=False,
         related_name="cohorts",
         verbose_name=_("split test"),
     )
@@ -71,9 +241,24 @@ class Cohort(models.Model):
     weight = models.PositiveSmallIntegerField(
         help_text=help_text.COHORT["weight"], validators=[MinValueValidator(1)]
     )
+    bandit_weight = models.PositiveSmallIntegerField(
+        _("bandit weight"),
+        blank=True,
+        null=True,
+        editable=False,
+        help_text=help_text.COHORT["bandit_weight"],
+    )
 
     created_at = models.DateTimeField(_("created at"), auto_now_add=True)
     modified_at = models.DateTimeField(_("modified at"), auto_now=True)
+    deleted_at = models.DateTimeField(
+        _("deleted at"),
+        blank=True,
+        null=True,
+        db_index=True,
+        editable=False,
+        help_text=help_text.COHORT["deleted_at"],
+    )
 
     objects = CohortManager()
 
@@ -84,6 +269,16 @@ class Cohort(models.Model):
         constraints = (
             models.UniqueConstraint(fields=("split_test", "slug"), name="unique_split_test_slug"),
         )
+        indexes = (
+            # Picking a cohort to assign filters on the split test and
+            # `is_active` and orders by weight. Only active cohorts are ever
+            # assigned, so the index leaves out the rest.
+            models.Index(
+                fields=("split_test", "-weight"),
+                condition=models.Q(is_active=True),
+                name="cohort_assign_idx",
+            ),
+        )
 
     def __str__(self):
         return f"{self.name}"
@@ -92,13 +287,24 @@ class Cohort(models.Model):
         return f"<Cohort: id={self.id} name={self.name} slug={self.slug} uuid={self.uuid}>"
 
     def save(self, *args, **kwargs):
+        # Re-activating a deleted cohort cancels its purge.
+        if self.is_active and self.deleted_at is not None:
+            self.deleted_at = None
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = {*kwargs["update_fields"], "deleted_at"}
         super().save(*args, **kwargs)
         SplitTest.cache.update()
 
     def delete(self, *args, **kwargs):
-        result = super().delete(*args, **kwargs)
-        SplitTest.cache.update()
-        return result
+        """Deactivate the cohort and mark it for purging.
+
+        As with split tests, the `purge_split_tests` command deletes its
+        assignments in small chunks before deleting the cohort itself.
+        """
+        self.is_active = False
+        self.deleted_at = timezone.now()
+        self.save(update_fields=["is_active", "deleted_at", "modified_at"])
+        return 0, {}
 
 
 class Assignment(models.Model):
@@ -123,9 +329,82 @@ class Assignment(models.Model):
         constraints = (
             models.UniqueConstraint(fields=("cohort", "user"), name="unique_cohort_user"),
         )
+        indexes = (
+            # Looking up a user's cohorts filters on the user and orders by
+            # `assigned_at`, without visiting the table.
+            models.Index(
+                fields=("user", "cohort", "assigned_at"), name="assignment_user_lookup_idx"
+            ),
+        )
 
     def __str__(self):
         return f"{self.cohort} - {self.user}"
 
     def __repr__(self):
         return f"<Assignment: id={self.id} cohort={self.cohort} user={self.user} assigned_at={self.assigned_at}>"
+
+
+class Exposure(models.Model):
+    """A record of a user seeing the cohort they're assigned to, logged in
+    batches (see `split_tests.exposures`).
+    """
+
+    cohort = models.ForeignKey(
+        Cohort,
+        on_delete=models.CASCADE,
+        related_name="exposures",
+        verbose_name=_("cohort"),
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        blank=True,
+        null=True,
+        related_name="split_test_exposures",
+        verbose_name=_("user"),
+    )
+    unit_id = models.CharField(_("unit ID"), max_length=64)
+    exposed_at = models.DateTimeField(_("exposed at"), default=timezone.now)
+
+    class Meta:
+        verbose_name = _("exposure")
+        verbose_name_plural = _("exposures")
+
+    def __str__(self):
+        return f"{self.cohort} - {self.unit_id}"
+
+    def __repr__(self):
+        return f"<Exposure: id={self.id} cohort={self.cohort} unit_id={self.unit_id} exposed_at={self.exposed_at}>"
+
+
+class GoalStatistics(models.Model):
+    """Running totals of the values recorded for a cohort's goal, from which
+    the split test's results are computed (see `split_tests.results`).
+    """
+
+    cohort = models.ForeignKey(
+        Cohort,
+        on_delete=models.CASCADE,
+        related_name="goal_statistics",
+        verbose_name=_("cohort"),
+    )
+    goal = models.SlugField(_("goal"), max_length=50)
+    count = models.PositiveBigIntegerField(_("count"), default=0)
+    total = models.FloatField(_("total"), default=0.0)
+    total_of_squares = models.FloatField(_("total of squares"), default=0.0)
+
+    modified_at = models.DateTimeField(_("modified at"), auto_now=True)
+
+    class Meta:
+        verbose_name = _("goal statistics")
+        verbose_name_plural = _("goal statistics")
+
+        constraints = (
+            models.UniqueConstraint(fields=("cohort", "goal"), name="unique_cohort_goal"),
+        )
+
+    def __str__(self):
+        return f"{self.cohort} - {self.goal}"
+
+    def __repr__(self):
+        return f"<GoalStatistics: id={self.id} cohort={self.cohort} goal={self.goal} count={self.count}>"
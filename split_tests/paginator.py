@@ -0,0 +1,39 @@
+import json
+
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+
+class EstimatedCountPaginator(Paginator):
+    """A paginator for very large tables which avoids counting every row.
+
+    Up to `exact_count_limit` rows are counted exactly, with a `LIMIT` so the
+    cost is bounded. Beyond that, PostgreSQL's query planner estimates the
+    number of rows. Other databases don't give a usable estimate, so the count
+    is capped at `exact_count_limit` and narrowing the list with filters is
+    required to see further.
+    """
+
+    exact_count_limit = 10_000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list.order_by()
+        count = queryset[: self.exact_count_limit + 1].count()
+        if count <= self.exact_count_limit:
+            return count
+        estimate = estimate_count(queryset)
+        if estimate is None:
+            return self.exact_count_limit
+        return max(estimate, count)
+
+
+def estimate_count(queryset):
+    """Return the query planner's estimate of the number of rows in the
+    queryset, or `None` if the database doesn't provide one.
+    """
+    if connections[queryset.db].vendor != "postgresql":
+        return None
+    plan = json.loads(queryset.explain(format="json"))
+    return int(plan[0]["Plan"]["Plan Rows"])
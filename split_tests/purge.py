@@ -0,0 +1,185 @@
+import csv
+import gzip
+import time
+
+from pathlib import Path
+
+from django.db import connections, router, transaction
+
+from .models import Assignment, Cohort, Exposure, GoalStatistics, SplitTest
+
+
+ARCHIVE_FIELDS = ("id", "split_test_uuid", "cohort_uuid", "user_id", "assigned_at")
+
+
+def get_archive_path(archive_dir, split_test, cohort=None):
+    """Return the path of the file the split test's assignments, or those of
+    one of its cohorts, are archived to.
+    """
+    if cohort is None:
+        return Path(archive_dir) / f"{split_test.slug}-{split_test.uuid}.csv.gz"
+    return Path(archive_dir) / f"{split_test.slug}-{cohort.slug}-{cohort.uuid}.csv.gz"
+
+
+def get_last_archived_id(archive_path):
+    """Return the largest assignment ID in the archive, or 0 if it's empty.
+
+    An interrupted write can leave a truncated row or gzip member at the end,
+    which is ignored.
+    """
+    last_id = 0
+    try:
+        with gzip.open(archive_path, "rt", newline="") as archive:
+            for row in csv.DictReader(archive):
+                last_id = max(last_id, int(row["id"]))
+    except (EOFError, gzip.BadGzipFile, ValueError):
+        pass
+    return last_id
+
+
+def delete_rows(model, pks, using):
+    """Delete the model's rows with the given primary keys with a single query,
+    without collecting related objects or sending `post_delete` for each.
+    """
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    placeholders = ", ".join(["%s"] * len(pks))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {quote_name(model._meta.db_table)}"
+            f" WHERE {quote_name(model._meta.pk.column)} IN ({placeholders})",
+            pks,
+        )
+
+
+def purge_assignments(split_test, archive_dir=None, chunk_size=1_000, delay=0.0, cohort=None):
+    """Archive and delete the split test's assignments, or only those of one
+    of its cohorts, and return the number deleted.
+
+    Assignments are deleted in chunks of `chunk_size` by primary key, each in
+    its own transaction and followed by a pause of `delay` seconds, so that
+    other queries aren't blocked for long. If `archive_dir` is given, each
+    chunk is first appended to a gzipped CSV file in it. Assignments which
+    are already in the archive, because an interrupted purge archived them
+    without deleting them, aren't archived again, so the purge can safely be
+    run again.
+
+    Each chunk is deleted with a single query, without sending `post_delete`
+    for each assignment, and its users' cached assignments are invalidated
+    together afterwards.
+    """
+    using = router.db_for_write(Assignment)
+    queryset = Assignment.objects.using(using).filter(cohort__split_test=split_test)
+    if cohort is not None:
+        queryset = queryset.filter(cohort=cohort)
+    queryset = queryset.order_by("pk")
+    archive = None
+    last_archived_id = 0
+    if archive_dir is not None:
+        # Appending adds a new gzip member, which readers handle transparently.
+        archive_path = get_archive_path(archive_dir, split_test, cohort)
+        is_new = not archive_path.exists()
+        if not is_new:
+            last_archived_id = get_last_archived_id(archive_path)
+        archive = gzip.open(archive_path, "at", newline="")
+        writer = csv.writer(archive)
+        if is_new:
+            writer.writerow(ARCHIVE_FIELDS)
+
+    deleted = 0
+    last_pk = 0
+    try:
+        while True:
+            rows = list(
+                queryset.filter(pk__gt=last_pk).values_list(
+                    "pk", "cohort__uuid", "user_id", "assigned_at"
+                )[:chunk_size]
+            )
+            if not rows:
+                break
+
+            if archive is not None:
+                writer.writerows(
+                    (pk, split_test.uuid, cohort_uuid, user_id, assigned_at.isoformat())
+                    for pk, cohort_uuid, user_id, assigned_at in rows
+                    if pk > last_archived_id
+                )
+                archive.flush()
+
+            pks = [row[0] for row in rows]
+            with transaction.atomic(using=using):
+                delete_rows(Assignment, pks, using)
+            Cohort.objects.invalidate_user_assignments(*{row[2] for row in rows})
+            deleted += len(pks)
+            last_pk = pks[-1]
+
+            if delay:
+                time.sleep(delay)
+    finally:
+        if archive is not None:
+            archive.close()
+
+    return deleted
+
+
+def purge_rows(queryset, chunk_size=1_000, delay=0.0):
+    """Delete the queryset's rows in chunks of `chunk_size` by primary key,
+    each in its own transaction and followed by a pause of `delay` seconds,
+    and return the number deleted.
+    """
+    model = queryset.model
+    using = router.db_for_write(model)
+    queryset = queryset.using(using).order_by("pk").values_list("pk", flat=True)
+
+    deleted = 0
+    last_pk = 0
+    while True:
+        pks = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+        if not pks:
+            break
+
+        with transaction.atomic(using=using):
+            delete_rows(model, pks, using)
+        deleted += len(pks)
+        last_pk = pks[-1]
+
+        if delay:
+            time.sleep(delay)
+
+    return deleted
+
+
+def purge_split_test(split_test, archive_dir=None, chunk_size=1_000, delay=0.0):
+    """Archive and delete the split test's assignments, delete its cohorts'
+    exposures and goal statistics, then delete the split test and its
+    cohorts. Return the number of assignments deleted.
+
+    The split test is only deleted if it's still marked for purging, and
+    not re-activated in the meantime.
+    """
+    deleted = purge_assignments(split_test, archive_dir, chunk_size, delay)
+    for model in (Exposure, GoalStatistics):
+        purge_rows(model.objects.filter(cohort__split_test=split_test), chunk_size, delay)
+    # Use the queryset to actually delete the split test rather than marking
+    # it for purging again.
+    SplitTest.objects.filter(pk=split_test.pk, is_active=False, deleted_at__isnull=False).delete()
+    SplitTest.cache.update()
+    return deleted
+
+
+def purge_cohort(cohort, archive_dir=None, chunk_size=1_000, delay=0.0):
+    """Archive and delete the cohort's assignments, delete its exposures and
+    goal statistics, then delete the cohort. Return the number of assignments
+    deleted.
+
+    The cohort is only deleted if it's still marked for purging, and not
+    re-activated in the meantime.
+    """
+    deleted = purge_assignments(cohort.split_test, archive_dir, chunk_size, delay, cohort=cohort)
+    for model in (Exposure, GoalStatistics):
+        purge_rows(model.objects.filter(cohort=cohort), chunk_size, delay)
+    # Use the queryset to actually delete the cohort rather than marking it
+    # for purging again.
+    Cohort.objects.filter(pk=cohort.pk, is_active=False, deleted_at__isnull=False).delete()
+    SplitTest.cache.update()
+    return deleted
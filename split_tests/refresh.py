@@ -0,0 +1,77 @@
+import logging
+import threading
+import time
+
+from .threads import BackgroundThread, closing_old_connections
+
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotRefresher:
+    """Rebuild a `SplitTestCacheManager`'s snapshot in the background, so that
+    requests never wait for the rebuild queries.
+
+    The snapshot is rebuilt every `interval` seconds, as soon as its
+    scheduled expiry is reached, and whenever `wake` is called (e.g. by a
+    request which found the stored snapshot missing). While the refresher is
+    running in a process, the manager keeps serving its last snapshot rather
+    than rebuilding it on a request thread.
+    """
+
+    def __init__(self, manager, interval=60.0):
+        self.manager = manager
+        self.interval = interval
+
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = BackgroundThread(
+            self.run, "split-tests-snapshot-refresher", on_start=self._stopping.clear
+        )
+
+    def ensure_started(self):
+        """Start the background thread if it isn't running in this process."""
+        self._thread.ensure_started()
+
+    def is_running(self):
+        """Return whether the background thread is running in this process."""
+        return self._thread.is_running()
+
+    def wake(self):
+        """Rebuild the snapshot now."""
+        self._wake.set()
+
+    def stop(self):
+        """Stop the refresher after its current rebuild."""
+        self._stopping.set()
+        self._wake.set()
+
+    def run(self):
+        """Rebuild the snapshot until stopped, e.g. from a management command."""
+        while not self._stopping.is_set():
+            self._wake.clear()
+            snapshot = self.refresh()
+            self._wake.wait(self.get_delay(snapshot))
+
+    def refresh(self):
+        """Rebuild and store the snapshot, and return it or `None` if the
+        rebuild failed.
+        """
+        with closing_old_connections():
+            try:
+                # Build from the primary database: a replica which lags behind
+                # it could replace a snapshot stored after a save with an
+                # older one.
+                return self.manager.update()
+            except Exception:
+                logger.exception("Failed to refresh the split test snapshot.")
+                return None
+
+    def get_delay(self, snapshot):
+        """Return the number of seconds to wait before rebuilding the
+        snapshot again.
+        """
+        delay = self.interval
+        if snapshot is not None and snapshot.expires_at is not None:
+            delay = min(delay, max(snapshot.expires_at - time.time(), 0.0))
+        return delay
@@ -0,0 +1,159 @@
+"""Split test results, computed from running totals rather than raw events.
+
+Each cohort keeps a `GoalStatistics` row per goal holding the count, sum and
+sum of squares of the values recorded for it (e.g. `1.0` for a conversion or
+an order's value), so a split test's results only read one row per cohort.
+Each cohort is compared with the control cohort with a two-sided z-test on
+the difference of their means.
+"""
+
+import math
+
+from collections import defaultdict
+from statistics import NormalDist
+from typing import NamedTuple
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import F
+
+from .managers import COHORT_ASSIGNMENT_ORDERING
+from .models import Cohort, GoalStatistics
+
+
+class CohortResult(NamedTuple):
+    slug: str
+    count: int
+    mean: float
+    std: float
+    # The difference between the cohort's mean and the control's, and its
+    # confidence interval.
+    difference: float
+    lower: float
+    upper: float
+    z: float
+    p_value: float
+    # The |z| needed to stop the split test at its current sample size.
+    boundary: float
+    is_significant: bool
+
+
+def record_values(values):
+    """Add an iterable of `(cohort_id, goal, value)` tuples to the running
+    totals of each cohort's goal.
+
+    The values are summed in memory first, so a batch of any size costs one
+    insert plus one update per cohort and goal.
+    """
+    totals = defaultdict(lambda: [0, 0.0, 0.0])
+    for cohort_id, goal, value in values:
+        key_totals = totals[cohort_id, goal]
+        key_totals[0] += 1
+        key_totals[1] += value
+        key_totals[2] += value * value
+    if not totals:
+        return
+
+    with transaction.atomic():
+        GoalStatistics.objects.bulk_create(
+            [GoalStatistics(cohort_id=cohort_id, goal=goal) for cohort_id, goal in totals],
+            ignore_conflicts=True,
+        )
+        for (cohort_id, goal), (count, total, total_of_squares) in totals.items():
+            # Increment the totals in the database, so concurrent batches
+            # don't overwrite each other.
+            GoalStatistics.objects.filter(cohort_id=cohort_id, goal=goal).update(
+                count=F("count") + count,
+                total=F("total") + total,
+                total_of_squares=F("total_of_squares") + total_of_squares,
+            )
+
+
+def get_totals(cohort_ids, goal):
+    """Return a `(count, total, total_of_squares)` tuple of the goal's running
+    totals for each of the cohorts with the given IDs, in the same order.
+    """
+    rows = {
+        cohort_id: (count, total, total_of_squares)
+        for cohort_id, count, total, total_of_squares in GoalStatistics.objects.filter(
+            cohort_id__in=cohort_ids, goal=goal
+        ).values_list("cohort_id", "count", "total", "total_of_squares")
+    }
+    return [rows.get(cohort_id, (0, 0.0, 0.0)) for cohort_id in cohort_ids]
+
+
+def get_results(split_test, goal, control="control", alpha=0.05, planned_count=None):
+    """Return a `CohortResult` for each of the split test's cohorts for the
+    given goal, compared with the cohort with the slug `control`.
+
+    If `planned_count` (the total number of values the split test is planned
+    to run for) is given, the significance boundaries are O'Brien-Fleming
+    boundaries for the fraction collected so far, so the results can be
+    checked repeatedly without inflating the false positive rate. Otherwise
+    they're those of a single test at the `alpha` significance level.
+    """
+    np = _import_numpy()
+
+    cohorts = list(
+        Cohort.objects.filter(split_test=split_test)
+        .order_by(*COHORT_ASSIGNMENT_ORDERING)
+        .values_list("id", "slug")
+    )
+    slugs = [slug for _, slug in cohorts]
+    if control not in slugs:
+        raise ValueError(f"The split test has no {control!r} cohort.")
+
+    totals = np.array(get_totals([cohort_id for cohort_id, _ in cohorts], goal), float)
+    count, total, total_of_squares = totals.T
+    control_index = slugs.index(control)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = total / count
+        # The unbiased sample variance, clipped to hide rounding errors.
+        variance = np.maximum(total_of_squares - count * mean**2, 0.0) / (count - 1)
+        std_error = np.sqrt(variance / count + variance[control_index] / count[control_index])
+        difference = mean - mean[control_index]
+        z = difference / std_error
+
+    normal = NormalDist()
+    critical_z = normal.inv_cdf(1 - alpha / 2)
+    if planned_count:
+        information = min(count.sum() / planned_count, 1.0)
+        boundary = critical_z / math.sqrt(information) if information else math.inf
+    else:
+        boundary = critical_z
+
+    p_value = _erfc(np, np.abs(z) / math.sqrt(2))
+    margin = critical_z * std_error
+    return [
+        CohortResult(*values)
+        for values in zip(
+            slugs,
+            count.astype(int).tolist(),
+            mean.tolist(),
+            np.sqrt(variance).tolist(),
+            difference.tolist(),
+            (difference - margin).tolist(),
+            (difference + margin).tolist(),
+            z.tolist(),
+            p_value.tolist(),
+            [boundary] * len(slugs),
+            (np.abs(z) >= boundary).tolist(),
+        )
+    ]
+
+
+def _erfc(np, x):
+    # NumPy doesn't provide the complementary error function, but the
+    # arrays only hold one value per cohort.
+    return np.vectorize(math.erfc, otypes=[float])(x)
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError as e:
+        raise ImproperlyConfigured(
+            "Split test results and bandit weights require the numpy package to be installed."
+        ) from e
+    return numpy
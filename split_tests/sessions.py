@@ -0,0 +1,78 @@
+"""The encodings of the `{split_test_uuid: cohort_uuid}` assignments the
+middleware keeps in sessions.
+
+By default the assignments are stored as a dict of UUIDs, which takes 70 or
+more characters per split test. With `SESSION_COMPACT`, they are stored as a
+single string of the cohorts' short IDs (see
+`Snapshot.get_cohort_short_id`), which are checked against the snapshot when
+the string is decoded: the split test of each cohort is taken from the
+snapshot, and cohorts which are no longer active are dropped.
+
+A cohort's short ID is only dropped while it is ambiguous, i.e. if a cohort
+created later has a UUID starting with the same 8 characters and belongs to
+the same split test, or to one whose UUID starts with the same 4 characters.
+That is very unlikely, but short IDs aren't guaranteed to stay valid.
+
+Either encoding is read regardless of the setting, and sessions are rewritten
+in the configured one the next time their assignments are checked, so the
+setting can be changed at any time.
+"""
+
+# Separates the cohorts' short IDs, and can't be part of a UUID.
+SEPARATOR = "."
+
+
+def encode_assignments(assignments, snapshot):
+    """Return the assignments as a compact string of cohort short IDs."""
+    return SEPARATOR.join(
+        snapshot.get_cohort_short_id(cohort_uuid) for cohort_uuid in assignments.values()
+    )
+
+
+def decode_assignments(value, snapshot):
+    """Return the `{split_test_uuid: cohort_uuid}` assignments of the active
+    cohorts in a compact string.
+    """
+    assignments = {}
+    if not value:
+        return assignments
+    for short_id in value.split(SEPARATOR):
+        cohort = snapshot.get_cohort_by_short_id(short_id)
+        if cohort is not None:
+            assignments[snapshot.split_tests[cohort.split_test].uuid] = cohort.uuid
+    return assignments
+
+
+def get_session_assignments(request, session_key, snapshot):
+    """Return the assignments stored under the session key, in either
+    encoding.
+
+    Assignments stored as a dict are returned as is, to be changed in place.
+    Compact ones are decoded once per request, and changes to them must be
+    stored with `set_session_assignments`.
+    """
+    value = request.session.get(session_key)
+    if isinstance(value, dict):
+        return value
+
+    decoded = request.__dict__.setdefault("_split_test_decoded_sessions", {})
+    cached = decoded.get(session_key)
+    if cached is None or cached[0] != value:
+        cached = decoded[session_key] = (value, decode_assignments(value, snapshot))
+    return cached[1]
+
+
+def set_session_assignments(request, session_key, snapshot, assignments, compact):
+    """Store the assignments under the session key, as a compact string if
+    `compact` or as a dict otherwise, unless the session already has them.
+    """
+    if compact:
+        value = encode_assignments(assignments, snapshot)
+        decoded = request.__dict__.setdefault("_split_test_decoded_sessions", {})
+        decoded[session_key] = (value, assignments)
+    else:
+        value = assignments
+
+    stored = request.session.get(session_key)
+    if stored is not value and stored != value:
+        request.session[session_key] = value
@@ -0,0 +1,96 @@
+from .bucketing import get_excluded_split_test_uuids
+from .config import get_app_settings
+from .models import Assignment, Cohort, SplitTest
+from .sessions import get_session_assignments
+from .targeting import get_untargeted_split_test_uuids
+
+
+def persist_assignments_on_login(sender, request, user, **kwargs):
+    """Persist the cohorts a user was assigned to whilst anonymous when they
+    log in, so that they stay in them in later sessions.
+
+    The assignments are read from the session, falling back to the cohort
+    cookies, and are written with a single bulk insert. Split tests the user
+    already has an assignment for, or isn't eligible for now that they're
+    bucketed by their primary key, are left alone.
+    """
+    if request is None or not hasattr(request, "session"):
+        return
+
+    cohort_uuids = get_assigned_cohort_uuids(request)
+    if not cohort_uuids:
+        return
+
+    # `login` has already set the user, but the targeting rules must check the
+    # user who logged in whoever sends the signal.
+    request.user = user
+    snapshot = SplitTest.cache.snapshot()
+    eligible_uuids = get_eligible_split_test_uuids(request, snapshot)
+    cohort_uuids = [
+        cohort_uuid
+        for cohort_uuid in cohort_uuids
+        if snapshot.split_tests[snapshot.get_cohort(cohort_uuid).split_test].uuid in eligible_uuids
+    ]
+    if not cohort_uuids:
+        return
+
+    cohort_ids = (
+        Cohort.objects.filter(uuid__in=cohort_uuids)
+        .exclude(split_test__cohorts__users=user)
+        .values_list("id", flat=True)
+    )
+    Assignment.objects.bulk_create(
+        [Assignment(cohort_id=cohort_id, user=user) for cohort_id in cohort_ids],
+        ignore_conflicts=True,
+    )
+    # `bulk_create` doesn't send `post_save`.
+    Cohort.objects.invalidate_user_assignments(user.pk)
+
+
+def invalidate_user_assignments(sender, instance, **kwargs):
+    """Remove the cached assignments of the user whose assignment changed."""
+    Cohort.objects.invalidate_user_assignments(instance.user_id)
+
+
+def get_eligible_split_test_uuids(request, snapshot):
+    """Return the UUIDs of the active split tests the authenticated user is
+    eligible for, by their layers and targeting rules, as the middleware will
+    check them on their next request.
+    """
+    split_test_uuids = snapshot.split_test_active_uuids
+    if snapshot.layer_bucket_ranges:
+        split_test_uuids = split_test_uuids - get_excluded_split_test_uuids(
+            snapshot.layer_bucket_ranges, str(request.user.pk)
+        )
+    if snapshot.targeting_predicates:
+        split_test_uuids = split_test_uuids - get_untargeted_split_test_uuids(
+            request,
+            split_test_uuids,
+            snapshot.targeting_predicates,
+            snapshot.targeting_group_names,
+        )
+    return split_test_uuids
+
+
+def get_assigned_cohort_uuids(request):
+    """Return the UUIDs of the active cohorts assigned to the current user by
+    their session and cohort cookies, at most one per split test.
+    """
+    app_settings = get_app_settings()
+    cookie_prefix = app_settings["COOKIE_PREFIX"]
+
+    assignments = {
+        cookie_key.removeprefix(cookie_prefix): cohort_uuid
+        for cookie_key, cohort_uuid in request.COOKIES.items()
+        if cookie_key.startswith(cookie_prefix)
+    }
+    snapshot = SplitTest.cache.snapshot()
+    assignments.update(get_session_assignments(request, app_settings["SESSION_KEY"], snapshot))
+
+    cohort_uuids = []
+    for split_test_uuid, cohort_uuid in assignments.items():
+        cohort = snapshot.get_cohort(cohort_uuid)
+        # Ensure that the cohort is still active and belongs to split test.
+        if cohort and snapshot.split_tests[cohort.split_test].uuid == split_test_uuid:
+            cohort_uuids.append(cohort_uuid)
+    return cohort_uuids
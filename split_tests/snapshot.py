@@ -0,0 +1,435 @@
+import json
+import logging
+
+from collections.abc import Mapping
+from dataclasses import dataclass, field
+from functools import partial
+from hashlib import blake2b
+from itertools import accumulate, chain, repeat
+from operator import itemgetter
+from typing import NamedTuple
+
+from .targeting import Predicate, compile_rules
+
+
+logger = logging.getLogger(__name__)
+
+
+# Records are named tuples rather than frozen dataclasses: they are just as
+# immutable and compact (`__slots__ = ()`), but far quicker to create, which
+# matters as every snapshot load creates one per split test and cohort.
+class SplitTestRecord(NamedTuple):
+    uuid: str
+    slug: str
+    # The indexes of the split test's cohorts in `Snapshot.cohorts`.
+    cohorts: range
+
+
+class CohortRecord(NamedTuple):
+    uuid: str
+    slug: str
+    # The index of the cohort's split test in `Snapshot.split_tests`.
+    split_test: int
+    weight: int
+
+
+class LayerRecord(NamedTuple):
+    uuid: str
+    upper_bounds: tuple[int, ...]
+    # The UUID of the split test which owns each range, or `None`.
+    split_test_uuids: tuple[str | None, ...]
+
+
+# The predicate of split tests whose targeting rules can't be compiled (e.g.
+# written by a newer version of the app), which matches no one.
+_never = Predicate(lambda request, context: False)
+
+# The size, in bytes, of the digest used as a snapshot's version.
+VERSION_SIZE = 8
+
+# The numbers of leading characters of a cohort's UUID and of its split
+# test's UUID which identify it in compact session assignments (see
+# `split_tests.sessions`).
+COHORT_SHORT_ID_LENGTH = 8
+SPLIT_TEST_SHORT_ID_LENGTH = 4
+
+# Create records from an iterable of values without a Python-level `__new__`
+# call for each one.
+new_split_test_record = partial(tuple.__new__, SplitTestRecord)
+new_cohort_record = partial(tuple.__new__, CohortRecord)
+
+
+class RecordMap(Mapping):
+    """A read-only mapping of UUIDs to a value taken from each record."""
+
+    __slots__ = ("_records", "_value")
+
+    def __init__(self, records, value):
+        self._records = records
+        self._value = value
+
+    def __getitem__(self, key):
+        return self._value(self._records[key])
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({dict(self)!r})"
+
+
+@dataclass(frozen=True, slots=True)
+class Snapshot:
+    """An immutable snapshot of the active split tests, cohorts and layers.
+
+    Records reference each other by their integer index and repeated slugs
+    are interned, so a snapshot holds a single copy of each string and is safe
+    to share between threads. Only the rows returned by `to_rows` are pickled;
+    the UUID lookups are rebuilt when a snapshot is loaded.
+    """
+
+    split_tests: tuple[SplitTestRecord, ...] = ()
+    cohorts: tuple[CohortRecord, ...] = ()
+    layers: tuple[LayerRecord, ...] = ()
+    # The `(split_test_uuid, rules)` of the split tests with targeting rules,
+    # as canonical JSON (see `targeting.dumps`).
+    targeting: tuple[tuple[str, str], ...] = ()
+    # A digest of the snapshot's contents, so equal snapshots built by
+    # different processes share a version. Computed if not given.
+    version: str = field(default=None, compare=False)
+    # The POSIX timestamp of the next scheduled start or end of a split test,
+    # when the snapshot must be rebuilt, or `None` if there isn't one.
+    expires_at: float = field(default=None, compare=False)
+
+    _split_tests_by_uuid: dict = field(init=False, repr=False, compare=False)
+    _split_test_uuids_by_slug: dict = field(init=False, repr=False, compare=False)
+    _cohorts_by_uuid: dict = field(init=False, repr=False, compare=False)
+    _layers_by_uuid: dict = field(init=False, repr=False, compare=False)
+    _targeting_predicates: dict = field(init=False, repr=False, compare=False)
+    _targeting_group_names: frozenset = field(init=False, repr=False, compare=False)
+    # Built on first use, as only compact sessions need it.
+    _cohort_uuids_by_short_id: dict = field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self.version is None:
+            digest = blake2b(
+                repr((self.to_rows(), self.expires_at)).encode(), digest_size=VERSION_SIZE
+            )
+            object.__setattr__(self, "version", digest.hexdigest())
+        object.__setattr__(self, "_split_tests_by_uuid", {r.uuid: r for r in self.split_tests})
+        object.__setattr__(
+            self, "_split_test_uuids_by_slug", {r.slug: r.uuid for r in self.split_tests}
+        )
+        object.__setattr__(self, "_cohorts_by_uuid", {r.uuid: r for r in self.cohorts})
+        object.__setattr__(self, "_layers_by_uuid", {r.uuid: r for r in self.layers})
+        # Compile the targeting rules once per snapshot rather than on every
+        # request.
+        predicates = {}
+        for uuid, rules in self.targeting:
+            try:
+                predicates[uuid] = compile_rules(json.loads(rules))
+            except ValueError:
+                logger.exception("Invalid targeting rules for split test %s.", uuid)
+                predicates[uuid] = _never
+        object.__setattr__(self, "_targeting_predicates", predicates)
+        object.__setattr__(
+            self,
+            "_targeting_group_names",
+            frozenset().union(*(p.groups for p in predicates.values())),
+        )
+
+    def __reduce__(self):
+        return (
+            partial(self.__class__.from_rows, version=self.version, expires_at=self.expires_at),
+            self.to_rows(),
+        )
+
+    @classmethod
+    def from_rows(
+        cls,
+        split_test_rows=(),
+        cohort_rows=(),
+        layer_rows=(),
+        targeting_rows=(),
+        version=None,
+        expires_at=None,
+    ):
+        """Return a snapshot built from plain tuples.
+
+        - `split_test_rows`: `(uuid, slug)`
+        - `cohort_rows`: `(uuid, slug, split_test_index, weight)`
+        - `layer_rows`: `(uuid, upper_bounds, split_test_indexes)`, where a
+          split test index of `None` marks a range with no active split test.
+        - `targeting_rows`: `(split_test_index, rules)`, where `rules` is
+          canonical JSON.
+        """
+        split_test_uuids = []
+        split_test_slugs = []
+        for uuid, slug in split_test_rows:
+            split_test_uuids.append(uuid)
+            split_test_slugs.append(slug)
+
+        # Group the cohorts by split test so that each split test's cohorts
+        # are a contiguous range.
+        cohort_counts = [0] * len(split_test_uuids)
+        cohort_uuids = []
+        cohort_slugs = []
+        cohort_weights = []
+        for uuid, slug, split_test_index, weight in sorted(cohort_rows, key=itemgetter(2)):
+            cohort_counts[split_test_index] += 1
+            cohort_uuids.append(uuid)
+            cohort_slugs.append(slug)
+            cohort_weights.append(weight)
+
+        return cls.from_columns(
+            split_test_uuids,
+            split_test_slugs,
+            cohort_counts,
+            cohort_uuids,
+            cohort_slugs,
+            cohort_weights,
+            layer_rows,
+            targeting_rows,
+            version=version,
+            expires_at=expires_at,
+        )
+
+    @classmethod
+    def from_columns(
+        cls,
+        split_test_uuids,
+        split_test_slugs,
+        cohort_counts,
+        cohort_uuids,
+        cohort_slugs,
+        cohort_weights,
+        layer_rows=(),
+        targeting_rows=(),
+        version=None,
+        expires_at=None,
+    ):
+        """Return a snapshot built from columns of values.
+
+        `cohort_counts` holds the number of cohorts of each split test, and
+        the cohort columns must be grouped by split test in the same order.
+        """
+        # UUIDs are unique, but slugs (e.g. "control") are often repeated.
+        slugs = {}
+        intern = slugs.setdefault
+
+        stops = list(accumulate(cohort_counts))
+        starts = [0, *stops[:-1]]
+        split_tests = tuple(
+            map(
+                new_split_test_record,
+                zip(
+                    split_test_uuids,
+                    map(intern, split_test_slugs, split_test_slugs),
+                    map(range, starts, stops),
+                ),
+            )
+        )
+        cohorts = tuple(
+            map(
+                new_cohort_record,
+                zip(
+                    cohort_uuids,
+                    map(intern, cohort_slugs, cohort_slugs),
+                    chain.from_iterable(map(repeat, range(len(stops)), cohort_counts)),
+                    cohort_weights,
+                ),
+            )
+        )
+        layers = tuple(
+            LayerRecord(
+                uuid,
+                tuple(upper_bounds),
+                tuple(None if i is None else split_tests[i].uuid for i in split_test_indexes),
+            )
+            for uuid, upper_bounds, split_test_indexes in layer_rows
+        )
+        targeting = tuple((split_tests[i].uuid, rules) for i, rules in targeting_rows)
+        return cls(split_tests, cohorts, layers, targeting, version, expires_at)
+
+    def to_rows(self):
+        """Return the plain tuples this snapshot can be rebuilt from."""
+        return (
+            tuple((r.uuid, r.slug) for r in self.split_tests),
+            tuple((r.uuid, r.slug, r.split_test, r.weight) for r in self.cohorts),
+            self.layer_rows(),
+            self.targeting_rows(),
+        )
+
+    def to_columns(self):
+        """Return the columns of values this snapshot can be rebuilt from with
+        `from_columns`, as a tuple of its positional arguments.
+        """
+        return (
+            [r.uuid for r in self.split_tests],
+            [r.slug for r in self.split_tests],
+            [len(r.cohorts) for r in self.split_tests],
+            [r.uuid for r in self.cohorts],
+            [r.slug for r in self.cohorts],
+            [r.weight for r in self.cohorts],
+            self.layer_rows(),
+            self.targeting_rows(),
+        )
+
+    def layer_rows(self):
+        """Return the `(uuid, upper_bounds, split_test_indexes)` rows of the
+        snapshot's layers.
+        """
+        split_test_indexes = {r.uuid: i for i, r in enumerate(self.split_tests)}
+        return tuple(
+            (
+                r.uuid,
+                r.upper_bounds,
+                tuple(
+                    None if uuid is None else split_test_indexes[uuid]
+                    for uuid in r.split_test_uuids
+                ),
+            )
+            for r in self.layers
+        )
+
+    def targeting_rows(self):
+        """Return the `(split_test_index, rules)` rows of the snapshot's
+        targeting rules.
+        """
+        split_test_indexes = {r.uuid: i for i, r in enumerate(self.split_tests)}
+        return tuple((split_test_indexes[uuid], rules) for uuid, rules in self.targeting)
+
+    def is_expired(self, now):
+        """Return whether the snapshot must be rebuilt at the POSIX timestamp
+        `now`.
+        """
+        return self.expires_at is not None and self.expires_at <= now
+
+    def get_split_test(self, uuid):
+        """Return the record of the active split test with the given UUID, or
+        `None`.
+        """
+        return self._split_tests_by_uuid.get(uuid)
+
+    def get_cohorts(self, split_test_uuid):
+        """Return the records of the active cohorts of the active split test
+        with the given UUID, in a stable order.
+        """
+        split_test = self._split_tests_by_uuid.get(split_test_uuid)
+        if split_test is None:
+            return ()
+        return self.cohorts[split_test.cohorts.start : split_test.cohorts.stop]
+
+    def get_cohort(self, uuid):
+        """Return the record of the active cohort with the given UUID, or
+        `None`.
+        """
+        return self._cohorts_by_uuid.get(uuid)
+
+    def get_cohort_short_id(self, uuid):
+        """Return the short ID of the cohort with the given UUID: the start of
+        its UUID followed by the start of its split test's, or the whole UUID
+        if another active cohort's short ID would be the same or the cohort
+        isn't active.
+
+        Short IDs are qualified by the split test so that a cohort created
+        later in another split test, whose UUID starts the same way, doesn't
+        make the short IDs already stored in sessions ambiguous.
+        """
+        cohort = self._cohorts_by_uuid.get(uuid)
+        if cohort is None:
+            return uuid
+        short_id = self._make_cohort_short_id(cohort)
+        if self._get_cohort_uuids_by_short_id().get(short_id) == uuid:
+            return short_id
+        return uuid
+
+    def get_cohort_by_short_id(self, short_id):
+        """Return the record of the active cohort with the given short ID (see
+        `get_cohort_short_id`), or `None`.
+        """
+        if len(short_id) == COHORT_SHORT_ID_LENGTH + SPLIT_TEST_SHORT_ID_LENGTH:
+            uuid = self._get_cohort_uuids_by_short_id().get(short_id)
+            if uuid is None:
+                return None
+        else:
+            uuid = short_id
+        return self._cohorts_by_uuid.get(uuid)
+
+    def _make_cohort_short_id(self, cohort):
+        split_test_uuid = self.split_tests[cohort.split_test].uuid
+        return cohort.uuid[:COHORT_SHORT_ID_LENGTH] + split_test_uuid[:SPLIT_TEST_SHORT_ID_LENGTH]
+
+    def _get_cohort_uuids_by_short_id(self):
+        uuids_by_short_id = self._cohort_uuids_by_short_id
+        if uuids_by_short_id is None:
+            uuids_by_short_id = {}
+            for cohort in self.cohorts:
+                short_id = self._make_cohort_short_id(cohort)
+                # Ambiguous short IDs map to `None`, so neither cohort uses one.
+                uuids_by_short_id[short_id] = None if short_id in uuids_by_short_id else cohort.uuid
+            object.__setattr__(self, "_cohort_uuids_by_short_id", uuids_by_short_id)
+        return uuids_by_short_id
+
+    def get_targeting(self, split_test_uuid):
+        """Return the targeting rules of the split test with the given UUID as
+        canonical JSON, or `None` if it has none.
+        """
+        for uuid, rules in self.targeting:
+            if uuid == split_test_uuid:
+                return rules
+        return None
+
+    @property
+    def targeting_predicates(self):
+        """A mapping of the UUIDs of split tests with targeting rules to their
+        compiled predicates (see `targeting.compile_rules`).
+        """
+        return self._targeting_predicates
+
+    @property
+    def targeting_group_names(self):
+        """The names of every group the targeting rules check."""
+        return self._targeting_group_names
+
+    @property
+    def split_test_active_uuids(self):
+        """A set-like view of the UUIDs of all active SplitTests."""
+        return self._split_tests_by_uuid.keys()
+
+    @property
+    def split_test_uuid_slug_map(self):
+        """A mapping of UUIDs to slugs for all active SplitTests."""
+        return RecordMap(self._split_tests_by_uuid, lambda r: r.slug)
+
+    @property
+    def split_test_slug_uuid_map(self):
+        """A dict mapping slugs to UUIDs for all active SplitTests, shared by
+        every caller, so it must not be changed.
+        """
+        return self._split_test_uuids_by_slug
+
+    @property
+    def cohort_active_uuids(self):
+        """A set-like view of the UUIDs of all active Cohorts."""
+        return self._cohorts_by_uuid.keys()
+
+    @property
+    def cohort_uuid_slug_map(self):
+        """A mapping of UUIDs to slugs for all active Cohorts."""
+        return RecordMap(self._cohorts_by_uuid, lambda r: r.slug)
+
+    @property
+    def cohort_uuid_split_test_uuid_map(self):
+        """A mapping of Cohort UUIDs to SplitTest UUIDs for all active Cohorts."""
+        return RecordMap(self._cohorts_by_uuid, lambda r: self.split_tests[r.split_test].uuid)
+
+    @property
+    def layer_bucket_ranges(self):
+        """A mapping of Layer UUIDs to their `(upper_bounds, split_test_uuids)`
+        bucket ranges.
+        """
+        return RecordMap(self._layers_by_uuid, lambda r: (r.upper_bounds, r.split_test_uuids))
@@ -0,0 +1,296 @@
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from . import cache as cache_config, codec
+from .config import get_app_settings
+from .threads import BackgroundThread
+from .timing import count_cache_call
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_snapshot_store():
+    """Return an instance of the configured snapshot store."""
+    app_settings = get_app_settings()
+    store_class = import_string(app_settings["SNAPSHOT_STORE"])
+    return store_class(**app_settings["SNAPSHOT_STORE_OPTIONS"])
+
+
+class CacheSnapshotStore:
+    """Store encoded snapshots in Django's default cache."""
+
+    def get_version(self):
+        """Return the version of the stored snapshot, or `None`."""
+        count_cache_call()
+        return cache.get(cache_config.SNAPSHOT_VERSION_KEY)
+
+    def get(self):
+        """Return the encoded snapshot, or `None`."""
+        count_cache_call()
+        return cache.get(cache_config.SNAPSHOT_KEY)
+
+    def set(self, data, version, timeout=cache_config.NEVER):
+        """Store an encoded snapshot and its version for `timeout` seconds, or
+        forever if `None`.
+        """
+        # Store the snapshot before its version so that other processes never
+        # see a new version without the snapshot it belongs to.
+        count_cache_call(2)
+        cache.set(cache_config.SNAPSHOT_KEY, data, timeout=timeout)
+        cache.set(cache_config.SNAPSHOT_VERSION_KEY, version, timeout=timeout)
+
+    def subscribe(self, callback):
+        """Do nothing, as the cache can't notify us of new versions."""
+
+
+class RedisSnapshotStore:
+    """Store encoded snapshots in Redis and publish their version whenever
+    they change.
+
+    Each process subscribes to the changes from a background thread and calls
+    the subscribed callback with each new version as soon as it's published.
+    While subscribed, reading the version doesn't touch the network.
+    """
+
+    # Seconds to wait before subscribing again after losing the connection.
+    reconnect_delay = 1.0
+
+    def __init__(
+        self, url="redis://localhost:6379/0", client=None, channel=cache_config.SNAPSHOT_CHANNEL
+    ):
+        if client is None:
+            try:
+                import redis
+            except ImportError as e:
+                raise ImproperlyConfigured(
+                    "RedisSnapshotStore requires the redis package to be installed."
+                ) from e
+            client = redis.Redis.from_url(url)
+
+        self.client = client
+        self.channel = channel
+        self.callback = None
+        # The latest version published while subscribed, or `None` if it's
+        # not known (e.g. we're not subscribed yet).
+        self.version = None
+
+        self._stopping = threading.Event()
+        self._thread = BackgroundThread(
+            self._listen, "split-tests-snapshot-subscriber", on_start=self._reset_version
+        )
+
+    def get_version(self):
+        """Return the version of the stored snapshot, or `None`."""
+        self._ensure_subscribed()
+        version = self.version
+        if version is None:
+            version = self._fetch_version()
+        return version
+
+    def get(self):
+        """Return the encoded snapshot, or `None`."""
+        count_cache_call()
+        return self.client.get(cache_config.SNAPSHOT_KEY)
+
+    def set(self, data, version, timeout=cache_config.NEVER):
+        """Store an encoded snapshot and its version for `timeout` seconds, or
+        forever if `None`, and notify every subscribed process.
+        """
+        px = None if timeout is None else max(int(timeout * 1000), 1)
+        count_cache_call(3)
+        # Store the snapshot before its version so that other processes never
+        # see a new version without the snapshot it belongs to.
+        self.client.set(cache_config.SNAPSHOT_KEY, data, px=px)
+        self.client.set(cache_config.SNAPSHOT_VERSION_KEY, version, px=px)
+        self.client.publish(self.channel, version)
+
+    def subscribe(self, callback):
+        """Call `callback(version)` from a background thread whenever a new
+        version is published.
+        """
+        self.callback = callback
+        self._ensure_subscribed()
+
+    def close(self):
+        """Stop the background thread."""
+        self._stopping.set()
+
+    def _ensure_subscribed(self):
+        self._thread.ensure_started()
+
+    def _reset_version(self):
+        # The version copied from the parent process isn't kept up to date.
+        self.version = None
+
+    def _fetch_version(self):
+        count_cache_call()
+        version = self.client.get(cache_config.SNAPSHOT_VERSION_KEY)
+        return None if version is None else _to_str(version)
+
+    def _listen(self):
+        while not self._stopping.is_set():
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                # Catch up on any versions published whilst we weren't
+                # subscribed.
+                self._set_version(self._fetch_version())
+                while not self._stopping.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message and message["type"] == "message":
+                        self._set_version(_to_str(message["data"]))
+            except Exception:
+                logger.exception("Lost the split test snapshot subscription. Retrying.")
+                self.version = None
+                self._stopping.wait(self.reconnect_delay)
+            finally:
+                pubsub.close()
+
+    def _set_version(self, version):
+        if version is None or version == self.version:
+            return
+        if self.callback is not None:
+            try:
+                self.callback(version)
+            except Exception:
+                logger.exception("Failed to load split test snapshot version %s.", version)
+        # Only publish the version to request threads once the callback has
+        # had a chance to load the snapshot it belongs to.
+        self.version = version
+
+
+class FileSnapshotStore:
+    """Share snapshots between the processes on a host through a
+    memory-mapped file.
+
+    Snapshots are read from and written to an upstream store and copied to
+    `path`, which should be on a local filesystem (ideally an in-memory one,
+    such as `/dev/shm`). Each process maps the file and reads the version from
+    its header, so checking the version costs a `stat` rather than a network
+    request. The file is refreshed from the upstream store once it's older
+    than `max_age` seconds, or as soon as a subscribed upstream store
+    publishes a new version.
+    """
+
+    def __init__(
+        self,
+        path,
+        upstream="split_tests.stores.CacheSnapshotStore",
+        upstream_options=None,
+        max_age=5.0,
+    ):
+        self.path = os.fspath(path)
+        self.upstream = import_string(upstream)(**(upstream_options or {}))
+        self.max_age = max_age
+        # The `(file_id, version, data)` of the mapped file, replaced as a
+        # whole so that threads never see a version with another's data.
+        self._mapped = (None, None, None)
+
+    def get_version(self):
+        """Return the version of the stored snapshot, or `None`."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return self._refresh()
+        if time.time() - stat.st_mtime > self.max_age:
+            return self._refresh()
+        # The file is always replaced rather than modified, and the old file
+        # can't be reused while it's mapped, so its inode identifies it.
+        if (stat.st_dev, stat.st_ino) != self._mapped[0]:
+            self._map()
+        return self._mapped[1]
+
+    def get(self):
+        """Return the encoded snapshot without copying it, or `None`."""
+        data = self._mapped[2]
+        if data is None:
+            return self.upstream.get()
+        return data
+
+    def set(self, data, version, timeout=cache_config.NEVER):
+        """Store an encoded snapshot upstream, for `timeout` seconds or forever
+        if `None`, and in the local file.
+        """
+        self.upstream.set(data, version, timeout)
+        self._write(data)
+        self._map()
+
+    def subscribe(self, callback):
+        """Refresh the local file, then call `callback(version)`, whenever
+        the upstream store publishes a new version.
+        """
+
+        def on_new_version(version):
+            self._refresh()
+            callback(version)
+
+        self.upstream.subscribe(on_new_version)
+
+    def _refresh(self):
+        version = self.upstream.get_version()
+        if version is None:
+            return None
+        if version == self._read_version():
+            # Reset the file's age so the other processes don't refresh it too.
+            os.utime(self.path)
+        else:
+            data = self.upstream.get()
+            if data is None:
+                return None
+            self._write(data)
+        self._map()
+        return self._mapped[1]
+
+    def _read_version(self):
+        try:
+            with open(self.path, "rb") as f:
+                header = f.read(codec.HEADER.size)
+        except FileNotFoundError:
+            return None
+        if len(header) < codec.HEADER.size:
+            return None
+        return codec.HEADER.unpack(header)[2].hex()
+
+    def _write(self, data):
+        write_atomically(self.path, data)
+
+    def _map(self):
+        try:
+            with open(self.path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                if stat.st_size < codec.HEADER.size:
+                    self._mapped = (None, None, None)
+                    return
+                data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except FileNotFoundError:
+            self._mapped = (None, None, None)
+            return
+        version = codec.HEADER.unpack_from(data)[2].hex()
+        self._mapped = ((stat.st_dev, stat.st_ino), version, data)
+
+
+def write_atomically(path, data):
+    """Write `data` to a temporary file in the same directory as `path` and
+    rename it over `path`, so that readers only ever see a complete file.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".split_tests.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def _to_str(value):
+    return value.decode() if isinstance(value, bytes) else value
@@ -0,0 +1,251 @@
+"""Audience targeting: rules which limit a split test to matching requests.
+
+A split test's `targeting` is a list of rules, all of which a request must
+match for the user to be eligible for the split test. Each rule is a dict
+with one of these keys:
+
+- `{"user": "is_staff"}`: the user's attribute is truthy, or with
+  `"equals": value`, equal to the value. Only the user's own attributes can
+  be checked, not related objects (e.g. `profile`, `groups` or
+  `profile.plan`), which would need a query on every request.
+- `{"group": "beta"}` or `{"group": ["beta", "staff"]}`: the user is
+  authenticated and in (any of) the named groups.
+- `{"header": "Accept-Language"}`: the request has the header, or with
+  `"equals"`, `"contains"` or `"matches"` (a regular expression searched for),
+  its value matches.
+- `{"cookie": "beta"}`: the request has the cookie, or with `"equals"`, the
+  cookie has the value.
+- `{"any": [rule, ...]}`: the request matches any of the rules.
+
+Any rule can be negated with `"not": true`.
+
+Rules are compiled into predicates once per snapshot, when it's built or
+loaded. Rules which need the database (`group`) are evaluated after the
+others, and the groups of every split test are read with a single query the
+first time a request needs them.
+"""
+
+import json
+import re
+
+from operator import attrgetter
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import FieldDoesNotExist
+
+
+# The keys which select the kind of a rule.
+RULE_KINDS = ("user", "group", "header", "cookie", "any")
+# The keys which compare a value, and those each kind of rule accepts.
+COMPARISONS = {
+    "user": ("equals",),
+    "group": (),
+    "header": ("equals", "contains", "matches"),
+    "cookie": ("equals",),
+    "any": (),
+}
+
+
+class TargetingError(ValueError):
+    """Targeting rules are invalid."""
+
+
+class Predicate:
+    """A compiled rule: call it with a request and its `TargetingContext`."""
+
+    __slots__ = ("func", "groups")
+
+    def __init__(self, func, groups=frozenset()):
+        self.func = func
+        # The names of the groups the rule checks, whose membership must be
+        # read from the database.
+        self.groups = groups
+
+    def __call__(self, request, context):
+        return self.func(request, context)
+
+
+class TargetingContext:
+    """The per-request state of targeting rules, which reads the user's
+    groups from the database at most once.
+    """
+
+    __slots__ = ("request", "group_names", "_user_groups")
+
+    def __init__(self, request, group_names):
+        self.request = request
+        # The names of every group any split test's rules check.
+        self.group_names = group_names
+        self._user_groups = None
+
+    @property
+    def user_groups(self):
+        """The set of the checked groups the user is in."""
+        if self._user_groups is None:
+            user = self.request.user
+            # Custom user models without `PermissionsMixin` have no groups.
+            if user.is_authenticated and self.group_names and hasattr(user, "groups"):
+                self._user_groups = frozenset(
+                    user.groups.filter(name__in=self.group_names).values_list("name", flat=True)
+                )
+            else:
+                self._user_groups = frozenset()
+        return self._user_groups
+
+
+def get_untargeted_split_test_uuids(request, split_test_uuids, predicates, group_names):
+    """Return those of the given split test UUIDs whose targeting rules the
+    request doesn't match.
+
+    `predicates` maps split test UUIDs to their compiled rules, and any groups
+    they check are read with a single query the first time one is needed.
+    """
+    context = TargetingContext(request, group_names)
+    return {
+        split_test_uuid
+        for split_test_uuid, predicate in predicates.items()
+        if split_test_uuid in split_test_uuids and not predicate(request, context)
+    }
+
+
+def dumps(rules):
+    """Return the rules as canonical JSON, so equal rules always compare and
+    hash equal in snapshots.
+    """
+    return json.dumps(rules, sort_keys=True, separators=(",", ":"))
+
+
+def compile_rules(rules):
+    """Return a predicate matching requests which match all of the rules.
+
+    Raise a `TargetingError` if the rules are invalid.
+    """
+    if not isinstance(rules, list):
+        raise TargetingError("Targeting rules must be a list.")
+    predicates = [compile_rule(rule) for rule in rules]
+    # Evaluate the rules which might need a query last, in case another one
+    # already rules the request out.
+    predicates.sort(key=lambda predicate: bool(predicate.groups))
+    groups = frozenset().union(*(predicate.groups for predicate in predicates))
+    if len(predicates) == 1:
+        return predicates[0]
+    return Predicate(
+        lambda request, context: all(predicate(request, context) for predicate in predicates),
+        groups,
+    )
+
+
+def compile_rule(rule):
+    """Return a predicate matching requests which match the rule.
+
+    Raise a `TargetingError` if the rule is invalid.
+    """
+    if not isinstance(rule, dict):
+        raise TargetingError(f"A targeting rule must be a dict, not {rule!r}.")
+    kinds = [kind for kind in RULE_KINDS if kind in rule]
+    if len(kinds) != 1:
+        raise TargetingError(f"A targeting rule needs exactly one of {RULE_KINDS}: {rule!r}.")
+    kind = kinds[0]
+    unknown = rule.keys() - {kind, "not", *COMPARISONS[kind]}
+    comparisons = [key for key in COMPARISONS[kind] if key in rule]
+    if unknown or len(comparisons) > 1:
+        raise TargetingError(f"Invalid targeting rule: {rule!r}.")
+
+    predicate = _COMPILERS[kind](rule[kind], comparisons[0] if comparisons else None, rule)
+    if rule.get("not", False):
+        func = predicate.func
+        predicate = Predicate(lambda request, context: not func(request, context), predicate.groups)
+    return predicate
+
+
+def _compile_user(attribute, comparison, rule):
+    if not isinstance(attribute, str) or attribute.startswith("_") or "." in attribute:
+        raise TargetingError(f"Invalid user attribute: {attribute!r}.")
+    try:
+        field = get_user_model()._meta.get_field(attribute)
+    except FieldDoesNotExist:
+        pass
+    else:
+        # Related objects would be fetched for every request.
+        if field.is_relation:
+            raise TargetingError(f"Invalid user attribute: {attribute!r}.")
+    get_attribute = attrgetter(attribute)
+
+    def get_value(request):
+        try:
+            return get_attribute(request.user)
+        except AttributeError:
+            return None
+
+    if comparison is None:
+        return Predicate(lambda request, context: bool(get_value(request)))
+    expected = rule[comparison]
+    return Predicate(lambda request, context: get_value(request) == expected)
+
+
+def _compile_group(names, comparison, rule):
+    if isinstance(names, str):
+        names = [names]
+    if not names or not all(isinstance(name, str) for name in names):
+        raise TargetingError(f"Invalid group names: {names!r}.")
+    names = frozenset(names)
+    return Predicate(lambda request, context: not names.isdisjoint(context.user_groups), names)
+
+
+def _compile_header(name, comparison, rule):
+    if not isinstance(name, str) or not name:
+        raise TargetingError(f"Invalid header name: {name!r}.")
+    return _compile_string_match(lambda request: request.headers.get(name), comparison, rule)
+
+
+def _compile_cookie(name, comparison, rule):
+    if not isinstance(name, str) or not name:
+        raise TargetingError(f"Invalid cookie name: {name!r}.")
+    return _compile_string_match(lambda request: request.COOKIES.get(name), comparison, rule)
+
+
+def _compile_string_match(get_value, comparison, rule):
+    if comparison is None:
+        return Predicate(lambda request, context: get_value(request) is not None)
+
+    expected = rule[comparison]
+    if not isinstance(expected, str):
+        raise TargetingError(f"Invalid {comparison!r} value: {expected!r}.")
+    if comparison == "matches":
+        try:
+            search = re.compile(expected).search
+        except re.error as e:
+            raise TargetingError(f"Invalid regular expression: {expected!r}.") from e
+    elif comparison == "contains":
+
+        def search(value):
+            return expected in value
+
+    else:
+        search = expected.__eq__
+
+    def func(request, context):
+        value = get_value(request)
+        return value is not None and bool(search(value))
+
+    return Predicate(func)
+
+
+def _compile_any(rules, comparison, rule):
+    if not isinstance(rules, list) or not rules:
+        raise TargetingError("An `any` targeting rule needs a list of rules.")
+    predicates = [compile_rule(rule) for rule in rules]
+    predicates.sort(key=lambda predicate: bool(predicate.groups))
+    return Predicate(
+        lambda request, context: any(predicate(request, context) for predicate in predicates),
+        frozenset().union(*(predicate.groups for predicate in predicates)),
+    )
+
+
+_COMPILERS = {
+    "user": _compile_user,
+    "group": _compile_group,
+    "header": _compile_header,
+    "cookie": _compile_cookie,
+    "any": _compile_any,
+}
@@ -0,0 +1,56 @@
+"""Background threads, each started lazily once per process."""
+
+import os
+import threading
+
+from contextlib import contextmanager
+
+from django.db import close_old_connections
+
+
+class BackgroundThread:
+    """A daemon thread which runs `target`, started the first time
+    `ensure_started` is called in each process.
+
+    Threads don't survive a fork, so each worker process of a preforking
+    server starts its own. `on_start`, if given, is called before the thread
+    is started in a new process (e.g. to reset state copied from the parent).
+    """
+
+    def __init__(self, target, name, on_start=None):
+        self.target = target
+        self.name = name
+        self.on_start = on_start
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+
+    def ensure_started(self):
+        """Start the thread if it isn't running in this process."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            if self.on_start is not None:
+                self.on_start()
+            self._thread = threading.Thread(target=self.target, name=self.name, daemon=True)
+            self._thread.start()
+
+    def is_running(self):
+        """Return whether the thread is running in this process."""
+        return self._pid == os.getpid() and self._thread is not None and self._thread.is_alive()
+
+
+@contextmanager
+def closing_old_connections():
+    """Like a request, discard database connections which are broken or past
+    their `CONN_MAX_AGE` before and after the block.
+    """
+    close_old_connections()
+    try:
+        yield
+    finally:
+        close_old_connections()
@@ -0,0 +1,108 @@
+"""Opt-in timings of `SplitTestMiddleware`'s phases, for profiling in
+production without a full profiler.
+
+When `SERVER_TIMING` is enabled, the middleware times each phase of a
+request and counts the database queries and cache calls it makes (outside
+of the view), then adds them to the response's `Server-Timing` header and
+logs them for a sample of requests.
+"""
+
+import time
+
+from contextlib import ExitStack, contextmanager, nullcontext
+from contextvars import ContextVar
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from .config import get_app_settings
+
+
+class Timings:
+    """The durations, in milliseconds, of named phases plus the number of
+    database queries and cache calls made.
+    """
+
+    def __init__(self):
+        self.durations = {}
+        self.queries = 0
+        self.query_duration = 0.0
+        self.cache_calls = 0
+
+    @contextmanager
+    def track(self):
+        """Count the queries and cache calls made in the block, including the
+        queries made on the `READ_DATABASE`.
+        """
+        aliases = {DEFAULT_DB_ALIAS, get_app_settings()["READ_DATABASE"]} - {None}
+        token = current_timings.set(self)
+        try:
+            with ExitStack() as stack:
+                for alias in aliases:
+                    stack.enter_context(connections[alias].execute_wrapper(self.count_query))
+                yield
+        finally:
+            current_timings.reset(token)
+
+    @contextmanager
+    def measure(self, name):
+        """Add the time spent in the block to the phase's duration."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.durations[name] = self.durations.get(name, 0.0) + elapsed
+
+    def count_query(self, execute, sql, params, many, context):
+        """Count and time a query; a database `execute_wrapper`."""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_duration += (time.perf_counter() - start) * 1000
+
+    def header(self, prefix="dst-"):
+        """Return the timings as a `Server-Timing` header value."""
+        metrics = [
+            f"{prefix}{name};dur={duration:.3f}" for name, duration in self.durations.items()
+        ]
+        metrics.append(f'{prefix}db;desc="{self.queries} queries";dur={self.query_duration:.3f}')
+        metrics.append(f'{prefix}cache;desc="{self.cache_calls} calls"')
+        return ", ".join(metrics)
+
+    def as_dict(self):
+        """Return the timings as a dict, e.g. for structured logging."""
+        return {
+            "durations": dict(self.durations),
+            "queries": self.queries,
+            "query_duration": self.query_duration,
+            "cache_calls": self.cache_calls,
+        }
+
+
+class NullTimings:
+    """Timings which record nothing, used when they're disabled."""
+
+    _null_context = nullcontext()
+
+    def track(self):
+        return self._null_context
+
+    def measure(self, name):
+        return self._null_context
+
+
+NULL_TIMINGS = NullTimings()
+
+# The timings of the current request.
+current_timings = ContextVar("split_tests_timings", default=NULL_TIMINGS)
+
+
+def count_cache_call(calls=1):
+    """Count cache calls made on behalf of the current request, if it's
+    being timed.
+    """
+    timings = current_timings.get()
+    if timings is not NULL_TIMINGS:
+        timings.cache_calls += calls
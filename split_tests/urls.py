@@ -0,0 +1,11 @@
+from django.urls import path
+
+from . import views
+
+
+app_name = "split_tests"
+
+urlpatterns = [
+    path("client.json", views.client_config, name="client_config"),
+    path("document.json", views.document, name="document"),
+]
@@ -0,0 +1,80 @@
+import math
+import time
+
+from hashlib import blake2b
+
+from django.http import JsonResponse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition, require_safe
+
+from .config import get_app_settings
+from .document import build_document
+from .models import SplitTest
+from .sessions import get_session_assignments
+from .snapshot import VERSION_SIZE
+
+
+def _get_assignments(request):
+    """Return the current user's `{split_test_uuid: cohort_uuid}`
+    assignments, as set in their session by the middleware.
+    """
+    return get_session_assignments(
+        request, get_app_settings()["SESSION_KEY"], SplitTest.cache.snapshot()
+    )
+
+
+def _client_config_etag(request):
+    # The response only depends on the snapshot and the user's assignments.
+    key = (SplitTest.cache.snapshot().version, sorted(_get_assignments(request).items()))
+    return blake2b(repr(key).encode(), digest_size=VERSION_SIZE).hexdigest()
+
+
+def _document_etag(request):
+    return SplitTest.cache.snapshot().version
+
+
+@require_safe
+@condition(etag_func=_document_etag)
+def document(request):
+    """Serve the document describing the active split tests (see
+    `split_tests.document`).
+
+    The response can be cached until the snapshot's next scheduled change,
+    for at most `DOCUMENT_MAX_AGE` seconds, and is revalidated with its
+    ETag.
+    """
+    snapshot = SplitTest.cache.snapshot()
+    response = JsonResponse(build_document(snapshot))
+
+    max_age = get_app_settings()["DOCUMENT_MAX_AGE"]
+    if snapshot.expires_at is not None:
+        max_age = max(min(max_age, math.floor(snapshot.expires_at - time.time())), 0)
+    patch_cache_control(response, public=True, max_age=max_age)
+    return response
+
+
+@require_safe
+@condition(etag_func=_client_config_etag)
+def client_config(request):
+    """Serve the active split tests and the current user's cohorts, for
+    front-end split tests.
+
+    Requires `SplitTestMiddleware`. The response is private to the user, but
+    clients can poll it cheaply: its ETag only changes with the snapshot or
+    the user's assignments, and a matching `If-None-Match` gets an empty 304
+    response.
+    """
+    snapshot = SplitTest.cache.snapshot()
+    slug_map = getattr(request.user, "split_test_slug_map", {})
+    response = JsonResponse(
+        {
+            "version": snapshot.version,
+            "split_tests": [split_test.slug for split_test in snapshot.split_tests],
+            # Read each cohort from the map, so that handing them all to the
+            # front end logs the user's exposures.
+            "cohorts": {split_test_slug: slug_map[split_test_slug] for split_test_slug in slug_map},
+        }
+    )
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ("Cookie",))
+    return response
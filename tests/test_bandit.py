@@ -0,0 +1,179 @@
+import io
+
+import numpy as np
+import pytest
+
+from django.contrib.auth import get_user_model
+from django.contrib.sites.models import Site
+from django.core.management import call_command
+
+from split_tests.bandit import (
+    EPSILON_GREEDY,
+    WEIGHT_SCALE,
+    get_bandit_weights,
+    update_bandit_weights,
+)
+from split_tests.models import Cohort, SplitTest
+from split_tests.results import record_values
+
+
+User = get_user_model()
+
+
+@pytest.fixture
+def cohorts():
+    split_test = SplitTest.objects.create(
+        name="Test",
+        slug="test",
+        site=Site.objects.get_current(),
+        is_active=True,
+        bandit_goal="signup",
+    )
+    control = Cohort.objects.create(
+        split_test=split_test, name="Control", slug="control", weight=1, is_active=True
+    )
+    variant = Cohort.objects.create(
+        split_test=split_test, name="Variant", slug="variant", weight=1, is_active=True
+    )
+    return split_test, control, variant
+
+
+def record_conversions(cohort, conversions, count):
+    record_values((cohort.id, "signup", 1.0 if i < conversions else 0.0) for i in range(count))
+
+
+def test_thompson_sampling_favours_the_best_cohort():
+    """Test that Thompson sampling gives most of the weight to the cohort
+    which is most likely the best, but keeps exploring close ones.
+    """
+    totals = np.array([(1000, 100.0, 100.0), (1000, 150.0, 150.0), (1000, 140.0, 140.0)])
+
+    weights = get_bandit_weights(np, totals, rng=np.random.default_rng(0))
+
+    assert sum(weights) == pytest.approx(WEIGHT_SCALE, abs=2)
+    assert weights[0] == 0
+    assert weights[1] > weights[2] > 0
+
+
+def test_epsilon_greedy():
+    """Test that epsilon-greedy gives most of the weight to the best cohort
+    and splits the rest equally.
+    """
+    totals = np.array([(1000, 100.0, 100.0), (1000, 150.0, 150.0)])
+
+    assert get_bandit_weights(np, totals, EPSILON_GREEDY, epsilon=0.2) == [1000, 9000]
+
+
+def test_bandit_weights_are_equal_until_every_cohort_has_enough_values():
+    """Test that the cohorts are weighted equally while any of them has too
+    few values.
+    """
+    totals = np.array([(1000, 100.0, 100.0), (10, 10.0, 10.0)])
+
+    assert get_bandit_weights(np, totals, min_count=100) == [5000, 5000]
+
+
+def test_unknown_bandit_strategy():
+    """Test that an unknown strategy is rejected."""
+    with pytest.raises(ValueError):
+        get_bandit_weights(np, np.array([(1, 1.0, 1.0)]), "random")
+
+
+@pytest.mark.django_db
+def test_update_bandit_weights(cohorts, django_assert_num_queries):
+    """Test that the weights are stored on the cohorts and swapped into the
+    snapshot without rebuilding it.
+    """
+    split_test, control, variant = cohorts
+    record_conversions(control, 100, 1000)
+    record_conversions(variant, 200, 1000)
+    SplitTest.cache.snapshot()
+
+    # Read the cohorts and their totals, then update them.
+    with django_assert_num_queries(3):
+        weights = update_bandit_weights(EPSILON_GREEDY)
+
+    assert weights == {str(control.uuid): 500, str(variant.uuid): 9500}
+    control.refresh_from_db()
+    variant.refresh_from_db()
+    assert (control.bandit_weight, variant.bandit_weight) == (500, 9500)
+    snapshot = SplitTest.cache.snapshot()
+    assert [cohort.weight for cohort in snapshot.get_cohorts(str(split_test.uuid))] == [500, 9500]
+
+    # The weights survive a rebuild of the snapshot.
+    snapshot = SplitTest.cache.update()
+    assert [cohort.weight for cohort in snapshot.get_cohorts(str(split_test.uuid))] == [500, 9500]
+
+
+@pytest.mark.django_db
+def test_update_bandit_weights_doesnt_overwrite_newer_snapshots(cohorts, monkeypatch):
+    """Test that a snapshot stored while the weights were being computed is
+    rebuilt with them rather than overwritten.
+    """
+    split_test, control, variant = cohorts
+    record_conversions(control, 100, 1000)
+    record_conversions(variant, 200, 1000)
+    stale_snapshot = SplitTest.cache.snapshot()
+    new_split_test = SplitTest.objects.create(
+        name="New", slug="new", site=split_test.site, is_active=True
+    )
+    Cohort.objects.create(
+        split_test=new_split_test, name="Control", slug="control", weight=1, is_active=True
+    )
+    monkeypatch.setattr(SplitTest.cache, "snapshot", lambda: stale_snapshot)
+
+    update_bandit_weights(EPSILON_GREEDY)
+
+    monkeypatch.undo()
+    snapshot = SplitTest.cache.snapshot()
+    assert snapshot.get_split_test(str(new_split_test.uuid)) is not None
+    assert [cohort.weight for cohort in snapshot.get_cohorts(str(split_test.uuid))] == [500, 9500]
+
+
+@pytest.mark.django_db
+def test_bandit_weights_are_ignored_without_a_bandit_goal(cohorts):
+    """Test that the cohorts' own weights are used once the split test's
+    bandit goal is removed.
+    """
+    split_test, control, variant = cohorts
+    Cohort.objects.filter(id=control.id).update(bandit_weight=0)
+
+    split_test.bandit_goal = ""
+    split_test.save()
+
+    snapshot = SplitTest.cache.snapshot()
+    assert [cohort.weight for cohort in snapshot.get_cohorts(str(split_test.uuid))] == [1, 1]
+    assert update_bandit_weights() == {}
+
+
+@pytest.mark.django_db
+def test_users_are_assigned_with_bandit_weights(cohorts):
+    """Test that authenticated users are assigned with the bandit weights."""
+    split_test, control, variant = cohorts
+    Cohort.objects.filter(id=control.id).update(bandit_weight=0)
+    Cohort.objects.filter(id=variant.id).update(bandit_weight=1)
+
+    users = [User.objects.create_user(username=f"user{i}") for i in range(10)]
+
+    for user in users[:5]:
+        assert Cohort.objects.get_for_user_and_split_test(user, split_test.uuid) == variant
+
+    user_ids = [user.id for user in users[5:]]
+    assert list(Cohort.objects.iter_cohort_slugs(user_ids, split_test.uuid, assign=True)) == [
+        (user_id, "variant") for user_id in user_ids
+    ]
+
+
+@pytest.mark.django_db
+def test_update_bandit_weights_command(cohorts):
+    """Test that the command updates the weights and reports the number of
+    cohorts.
+    """
+    split_test, control, variant = cohorts
+    stdout = io.StringIO()
+
+    call_command("update_bandit_weights", "--strategy", EPSILON_GREEDY, stdout=stdout)
+
+    assert stdout.getvalue() == "Updated the weights of 2 cohort(s).\n"
+    variant.refresh_from_db()
+    assert variant.bandit_weight == 5000
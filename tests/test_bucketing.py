@@ -0,0 +1,106 @@
+from split_tests.bucketing import (
+    LAYER_BUCKETS,
+    build_bucket_ranges,
+    find_bucket_start,
+    get_bucket,
+    get_free_buckets,
+    pick_split_test_uuid,
+    pick_weighted,
+)
+
+
+def test_get_bucket_is_stable():
+    """Test that the same salt and unit ID always return the same bucket."""
+    assert get_bucket("layer", "user") == get_bucket("layer", "user")
+
+
+def test_get_bucket_is_in_range():
+    """Test that buckets are always within the number of buckets."""
+    buckets = {get_bucket("layer", unit_id) for unit_id in range(1_000)}
+    assert min(buckets) >= 0
+    assert max(buckets) < LAYER_BUCKETS
+
+
+def test_build_bucket_ranges_keeps_buckets_of_inactive_split_tests():
+    """Test that inactive split tests keep their buckets so that the ranges of
+    the other split tests in the layer do not move.
+    """
+    assert build_bucket_ranges(
+        [("one", 0, 30, True), ("two", 30, 20, False), ("three", 50, 50, True)]
+    ) == ((30, 50, 100), ("one", None, "three"))
+
+
+def test_build_bucket_ranges_keeps_stored_starts():
+    """Test that each split test's range starts where it's stored, whatever
+    the other ranges, with the buckets in between unallocated.
+    """
+    assert build_bucket_ranges([("two", 60, 20, True), ("one", 10, 30, True)]) == (
+        (10, 40, 60, 80),
+        (None, "one", None, "two"),
+    )
+
+
+def test_build_bucket_ranges_truncates_over_allocation():
+    """Test that overlapping allocations and those beyond the number of
+    buckets are truncated, and split tests without any buckets keep an empty
+    range which is never picked.
+    """
+    bucket_ranges = build_bucket_ranges(
+        [
+            ("zero", None, 0, True),
+            ("one", 0, 80, True),
+            ("two", 50, 80, True),
+            ("three", None, 10, True),
+        ]
+    )
+
+    assert bucket_ranges == ((80, 100, 100, 100), ("one", "two", "zero", "three"))
+    picked = {pick_split_test_uuid(bucket_ranges, bucket) for bucket in range(LAYER_BUCKETS)}
+    assert picked == {"one", "two"}
+
+
+def test_find_bucket_start():
+    """Test that split tests are given the first gap they fit in."""
+    ranges = [(50, 20), (0, 30)]
+
+    assert find_bucket_start(ranges, 20) == 30
+    assert find_bucket_start(ranges, 30) == 70
+    assert find_bucket_start(ranges, 31) is None
+    assert get_free_buckets(ranges) == 30
+    assert get_free_buckets(ranges, 30) == 20
+    assert get_free_buckets(ranges, 10) == 0
+
+
+def test_pick_split_test_uuid():
+    """Test that each bucket maps to the split test which owns it."""
+    bucket_ranges = build_bucket_ranges([("one", 0, 30, True), ("two", 30, 20, False)])
+
+    assert pick_split_test_uuid(bucket_ranges, 0) == "one"
+    assert pick_split_test_uuid(bucket_ranges, 29) == "one"
+    assert pick_split_test_uuid(bucket_ranges, 30) is None
+    # Unallocated buckets don't map to any split test.
+    assert pick_split_test_uuid(bucket_ranges, 50) is None
+
+
+def test_pick_weighted_is_proportional_to_weights():
+    """Test that each index is picked for a share of unit IDs roughly
+    proportional to its weight, and that zero weights are never picked.
+    """
+    picks = [pick_weighted("split-test", unit_id, [3, 0, 1]) for unit_id in range(4_000)]
+
+    assert picks.count(1) == 0
+    assert 2_800 < picks.count(0) < 3_200
+    assert picks.count(0) + picks.count(2) == 4_000
+
+
+def test_pick_weighted_is_stable():
+    """Test that the same salt and unit ID always pick the same index."""
+    assert pick_weighted("split-test", "user", [1, 1]) == pick_weighted(
+        "split-test", "user", [1, 1]
+    )
+
+
+def test_pick_weighted_without_weights():
+    """Test that nothing is picked if there are no non-zero weights."""
+    assert pick_weighted("split-test", "user", []) is None
+    assert pick_weighted("split-test", "user", [0, 0]) is None
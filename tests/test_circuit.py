@@ -0,0 +1,234 @@
+import time
+
+import pytest
+
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.contrib.sites.models import Site
+from django.core.cache.backends.locmem import LocMemCache
+from django.http import HttpResponse
+from django.test import RequestFactory
+
+from split_tests import codec
+from split_tests.circuit import (
+    CacheUnavailable,
+    CircuitBreaker,
+    CircuitOpenError,
+    get_circuit_breaker,
+)
+from split_tests.middleware import SplitTestMiddleware
+from split_tests.models import Cohort, SplitTest
+from split_tests.snapshot import Snapshot
+
+
+User = get_user_model()
+
+
+class FlakyCache(LocMemCache):
+    """A local memory cache whose split test keys can be made slow or
+    unavailable.
+    """
+
+    delay = 0.0
+    is_down = False
+
+    def _inject(self, key):
+        if not key.startswith("split_tests:"):
+            return
+        if self.delay:
+            time.sleep(self.delay)
+        if self.is_down:
+            raise ConnectionError("The cache is down.")
+
+    def get(self, key, *args, **kwargs):
+        self._inject(key)
+        return super().get(key, *args, **kwargs)
+
+    def set(self, key, *args, **kwargs):
+        self._inject(key)
+        return super().set(key, *args, **kwargs)
+
+    def delete_many(self, keys, *args, **kwargs):
+        for key in keys:
+            self._inject(key)
+        return super().delete_many(keys, *args, **kwargs)
+
+
+@pytest.fixture
+def flaky_cache(settings):
+    FlakyCache.delay = 0.0
+    FlakyCache.is_down = False
+    settings.CACHES = {"default": {"BACKEND": "tests.test_circuit.FlakyCache"}}
+    settings.DJANGO_SPLIT_TESTS = {
+        "CACHE_CIRCUIT_BREAKER": {
+            "failure_threshold": 2,
+            "reset_timeout": 60,
+            "slow_call_threshold": 0.05,
+        }
+    }
+    SplitTest.cache.local_snapshot = None
+    yield FlakyCache
+    SplitTest.cache.local_snapshot = None
+
+
+@pytest.fixture
+def split_test():
+    split_test = SplitTest.objects.create(
+        name="Test", slug="test", site=Site.objects.get_current(), is_active=True
+    )
+    Cohort.objects.create(
+        split_test=split_test, name="Control", slug="control", weight=1, is_active=True
+    )
+    return split_test
+
+
+def fail():
+    raise ConnectionError("The cache is down.")
+
+
+def test_circuit_breaker_opens_after_failures():
+    """Test that calls are skipped once enough calls in a row have failed."""
+    circuit_breaker = CircuitBreaker(failure_threshold=2)
+    calls = []
+
+    for _ in range(2):
+        with pytest.raises(CacheUnavailable):
+            circuit_breaker.call(fail)
+    assert circuit_breaker.is_open()
+
+    with pytest.raises(CircuitOpenError):
+        circuit_breaker.call(calls.append, "called")
+    assert calls == []
+
+
+def test_circuit_breaker_counts_slow_calls_as_failures():
+    """Test that calls slower than the threshold open the circuit, though
+    their results are still returned.
+    """
+    circuit_breaker = CircuitBreaker(failure_threshold=1, slow_call_threshold=0.01)
+
+    assert circuit_breaker.call(lambda: time.sleep(0.02) or "slow") == "slow"
+
+    assert circuit_breaker.is_open()
+
+
+def test_circuit_breaker_resets_failures_after_success():
+    """Test that only consecutive failures open the circuit."""
+    circuit_breaker = CircuitBreaker(failure_threshold=2)
+
+    with pytest.raises(CacheUnavailable):
+        circuit_breaker.call(fail)
+    circuit_breaker.call(lambda: None)
+    with pytest.raises(CacheUnavailable):
+        circuit_breaker.call(fail)
+
+    assert not circuit_breaker.is_open()
+
+
+def test_circuit_breaker_recovers():
+    """Test that a single call tests the cache after the reset timeout,
+    reopening the circuit if it fails and closing it if it succeeds.
+    """
+    circuit_breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+    with pytest.raises(CacheUnavailable):
+        circuit_breaker.call(fail)
+
+    time.sleep(0.02)
+    with pytest.raises(CacheUnavailable):
+        circuit_breaker.call(fail)
+    assert circuit_breaker.is_open()
+
+    time.sleep(0.02)
+    assert circuit_breaker.call(lambda: "ok") == "ok"
+    assert not circuit_breaker.is_open()
+    assert circuit_breaker.failures == 0
+
+
+def test_circuit_breaker_is_disabled_by_default():
+    """Test that cache calls aren't guarded unless configured."""
+    assert get_circuit_breaker() is None
+
+
+@pytest.mark.django_db
+def test_snapshot_serves_local_snapshot_when_cache_is_slow(
+    flaky_cache, split_test, django_assert_num_queries
+):
+    """Test that once the cache is slow, requests stop waiting for it and use
+    the process's last known snapshot without querying the database.
+    """
+    snapshot = SplitTest.cache.snapshot()
+    flaky_cache.delay = 0.1
+
+    for _ in range(2):
+        assert SplitTest.cache.snapshot() == snapshot
+    assert get_circuit_breaker().is_open()
+
+    start = time.monotonic()
+    with django_assert_num_queries(0):
+        assert SplitTest.cache.snapshot() == snapshot
+    assert time.monotonic() - start < flaky_cache.delay
+
+
+@pytest.mark.django_db
+def test_snapshot_serves_fallback_file_when_cache_is_down(
+    flaky_cache, settings, tmp_path, django_assert_num_queries
+):
+    """Test that a process without a snapshot reads the last known one from
+    the fallback file when the cache is down.
+    """
+    settings.DJANGO_SPLIT_TESTS = settings.DJANGO_SPLIT_TESTS | {
+        "SNAPSHOT_FALLBACK_PATH": str(tmp_path / "snapshot")
+    }
+    snapshot = Snapshot.from_rows([("a", "test")], [("b", "control", 0, 1)])
+    SplitTest.cache.set_snapshot(snapshot)
+    assert codec.decode((tmp_path / "snapshot").read_bytes()) == snapshot
+    SplitTest.cache.local_snapshot = None
+    flaky_cache.is_down = True
+
+    with django_assert_num_queries(0):
+        assert SplitTest.cache.snapshot() == snapshot
+
+
+@pytest.mark.django_db
+def test_snapshot_rebuilds_once_when_cache_is_down(flaky_cache, split_test):
+    """Test that a process without any snapshot builds one from the database
+    rather than erroring when the cache is down.
+    """
+    flaky_cache.is_down = True
+
+    snapshot = SplitTest.cache.snapshot()
+
+    assert snapshot.get_split_test(str(split_test.uuid)) is not None
+    assert SplitTest.cache.local_snapshot is snapshot
+
+
+@pytest.mark.django_db
+def test_middleware_skips_assignments_while_circuit_is_open(
+    flaky_cache, split_test, django_assert_num_queries
+):
+    """Test that authenticated users aren't assigned from the database while
+    the circuit is open, but their cookies are still honoured.
+    """
+    user = User.objects.create_user(username="user")
+    cohort = split_test.cohorts.get()
+    SplitTest.cache.snapshot()
+    flaky_cache.is_down = True
+    for _ in range(2):
+        SplitTest.cache.snapshot()
+    middleware = SplitTestMiddleware(lambda request: HttpResponse())
+
+    def make_request(cookies):
+        request = RequestFactory().get("/")
+        request.COOKIES.update(cookies)
+        SessionMiddleware(lambda req: None).process_request(request)
+        request.user = user
+        return request
+
+    request = make_request({})
+    with django_assert_num_queries(0):
+        middleware(request)
+    assert request.session["split_tests"] == {}
+
+    request = make_request({f"dst:{split_test.uuid}": str(cohort.uuid)})
+    middleware(request)
+    assert request.user.split_test_slug_map == {"test": "control"}
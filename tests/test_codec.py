@@ -0,0 +1,115 @@
+import pickle
+
+import pytest
+
+from split_tests import codec
+from split_tests.snapshot import Snapshot
+
+
+@pytest.fixture
+def snapshot():
+    return Snapshot.from_rows(
+        [("split-test-one", "one"), ("split-test-two", "two"), ("split-test-three", "three")],
+        [
+            ("cohort-one", "control", 0, 1),
+            ("cohort-two", "variant", 0, 1),
+            ("cohort-three", "control", 2, 1),
+        ],
+        [("layer", (50, 100), (2, None))],
+    )
+
+
+def test_encode_decode_round_trip(snapshot):
+    """Test that a decoded snapshot is equal to the encoded one, including
+    split tests without cohorts and layers.
+    """
+    decoded = codec.decode(codec.encode(snapshot))
+
+    assert decoded == snapshot
+    assert decoded.version == snapshot.version
+    assert decoded.layer_bucket_ranges == snapshot.layer_bucket_ranges
+    assert decoded.get_split_test("split-test-two").cohorts == range(2, 2)
+
+
+def test_encode_decode_keeps_expiry(snapshot):
+    """Test that the snapshot's expiry survives encoding."""
+    snapshot = Snapshot.from_rows(*snapshot.to_rows(), expires_at=1_700_000_000.25)
+
+    decoded = codec.decode(codec.encode(snapshot))
+
+    assert decoded.expires_at == 1_700_000_000.25
+    assert decoded.version == snapshot.version
+    assert codec.decode(codec.encode(Snapshot.from_rows())).expires_at is None
+
+
+def test_encode_decode_empty_snapshot():
+    """Test that a snapshot with no split tests can be encoded and decoded."""
+    assert codec.decode(codec.encode(Snapshot())) == Snapshot()
+
+
+def test_encode_compresses_above_threshold(snapshot):
+    """Test that the body is only compressed when it's above the threshold."""
+    uncompressed = codec.encode(snapshot, compress_threshold=None)
+    compressed = codec.encode(snapshot, compress_threshold=0)
+
+    assert not uncompressed[1] & codec.FLAG_ZLIB
+    assert compressed[1] & codec.FLAG_ZLIB
+    assert codec.decode(compressed) == snapshot
+
+
+def test_decode_rejects_unsupported_format_version(snapshot):
+    """Test that snapshots in an unknown format raise a ValueError."""
+    data = bytearray(codec.encode(snapshot))
+    data[0] = codec.FORMAT_VERSION + 1
+
+    with pytest.raises(ValueError):
+        codec.decode(bytes(data))
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        None,
+        b"",
+        bytes([codec.FORMAT_VERSION, codec.FLAG_ZLIB]) + b"\x00" * 8 + b"not zlib",
+        object(),
+    ],
+)
+def test_decode_rejects_invalid_data(data):
+    """Test that anything other than an encoded snapshot raises a ValueError."""
+    with pytest.raises(ValueError):
+        codec.decode(data)
+
+
+@pytest.mark.parametrize(
+    "column, value",
+    [
+        # A layer range owned by a split test which doesn't exist.
+        (6, (("layer", (100,), (9,)),)),
+        # Targeting rules for a split test which doesn't exist.
+        (7, ((9, "[]"),)),
+        # Too few columns.
+        (None, None),
+    ],
+)
+def test_decode_rejects_corrupt_body(snapshot, column, value):
+    """Test that a body whose columns don't fit together raises a
+    ValueError, so that the snapshot is rebuilt.
+    """
+    columns = [*snapshot.to_columns(), None]
+    if column is None:
+        del columns[0]
+    else:
+        columns[column] = value
+    data = codec.encode(snapshot)[: codec.HEADER.size] + pickle.dumps(tuple(columns))
+
+    with pytest.raises(ValueError):
+        codec.decode(data)
+
+
+def test_decode_rejects_classes(snapshot):
+    """Test that a body can't make the unpickler load any class."""
+    data = codec.encode(snapshot)[: codec.HEADER.size] + pickle.dumps(snapshot)
+
+    with pytest.raises(ValueError):
+        codec.decode(data)
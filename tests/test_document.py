@@ -0,0 +1,113 @@
+import hashlib
+import json
+
+from split_tests.document import build_document
+from split_tests.middleware import SplitTestMiddleware
+from split_tests.snapshot import Snapshot
+
+
+def make_snapshot():
+    return Snapshot.from_rows(
+        [("split-test-one", "one"), ("split-test-two", "two"), ("split-test-three", "three")],
+        [
+            ("cohort-one", "control", 0, 3),
+            ("cohort-two", "variant", 0, 1),
+            ("cohort-three", "control", 1, 1),
+            ("cohort-four", "variant", 1, 1),
+            ("cohort-five", "control", 2, 1),
+        ],
+        [("layer", (50, 100), (0, 1))],
+        expires_at=1_700_000_000.0,
+    )
+
+
+def edge_assign(document, unit_id):
+    """Assign cohorts using only the published document, as an edge worker
+    would.
+    """
+    spec = document["hash"]
+
+    def bucket(salt, n):
+        message = spec["message"].format(salt=salt, unit_id=unit_id).encode()
+        digest = hashlib.new(spec["algorithm"], message).digest()
+        return int.from_bytes(digest[: spec["digest_bytes"]], spec["byteorder"]) % n
+
+    skipped = set()
+    for layer in document["layers"]:
+        point = bucket(layer["uuid"], document["layer_buckets"])
+        selected = next(
+            (
+                uuid
+                for upper_bound, uuid in zip(layer["upper_bounds"], layer["split_tests"])
+                if upper_bound > point
+            ),
+            None,
+        )
+        skipped.update(uuid for uuid in layer["split_tests"] if uuid and uuid != selected)
+
+    assignments = {}
+    for split_test in document["split_tests"]:
+        if split_test["uuid"] in skipped:
+            continue
+        point = bucket(split_test["uuid"], sum(c["weight"] for c in split_test["cohorts"]))
+        cumulative_weight = 0
+        for cohort in split_test["cohorts"]:
+            cumulative_weight += cohort["weight"]
+            if cumulative_weight > point:
+                assignments[split_test["uuid"]] = cohort["uuid"]
+                break
+    return assignments
+
+
+def middleware_assign(snapshot, unit_id):
+    middleware = SplitTestMiddleware(lambda request: None)
+
+    class Request:
+        COOKIES = {"dst_uid": unit_id}
+
+        class user:
+            is_authenticated = False
+
+    return {
+        split_test_uuid: middleware.pick_cohort_uuid(snapshot, split_test_uuid, unit_id)
+        for split_test_uuid in middleware.get_eligible_split_test_uuids(Request(), snapshot)
+    }
+
+
+def test_build_document():
+    """Test that the document describes the snapshot and is JSON."""
+    snapshot = make_snapshot()
+
+    document = json.loads(json.dumps(build_document(snapshot)))
+
+    assert document["version"] == snapshot.version
+    assert document["expires_at"] == 1_700_000_000.0
+    assert document["cookies"]["unit_id"] == "dst_uid"
+    assert document["cookies"]["cohort_prefix"] == "dst:"
+    assert document["split_tests"][0] == {
+        "uuid": "split-test-one",
+        "slug": "one",
+        "targeting": [],
+        "cohorts": [
+            {"uuid": "cohort-one", "slug": "control", "weight": 3},
+            {"uuid": "cohort-two", "slug": "variant", "weight": 1},
+        ],
+    }
+    assert document["layers"] == [
+        {
+            "uuid": "layer",
+            "upper_bounds": [50, 100],
+            "split_tests": ["split-test-one", "split-test-two"],
+        }
+    ]
+
+
+def test_document_assignments_match_middleware():
+    """Test that following the document assigns every user to the same
+    split tests and cohorts as the middleware.
+    """
+    snapshot = make_snapshot()
+    document = json.loads(json.dumps(build_document(snapshot)))
+
+    for unit_id in (f"user-{i}" for i in range(200)):
+        assert edge_assign(document, unit_id) == middleware_assign(snapshot, unit_id)
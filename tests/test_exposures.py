@@ -0,0 +1,279 @@
+import io
+import json
+import os
+import socket
+import subprocess
+import threading
+import time
+import uuid
+
+import pytest
+
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.contrib.sites.models import Site
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+
+from split_tests.exposures import (
+    DatabaseExposureSink,
+    ExposureBuffer,
+    ExposureEvent,
+    JSONLinesExposureSink,
+    is_sampled,
+    read_exposure_file,
+)
+from split_tests.middleware import SplitTestMiddleware
+from split_tests.models import Cohort, Exposure, SplitTest
+
+
+class ListSink:
+    """A sink which keeps the batches written to it, and the threads which
+    wrote them.
+    """
+
+    batches = []
+    threads = []
+
+    def write(self, events):
+        self.threads.append(threading.current_thread())
+        self.batches.append(list(events))
+
+
+@pytest.fixture
+def list_sink():
+    ListSink.batches = []
+    ListSink.threads = []
+    return ListSink
+
+
+def wait_for_batches(sink, count, timeout=5.0):
+    """Wait for the background thread to write `count` batches to the sink."""
+    deadline = time.monotonic() + timeout
+    while len(sink.batches) < count and time.monotonic() < deadline:
+        time.sleep(0.001)
+    return sink.batches
+
+
+@pytest.fixture
+def cohort():
+    split_test = SplitTest.objects.create(
+        name="Test", slug="test", site=Site.objects.get_current(), is_active=True
+    )
+    return Cohort.objects.create(
+        split_test=split_test, name="Control", slug="control", weight=1, is_active=True
+    )
+
+
+def make_event(cohort_uuid="cohort", unit_id="unit"):
+    return ExposureEvent(str(cohort_uuid), None, unit_id, 1_700_000_000.0)
+
+
+def test_buffer_flushes_full_batches(list_sink):
+    """Test that exposures are written once a batch is full, by a background
+    thread rather than the one which added them.
+    """
+    buffer = ExposureBuffer(list_sink(), batch_size=2, flush_interval=60)
+
+    buffer.add(make_event(unit_id="one"))
+    assert list_sink.batches == []
+    buffer.add(make_event(unit_id="two"))
+
+    assert wait_for_batches(list_sink, 1) == [
+        [make_event(unit_id="one"), make_event(unit_id="two")]
+    ]
+    assert list_sink.threads[0] is not threading.current_thread()
+
+
+def test_buffer_flushes_old_exposures(list_sink):
+    """Test that exposures aren't kept for longer than the flush interval,
+    even if no more are added.
+    """
+    buffer = ExposureBuffer(list_sink(), batch_size=100, flush_interval=0.01)
+
+    buffer.add(make_event(unit_id="one"))
+    assert wait_for_batches(list_sink, 1) == [[make_event(unit_id="one")]]
+
+    buffer.add(make_event(unit_id="two"))
+    assert list_sink.batches == [[make_event(unit_id="one")]]
+    assert wait_for_batches(list_sink, 2)[1] == [make_event(unit_id="two")]
+
+
+def test_buffer_flush_without_exposures(list_sink):
+    """Test that an empty buffer writes nothing."""
+    ExposureBuffer(list_sink()).flush()
+
+    assert list_sink.batches == []
+
+
+@pytest.mark.django_db
+def test_database_sink(cohort, django_assert_num_queries):
+    """Test that exposures are bulk inserted, skipping deleted cohorts."""
+    with django_assert_num_queries(2):
+        DatabaseExposureSink().write([make_event(cohort.uuid), make_event(uuid.uuid4())])
+
+    exposure = Exposure.objects.get()
+    assert exposure.cohort == cohort
+    assert exposure.unit_id == "unit"
+    assert exposure.exposed_at.timestamp() == 1_700_000_000.0
+
+
+def test_json_lines_sink_rotates_files(tmp_path):
+    """Test that a file is completed once it's full or the sink is closed."""
+    sink = JSONLinesExposureSink(tmp_path, max_bytes=100)
+
+    sink.write([make_event(unit_id="one")])
+    assert list(tmp_path.glob("*.jsonl")) == []
+    sink.write([make_event(unit_id="two")])
+    sink.write([make_event(unit_id="three")])
+    sink.close()
+
+    paths = sorted(tmp_path.glob("*.jsonl"))
+    assert len(paths) == 2
+    assert list(tmp_path.glob("*.part")) == []
+    assert [event.unit_id for path in paths for event in read_exposure_file(path)] == [
+        "one",
+        "two",
+        "three",
+    ]
+
+
+def test_json_lines_sink_rotates_old_files(tmp_path):
+    """Test that a file is completed once it's been open for `max_age`
+    seconds, whether or not more exposures are written.
+    """
+    sink = JSONLinesExposureSink(tmp_path, max_age=60)
+
+    sink.write([make_event(unit_id="one")])
+    sink.rotate_if_due()
+    assert list(tmp_path.glob("*.jsonl")) == []
+    sink.max_age = 0
+    sink.rotate_if_due()
+    assert len(list(tmp_path.glob("*.jsonl"))) == 1
+
+    sink.write([make_event(unit_id="two")])
+    assert len(list(tmp_path.glob("*.jsonl"))) == 2
+    assert list(tmp_path.glob("*.part")) == []
+
+
+def test_buffer_rotates_idle_sinks(tmp_path):
+    """Test that the background thread completes old files while no
+    exposures are being logged.
+    """
+    sink = JSONLinesExposureSink(tmp_path, max_age=60)
+    buffer = ExposureBuffer(sink, flush_interval=0.01)
+    sink.write([make_event(unit_id="one")])
+    buffer.ensure_started()
+
+    sink.max_age = 0
+
+    deadline = time.monotonic() + 5.0
+    while list(tmp_path.glob("*.part")) and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert list(tmp_path.glob("*.part")) == []
+
+
+@pytest.mark.django_db
+def test_load_exposures_command(cohort, tmp_path):
+    """Test that completed files are imported and deleted, leaving files
+    which are still being written.
+    """
+    sink = JSONLinesExposureSink(tmp_path)
+    sink.write([make_event(cohort.uuid, "one"), make_event(cohort.uuid, "two")])
+    sink.close()
+    partial_path = tmp_path / "exposures-other.jsonl.part"
+    partial_path.write_text(json.dumps(make_event(cohort.uuid, "three")._asdict()) + "\n")
+    stdout = io.StringIO()
+
+    call_command("load_exposures", str(tmp_path), stdout=stdout)
+
+    assert sorted(Exposure.objects.values_list("unit_id", flat=True)) == ["one", "two"]
+    assert list(tmp_path.iterdir()) == [partial_path]
+    assert "Imported 2 exposure(s)" in stdout.getvalue()
+
+
+@pytest.mark.django_db
+def test_load_exposures_command_imports_abandoned_files(cohort, tmp_path):
+    """Test that partial files whose process on this host no longer exists
+    are completed and imported, ignoring a partly written last line, while
+    those of running processes and other hosts are left alone.
+    """
+    child = subprocess.Popen(["true"])
+    child.wait()
+    dead_pid = child.pid
+    line = json.dumps(make_event(cohort.uuid, "abandoned")._asdict()) + "\n"
+    hostname = socket.gethostname()
+    abandoned_path = tmp_path / f"exposures-{hostname}-{dead_pid}-1.jsonl.part"
+    abandoned_path.write_text(line + line[:10])
+    running_path = tmp_path / f"exposures-{hostname}-{os.getpid()}-1.jsonl.part"
+    running_path.write_text(line)
+    other_host_path = tmp_path / f"exposures-other-host-{dead_pid}-1.jsonl.part"
+    other_host_path.write_text(line)
+
+    call_command("load_exposures", str(tmp_path), stdout=io.StringIO())
+
+    assert list(Exposure.objects.values_list("unit_id", flat=True)) == ["abandoned"]
+    assert sorted(tmp_path.iterdir()) == sorted([running_path, other_host_path])
+
+
+@override_settings(DJANGO_SPLIT_TESTS={"EXPOSURE_SAMPLE_RATES": {"sampled": 0.5, "none": 0}})
+def test_is_sampled():
+    """Test that the sample rate of each split test is respected."""
+    unit_ids = [f"unit-{i}" for i in range(1_000)]
+
+    sampled = sum(is_sampled("uuid", "sampled", unit_id) for unit_id in unit_ids)
+
+    assert 400 < sampled < 600
+    assert not any(is_sampled("uuid", "none", unit_id) for unit_id in unit_ids)
+    assert all(is_sampled("uuid", "other", unit_id) for unit_id in unit_ids)
+
+
+def make_request(session_key=None):
+    request = RequestFactory().get("/")
+    if session_key is not None:
+        request.COOKIES["sessionid"] = session_key
+    SessionMiddleware(lambda req: None).process_request(request)
+    request.user = AnonymousUser()
+    return request
+
+
+@pytest.mark.django_db
+@override_settings(
+    DJANGO_SPLIT_TESTS={"EXPOSURE_SINK": "tests.test_exposures.ListSink", "EXPOSURE_BATCH_SIZE": 1}
+)
+def test_middleware_logs_exposures_once_per_session(cohort, list_sink):
+    """Test that reading a cohort from the slug map logs a single exposure per
+    session, and that requests which don't read it log none.
+    """
+
+    def view(request):
+        assert request.user.split_test_slug_map["test"] == "control"
+        assert request.user.split_test_slug_map.get("test") == "control"
+        return HttpResponse()
+
+    middleware = SplitTestMiddleware(view)
+    request = make_request()
+    middleware(request)
+    request.session.save()
+
+    assert len(wait_for_batches(list_sink, 1)) == 1
+    [event] = list_sink.batches[0]
+    assert event.cohort_uuid == str(cohort.uuid)
+    assert event.unit_id == request.split_test_unit_id
+    assert event.user_id is None
+
+    middleware(make_request(request.session.session_key))
+    SplitTestMiddleware(lambda request: HttpResponse())(make_request())
+
+    assert len(list_sink.batches) == 1
+
+
+@pytest.mark.django_db
+def test_middleware_without_exposure_logging(cohort):
+    """Test that the slug map is a plain dict when exposures aren't logged."""
+    request = make_request()
+
+    SplitTestMiddleware(lambda request: HttpResponse())(request)
+
+    assert type(request.user.split_test_slug_map) is dict
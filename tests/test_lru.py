@@ -0,0 +1,56 @@
+from split_tests.lru import LRUCache
+
+
+def test_lru_cache_get_and_set():
+    """Test that values can be set and read back."""
+    lru = LRUCache(2)
+    lru.set("a", 1)
+
+    assert lru.get("a") == 1
+    assert lru.get("b") is None
+    assert lru.get("b", "default") == "default"
+
+
+def test_lru_cache_evicts_least_recently_used():
+    """Test that the least recently used entry is evicted when full."""
+    lru = LRUCache(2)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    lru.get("a")
+
+    lru.set("c", 3)
+
+    assert len(lru) == 2
+    assert lru.get("a") == 1
+    assert lru.get("b") is None
+    assert lru.get("c") == 3
+
+
+def test_lru_cache_expires_entries(monkeypatch):
+    """Test that entries expire `ttl` seconds after they're set."""
+    now = 100.0
+    monkeypatch.setattr("split_tests.lru.time.monotonic", lambda: now)
+    lru = LRUCache(2, ttl=10)
+    lru.set("a", 1)
+
+    now = 109.0
+    assert lru.get("a") == 1
+
+    now = 110.0
+    assert lru.get("a") is None
+    assert len(lru) == 0
+
+
+def test_lru_cache_delete_and_clear():
+    """Test that entries can be removed individually or all at once."""
+    lru = LRUCache(3)
+    lru.set("a", 1)
+    lru.set("b", 2)
+
+    lru.delete("a")
+    lru.delete("missing")
+    assert lru.get("a") is None
+    assert lru.get("b") == 2
+
+    lru.clear()
+    assert len(lru) == 0
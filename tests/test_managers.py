@@ -1,17 +1,32 @@
+import time
+
+from datetime import timedelta
+
 import pytest
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.sites.models import Site
 from django.core.cache import cache
+from django.utils import timezone
 
-from split_tests import cache as cache_config
-from split_tests.models import Cohort, SplitTest
+from split_tests import cache as cache_config, codec
+from split_tests.bucketing import get_bucket, pick_split_test_uuid, pick_weighted
+from split_tests.managers import COHORT_ASSIGNMENT_ORDERING
+from split_tests.models import Assignment, Cohort, Layer, SplitTest
+from split_tests.snapshot import Snapshot
 
 
 User = get_user_model()
 
 
+def set_cached_snapshot(snapshot):
+    """Store a snapshot in the cache as another process would have."""
+    cache.set(cache_config.SNAPSHOT_KEY, codec.encode(snapshot))
+    cache.set(cache_config.SNAPSHOT_VERSION_KEY, snapshot.version)
+    SplitTest.cache.local_snapshot = None
+
+
 @pytest.mark.django_db
 def test_cache_manager_update_excludes_inactive_split_tests():
     """Test that inactive split tests and their cohorts are excluded from the
@@ -32,19 +47,13 @@ def test_cache_manager_update_excludes_inactive_split_tests():
         is_active=True,
     )
 
-    (
-        split_test_active_uuids,
-        split_test_uuid_slug_map,
-        cohort_active_uuids,
-        cohort_uuid_slug_map,
-        cohort_uuid_split_test_uuid_map,
-    ) = SplitTest.cache.update()
+    snapshot = SplitTest.cache.update()
 
-    assert str(inactive_split_test.uuid) not in split_test_active_uuids
-    assert str(inactive_split_test.uuid) not in split_test_uuid_slug_map
-    assert str(active_cohort.uuid) not in cohort_active_uuids
-    assert str(active_cohort.uuid) not in cohort_uuid_slug_map
-    assert str(active_cohort.uuid) not in cohort_uuid_split_test_uuid_map
+    assert str(inactive_split_test.uuid) not in snapshot.split_test_active_uuids
+    assert str(inactive_split_test.uuid) not in snapshot.split_test_uuid_slug_map
+    assert str(active_cohort.uuid) not in snapshot.cohort_active_uuids
+    assert str(active_cohort.uuid) not in snapshot.cohort_uuid_slug_map
+    assert str(active_cohort.uuid) not in snapshot.cohort_uuid_split_test_uuid_map
 
 
 @pytest.mark.django_db
@@ -67,19 +76,13 @@ def test_cache_manager_update_excludes_other_sites_split_tests():
         is_active=True,
     )
 
-    (
-        split_test_active_uuids,
-        split_test_uuid_slug_map,
-        cohort_active_uuids,
-        cohort_uuid_slug_map,
-        cohort_uuid_split_test_uuid_map,
-    ) = SplitTest.cache.update()
+    snapshot = SplitTest.cache.update()
 
-    assert str(split_test.uuid) not in split_test_active_uuids
-    assert str(split_test.uuid) not in split_test_uuid_slug_map
-    assert str(cohort.uuid) not in cohort_active_uuids
-    assert str(cohort.uuid) not in cohort_uuid_slug_map
-    assert str(cohort.uuid) not in cohort_uuid_split_test_uuid_map
+    assert str(split_test.uuid) not in snapshot.split_test_active_uuids
+    assert str(split_test.uuid) not in snapshot.split_test_uuid_slug_map
+    assert str(cohort.uuid) not in snapshot.cohort_active_uuids
+    assert str(cohort.uuid) not in snapshot.cohort_uuid_slug_map
+    assert str(cohort.uuid) not in snapshot.cohort_uuid_split_test_uuid_map
 
 
 @pytest.mark.django_db
@@ -93,19 +96,13 @@ def test_cache_manager_update_excludes_split_tests_with_no_cohorts():
         is_active=True,
     )
 
-    (
-        split_test_active_uuids,
-        split_test_uuid_slug_map,
-        cohort_active_uuids,
-        cohort_uuid_slug_map,
-        cohort_uuid_split_test_uuid_map,
-    ) = SplitTest.cache.update()
+    snapshot = SplitTest.cache.update()
 
-    assert str(split_test.uuid) not in split_test_active_uuids
-    assert str(split_test.uuid) not in split_test_uuid_slug_map
-    assert cohort_active_uuids == set()
-    assert cohort_uuid_slug_map == {}
-    assert cohort_uuid_split_test_uuid_map == {}
+    assert str(split_test.uuid) not in snapshot.split_test_active_uuids
+    assert str(split_test.uuid) not in snapshot.split_test_uuid_slug_map
+    assert snapshot.cohort_active_uuids == set()
+    assert snapshot.cohort_uuid_slug_map == {}
+    assert snapshot.cohort_uuid_split_test_uuid_map == {}
 
 
 @pytest.mark.django_db
@@ -128,19 +125,13 @@ def test_cache_manager_update_excludes_split_tests_with_no_active_cohorts():
         is_active=False,
     )
 
-    (
-        split_test_active_uuids,
-        split_test_uuid_slug_map,
-        cohort_active_uuids,
-        cohort_uuid_slug_map,
-        cohort_uuid_split_test_uuid_map,
-    ) = SplitTest.cache.update()
+    snapshot = SplitTest.cache.update()
 
-    assert str(split_test.uuid) not in split_test_active_uuids
-    assert str(split_test.uuid) not in split_test_uuid_slug_map
-    assert cohort_active_uuids == set()
-    assert cohort_uuid_slug_map == {}
-    assert cohort_uuid_split_test_uuid_map == {}
+    assert str(split_test.uuid) not in snapshot.split_test_active_uuids
+    assert str(split_test.uuid) not in snapshot.split_test_uuid_slug_map
+    assert snapshot.cohort_active_uuids == set()
+    assert snapshot.cohort_uuid_slug_map == {}
+    assert snapshot.cohort_uuid_split_test_uuid_map == {}
 
 
 @pytest.mark.django_db
@@ -176,22 +167,19 @@ def test_cache_manager_update_includes_only_active_cohorts():
         is_active=False,
     )
 
-    (
-        split_test_active_uuids,
-        split_test_uuid_slug_map,
-        cohort_active_uuids,
-        cohort_uuid_slug_map,
-        cohort_uuid_split_test_uuid_map,
-    ) = SplitTest.cache.update()
+    snapshot = SplitTest.cache.update()
 
-    assert str(split_test.uuid) in split_test_active_uuids
-    assert split_test_uuid_slug_map[str(split_test.uuid)] == split_test.slug
-    assert cohort_active_uuids == {str(active_cohort_one.uuid), str(active_cohort_two.uuid)}
-    assert cohort_uuid_slug_map == {
+    assert str(split_test.uuid) in snapshot.split_test_active_uuids
+    assert snapshot.split_test_uuid_slug_map[str(split_test.uuid)] == split_test.slug
+    assert snapshot.cohort_active_uuids == {
+        str(active_cohort_one.uuid),
+        str(active_cohort_two.uuid),
+    }
+    assert snapshot.cohort_uuid_slug_map == {
         str(active_cohort_one.uuid): active_cohort_one.slug,
         str(active_cohort_two.uuid): active_cohort_two.slug,
     }
-    assert cohort_uuid_split_test_uuid_map == {
+    assert snapshot.cohort_uuid_split_test_uuid_map == {
         str(active_cohort_one.uuid): str(split_test.uuid),
         str(active_cohort_two.uuid): str(split_test.uuid),
     }
@@ -216,12 +204,15 @@ def test_split_test_active_uuids_populates_empty_cache():
     )
 
     cache.clear()
-    assert cache.get(cache_config.SPLIT_TEST_ACTIVE_UUIDS_KEY) is None
+    assert cache.get(cache_config.SNAPSHOT_KEY) is None
 
     split_test_active_uuids = SplitTest.cache.split_test_active_uuids()
 
     assert str(split_test.uuid) in split_test_active_uuids
-    assert cache.get(cache_config.SPLIT_TEST_ACTIVE_UUIDS_KEY) == split_test_active_uuids
+    assert (
+        codec.decode(cache.get(cache_config.SNAPSHOT_KEY)).split_test_active_uuids
+        == split_test_active_uuids
+    )
 
 
 @pytest.mark.django_db
@@ -243,12 +234,15 @@ def test_cohort_active_uuids_populates_empty_cache():
     )
 
     cache.clear()
-    assert cache.get(cache_config.COHORT_ACTIVE_UUIDS_KEY) is None
+    assert cache.get(cache_config.SNAPSHOT_KEY) is None
 
     cohort_active_uuids = SplitTest.cache.cohort_active_uuids()
 
     assert str(cohort.uuid) in cohort_active_uuids
-    assert cache.get(cache_config.COHORT_ACTIVE_UUIDS_KEY) == cohort_active_uuids
+    assert (
+        codec.decode(cache.get(cache_config.SNAPSHOT_KEY)).cohort_active_uuids
+        == cohort_active_uuids
+    )
 
 
 @pytest.mark.django_db
@@ -256,13 +250,13 @@ def test_split_test_active_uuids_returns_cached_value():
     """Test that split_test_active_uuids returns the cached value without
     recomputing.
     """
-    cached_uuids = {"split_test"}
-    cache.set(cache_config.SPLIT_TEST_ACTIVE_UUIDS_KEY, cached_uuids)
+    cached_snapshot = Snapshot.from_rows([("split_test", "slug")])
+    set_cached_snapshot(cached_snapshot)
 
     split_test_active_uuids = SplitTest.cache.split_test_active_uuids()
 
-    assert split_test_active_uuids == cached_uuids
-    assert cache.get(cache_config.SPLIT_TEST_ACTIVE_UUIDS_KEY) == cached_uuids
+    assert split_test_active_uuids == {"split_test"}
+    assert codec.decode(cache.get(cache_config.SNAPSHOT_KEY)) == cached_snapshot
 
 
 @pytest.mark.django_db
@@ -270,13 +264,13 @@ def test_cohort_active_uuids_returns_cached_value():
     """Test that cohort_active_uuids returns the cached value without
     recomputing.
     """
-    cached_uuids = {"uuid"}
-    cache.set(cache_config.COHORT_ACTIVE_UUIDS_KEY, cached_uuids)
+    cached_snapshot = Snapshot.from_rows([("split_test", "slug")], [("uuid", "slug", 0, 1)])
+    set_cached_snapshot(cached_snapshot)
 
     cohort_active_uuids = SplitTest.cache.cohort_active_uuids()
 
-    assert cohort_active_uuids == cached_uuids
-    assert cache.get(cache_config.COHORT_ACTIVE_UUIDS_KEY) == cached_uuids
+    assert cohort_active_uuids == {"uuid"}
+    assert codec.decode(cache.get(cache_config.SNAPSHOT_KEY)) == cached_snapshot
 
 
 @pytest.mark.django_db
@@ -298,12 +292,15 @@ def test_split_test_uuid_slug_map_populates_empty_cache():
     )
 
     cache.clear()
-    assert cache.get(cache_config.SPLIT_TEST_UUID_SLUG_MAP_KEY) is None
+    assert cache.get(cache_config.SNAPSHOT_KEY) is None
 
     split_test_uuid_slug_map = SplitTest.cache.split_test_uuid_slug_map()
 
     assert split_test_uuid_slug_map[str(split_test.uuid)] == split_test.slug
-    assert cache.get(cache_config.SPLIT_TEST_UUID_SLUG_MAP_KEY) == split_test_uuid_slug_map
+    assert (
+        codec.decode(cache.get(cache_config.SNAPSHOT_KEY)).split_test_uuid_slug_map
+        == split_test_uuid_slug_map
+    )
 
 
 @pytest.mark.django_db
@@ -311,13 +308,13 @@ def test_split_test_uuid_slug_map_returns_cached_value():
     """Test that split_test_uuid_slug_map returns the cached value without
     recomputing.
     """
-    cached_map = {"uuid": "slug"}
-    cache.set(cache_config.SPLIT_TEST_UUID_SLUG_MAP_KEY, cached_map)
+    cached_snapshot = Snapshot.from_rows([("uuid", "slug")])
+    set_cached_snapshot(cached_snapshot)
 
     split_test_uuid_slug_map = SplitTest.cache.split_test_uuid_slug_map()
 
-    assert split_test_uuid_slug_map == cached_map
-    assert cache.get(cache_config.SPLIT_TEST_UUID_SLUG_MAP_KEY) == cached_map
+    assert split_test_uuid_slug_map == {"uuid": "slug"}
+    assert codec.decode(cache.get(cache_config.SNAPSHOT_KEY)) == cached_snapshot
 
 
 @pytest.mark.django_db
@@ -339,12 +336,15 @@ def test_cohort_uuid_slug_map_populates_empty_cache():
     )
 
     cache.clear()
-    assert cache.get(cache_config.COHORT_UUID_SLUG_MAP_KEY) is None
+    assert cache.get(cache_config.SNAPSHOT_KEY) is None
 
     cohort_uuid_slug_map = SplitTest.cache.cohort_uuid_slug_map()
 
     assert cohort_uuid_slug_map[str(cohort.uuid)] == cohort.slug
-    assert cache.get(cache_config.COHORT_UUID_SLUG_MAP_KEY) == cohort_uuid_slug_map
+    assert (
+        codec.decode(cache.get(cache_config.SNAPSHOT_KEY)).cohort_uuid_slug_map
+        == cohort_uuid_slug_map
+    )
 
 
 @pytest.mark.django_db
@@ -352,13 +352,13 @@ def test_cohort_uuid_slug_map_returns_cached_value():
     """Test that cohort_uuid_slug_map returns the cached value without
     recomputing.
     """
-    cached_map = {"uuid": "slug"}
-    cache.set(cache_config.COHORT_UUID_SLUG_MAP_KEY, cached_map)
+    cached_snapshot = Snapshot.from_rows([("split-test-uuid", "slug")], [("uuid", "slug", 0, 1)])
+    set_cached_snapshot(cached_snapshot)
 
     cohort_uuid_slug_map = SplitTest.cache.cohort_uuid_slug_map()
 
-    assert cohort_uuid_slug_map == cached_map
-    assert cache.get(cache_config.COHORT_UUID_SLUG_MAP_KEY) == cached_map
+    assert cohort_uuid_slug_map == {"uuid": "slug"}
+    assert codec.decode(cache.get(cache_config.SNAPSHOT_KEY)) == cached_snapshot
 
 
 @pytest.mark.django_db
@@ -382,13 +382,13 @@ def test_cohort_uuid_split_test_uuid_map_populates_empty_cache():
     )
 
     cache.clear()
-    assert cache.get(cache_config.COHORT_UUID_SPLIT_TEST_UUID_MAP_KEY) is None
+    assert cache.get(cache_config.SNAPSHOT_KEY) is None
 
     cohort_uuid_split_test_uuid_map = SplitTest.cache.cohort_uuid_split_test_uuid_map()
 
     assert cohort_uuid_split_test_uuid_map[str(cohort.uuid)] == str(split_test.uuid)
     assert (
-        cache.get(cache_config.COHORT_UUID_SPLIT_TEST_UUID_MAP_KEY)
+        codec.decode(cache.get(cache_config.SNAPSHOT_KEY)).cohort_uuid_split_test_uuid_map
         == cohort_uuid_split_test_uuid_map
     )
 
@@ -398,13 +398,13 @@ def test_cohort_uuid_split_test_uuid_map_returns_cached_value():
     """Test that cohort_uuid_split_test_uuid_map returns the cached value
     without recomputing.
     """
-    cached_map = {"uuid": "split-test-uuid"}
-    cache.set(cache_config.COHORT_UUID_SPLIT_TEST_UUID_MAP_KEY, cached_map)
+    cached_snapshot = Snapshot.from_rows([("split-test-uuid", "slug")], [("uuid", "slug", 0, 1)])
+    set_cached_snapshot(cached_snapshot)
 
     cohort_uuid_split_test_uuid_map = SplitTest.cache.cohort_uuid_split_test_uuid_map()
 
-    assert cohort_uuid_split_test_uuid_map == cached_map
-    assert cache.get(cache_config.COHORT_UUID_SPLIT_TEST_UUID_MAP_KEY) == cached_map
+    assert cohort_uuid_split_test_uuid_map == {"uuid": "split-test-uuid"}
+    assert codec.decode(cache.get(cache_config.SNAPSHOT_KEY)) == cached_snapshot
 
 
 @pytest.fixture
@@ -460,6 +460,22 @@ def test_get_for_user_and_split_test_with_new_assignment_for_authenticated_user(
     assert Cohort.objects.get(users=user, split_test=split_test, is_active=True) == cohort_two
 
 
+@pytest.mark.django_db
+def test_get_for_user_and_split_test_assigns_authenticated_users_deterministically(
+    setup_get_for_user_and_split_test_tests,
+):
+    """Test that an authenticated user's cohort is picked from the hash of
+    their primary key, so that it doesn't depend on which process assigns it.
+    """
+    user, split_test, cohort_one, _ = setup_get_for_user_and_split_test_tests
+    cohort_one.weight = 1
+    cohort_one.save()
+    cohorts = list(Cohort.objects.order_by(*COHORT_ASSIGNMENT_ORDERING))
+    index = pick_weighted(str(split_test.uuid), str(user.pk), [c.weight for c in cohorts])
+
+    assert Cohort.objects.get_for_user_and_split_test(user, split_test.uuid) == cohorts[index]
+
+
 @pytest.mark.django_db
 def test_get_for_user_and_split_test_with_existing_active_assignment_for_authenticated_user(
     setup_get_for_user_and_split_test_tests,
@@ -601,3 +617,377 @@ def test_get_for_user_and_split_test_with_only_zero_weighted_cohorts(
     # Ensure that zero-weighted cohorts are not returned.
     selected_cohort = Cohort.objects.get_for_user_and_split_test(user, split_test.uuid)
     assert selected_cohort is None
+
+
+@pytest.mark.django_db
+def test_cache_manager_update_builds_layer_bucket_ranges():
+    """Test that layered split tests are given consecutive bucket ranges and
+    that inactive split tests keep theirs.
+    """
+    current_site = Site.objects.get_current()
+    layer = Layer.objects.create(name="Layer", slug="layer", site=current_site)
+    split_tests = []
+    for index, (is_active, layer_allocation) in enumerate(((True, 30), (False, 20), (True, 50))):
+        split_test = SplitTest.objects.create(
+            name=f"Split Test {index}",
+            slug=f"split-test-{index}",
+            site=current_site,
+            is_active=is_active,
+            layer=layer,
+            layer_allocation=layer_allocation,
+        )
+        Cohort.objects.create(
+            split_test=split_test,
+            name="Cohort",
+            slug="cohort",
+            weight=1,
+            is_active=True,
+        )
+        split_tests.append(split_test)
+
+    snapshot = SplitTest.cache.update()
+
+    assert snapshot.layer_bucket_ranges == {
+        str(layer.uuid): (
+            (30, 50, 100),
+            (str(split_tests[0].uuid), None, str(split_tests[2].uuid)),
+        )
+    }
+    assert codec.decode(cache.get(cache_config.SNAPSHOT_KEY)) == snapshot
+
+
+@pytest.mark.django_db
+def test_layered_split_tests_keep_their_buckets():
+    """Test that changing or deleting the first split test in a layer doesn't
+    move the users of the next one.
+    """
+    current_site = Site.objects.get_current()
+    layer = Layer.objects.create(name="Layer", slug="layer", site=current_site)
+    split_tests = []
+    for index in range(2):
+        split_test = SplitTest.objects.create(
+            name=f"Split Test {index}",
+            slug=f"split-test-{index}",
+            site=current_site,
+            is_active=True,
+            layer=layer,
+            layer_allocation=50,
+        )
+        Cohort.objects.create(
+            split_test=split_test, name="Cohort", slug="cohort", weight=1, is_active=True
+        )
+        split_tests.append(split_test)
+
+    def get_users(split_test):
+        bucket_ranges = SplitTest.cache.snapshot().layer_bucket_ranges[str(layer.uuid)]
+        return {
+            user_id
+            for user_id in range(1_000)
+            if pick_split_test_uuid(bucket_ranges, get_bucket(str(layer.uuid), user_id))
+            == str(split_test.uuid)
+        }
+
+    users = get_users(split_tests[1])
+    assert len(users) > 400
+
+    split_tests[0].layer_allocation = 20
+    split_tests[0].save()
+    assert get_users(split_tests[1]) == users
+
+    split_tests[0].layer = None
+    split_tests[0].save()
+    assert get_users(split_tests[1]) == users
+
+    split_tests[0].layer = layer
+    split_tests[0].save()
+    assert split_tests[0].layer_bucket_start == 0
+    assert get_users(split_tests[1]) == users
+
+
+@pytest.mark.django_db
+def test_snapshot_reuses_local_snapshot_while_version_is_unchanged():
+    """Test that the snapshot is only decoded again when its version in the
+    cache changes.
+    """
+    cached_snapshot = Snapshot.from_rows([("split_test", "slug")])
+    set_cached_snapshot(cached_snapshot)
+
+    snapshot = SplitTest.cache.snapshot()
+    assert snapshot == cached_snapshot
+    assert SplitTest.cache.snapshot() is snapshot
+
+    new_snapshot = Snapshot.from_rows([("new_split_test", "slug")])
+    set_cached_snapshot(new_snapshot)
+    SplitTest.cache.local_snapshot = snapshot
+
+    assert SplitTest.cache.snapshot() == new_snapshot
+
+
+@pytest.mark.django_db
+def test_snapshot_rebuilds_unsupported_cached_snapshot():
+    """Test that a snapshot which can't be decoded is rebuilt."""
+    cache.set(cache_config.SNAPSHOT_KEY, b"unsupported")
+    cache.set(cache_config.SNAPSHOT_VERSION_KEY, "version")
+    SplitTest.cache.local_snapshot = None
+
+    snapshot = SplitTest.cache.snapshot()
+
+    assert snapshot == Snapshot()
+    assert cache.get(cache_config.SNAPSHOT_VERSION_KEY) == snapshot.version
+
+
+@pytest.fixture
+def assigned_user():
+    """Create a user assigned to a cohort of an active split test."""
+    user = User.objects.create_user(username="user", password="password")
+    split_test = SplitTest.objects.create(
+        name="Test", slug="test", site=Site.objects.get_current(), is_active=True
+    )
+    cohort = Cohort.objects.create(
+        split_test=split_test, name="Control", slug="control", weight=1, is_active=True
+    )
+    Assignment.objects.create(cohort=cohort, user=user)
+    return user
+
+
+@pytest.fixture
+def local_user_assignments(settings):
+    """Enable the in-process cache of user assignments for a test."""
+    settings.DJANGO_SPLIT_TESTS = {"USER_ASSIGNMENTS_LRU_SIZE": 10}
+    Cohort.objects._local_user_assignments = None
+    yield
+    Cohort.objects._local_user_assignments = None
+
+
+@pytest.mark.django_db
+def test_get_user_assignments(assigned_user, django_assert_num_queries):
+    """Test that a user's assignments are read in one query and then cached."""
+    cohort = Cohort.objects.get(users=assigned_user)
+    other_cohort = Cohort.objects.create(
+        split_test=cohort.split_test, name="Variant", slug="variant", weight=1, is_active=False
+    )
+    Assignment.objects.create(cohort=other_cohort, user=assigned_user)
+
+    with django_assert_num_queries(1):
+        assignments = Cohort.objects.get_user_assignments(assigned_user)
+    with django_assert_num_queries(0):
+        assert Cohort.objects.get_user_assignments(assigned_user) == assignments
+
+    assert assignments == {str(cohort.split_test.uuid): (str(cohort.uuid), str(other_cohort.uuid))}
+
+
+@pytest.mark.django_db
+def test_get_user_assignments_is_invalidated_by_changes(assigned_user):
+    """Test that creating or deleting an assignment invalidates the cache."""
+    assignment = Assignment.objects.get(user=assigned_user)
+    Cohort.objects.get_user_assignments(assigned_user)
+
+    assignment.delete()
+    assert Cohort.objects.get_user_assignments(assigned_user) == {}
+
+    Assignment.objects.create(cohort=assignment.cohort, user=assigned_user)
+    assert Cohort.objects.get_user_assignments(assigned_user) == {
+        str(assignment.cohort.split_test.uuid): (str(assignment.cohort.uuid),)
+    }
+
+
+@pytest.mark.django_db
+def test_get_user_assignments_uses_local_cache(assigned_user, local_user_assignments):
+    """Test that the in-process cache is used when enabled and invalidated
+    along with the shared cache.
+    """
+    assignment = Assignment.objects.get(user=assigned_user)
+    assignments = Cohort.objects.get_user_assignments(assigned_user)
+    cache.clear()
+
+    assert Cohort.objects.get_user_assignments(assigned_user) is assignments
+
+    assignment.delete()
+    assert Cohort.objects.get_user_assignments(assigned_user) == {}
+
+
+@pytest.mark.django_db
+def test_cache_manager_update_respects_schedule():
+    """Test that split tests are only included between their start and end
+    times, and that the snapshot expires at the next of them.
+    """
+    now = timezone.now()
+    current_site = Site.objects.get_current()
+    split_tests = {}
+    for slug, starts_at, ends_at in (
+        ("started", now - timedelta(hours=1), None),
+        ("scheduled", now + timedelta(hours=2), None),
+        ("ending", None, now + timedelta(hours=1)),
+        ("ended", None, now - timedelta(hours=1)),
+    ):
+        split_tests[slug] = SplitTest.objects.create(
+            name=slug.title(),
+            slug=slug,
+            site=current_site,
+            is_active=True,
+            starts_at=starts_at,
+            ends_at=ends_at,
+        )
+        Cohort.objects.create(
+            split_test=split_tests[slug], name="Control", slug="control", weight=1, is_active=True
+        )
+
+    snapshot = SplitTest.cache.update()
+
+    assert set(snapshot.split_test_uuid_slug_map.values()) == {"started", "ending"}
+    assert snapshot.expires_at == split_tests["ending"].ends_at.timestamp()
+
+
+@pytest.mark.django_db
+def test_snapshot_rebuilds_expired_snapshot():
+    """Test that an expired snapshot is rebuilt rather than used."""
+    split_test = SplitTest.objects.create(
+        name="Test", slug="test", site=Site.objects.get_current(), is_active=True
+    )
+    Cohort.objects.create(
+        split_test=split_test, name="Control", slug="control", weight=1, is_active=True
+    )
+    set_cached_snapshot(Snapshot.from_rows(expires_at=time.time() - 1))
+
+    snapshot = SplitTest.cache.snapshot()
+
+    assert str(split_test.uuid) in snapshot.split_test_active_uuids
+    assert snapshot.expires_at is None
+
+
+@pytest.fixture
+def bulk_users(setup_get_for_user_and_split_test_tests):
+    user, split_test, cohort_one, cohort_two = setup_get_for_user_and_split_test_tests
+    users = [user, *(User.objects.create_user(username=f"user-{i}") for i in range(4))]
+    return users, split_test, cohort_one, cohort_two
+
+
+@pytest.mark.django_db
+def test_iter_cohort_slugs(bulk_users, django_assert_num_queries):
+    """Test that cohorts are looked up with a single query per chunk, without
+    assigning users.
+    """
+    users, split_test, cohort_one, _ = bulk_users
+    cohort_one.users.add(users[1])
+    user_ids = [user.pk for user in users]
+
+    with django_assert_num_queries(4):
+        results = list(Cohort.objects.iter_cohort_slugs(user_ids, split_test.uuid, chunk_size=2))
+
+    assert results == [
+        (user_ids[0], None),
+        (user_ids[1], "cohort-one"),
+        (user_ids[2], None),
+        (user_ids[3], None),
+        (user_ids[4], None),
+    ]
+    assert Assignment.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_iter_cohort_slugs_assigns_missing_users(bulk_users, django_assert_num_queries):
+    """Test that missing users are assigned in a single bulk insert per chunk,
+    to the cohort the middleware would pick for them.
+    """
+    users, split_test, cohort_one, cohort_two = bulk_users
+    cohort_one.users.add(users[1])
+    user_ids = [user.pk for user in users]
+
+    with django_assert_num_queries(3):
+        results = list(
+            Cohort.objects.iter_cohort_slugs(user_ids, split_test.uuid, chunk_size=5, assign=True)
+        )
+
+    assert results == [
+        (user_ids[0], "cohort-two"),
+        (user_ids[1], "cohort-one"),
+        (user_ids[2], "cohort-two"),
+        (user_ids[3], "cohort-two"),
+        (user_ids[4], "cohort-two"),
+    ]
+    assert Assignment.objects.filter(cohort=cohort_two).count() == 4
+    for user in users:
+        assert (
+            Cohort.objects.get_for_user_and_split_test(user, split_test.uuid).slug
+            == dict(results)[user.pk]
+        )
+
+
+@pytest.mark.django_db
+def test_iter_cohort_slugs_invalidates_cached_assignments(bulk_users):
+    """Test that bulk assignments invalidate the users' cached assignments."""
+    users, split_test, _, cohort_two = bulk_users
+    assert Cohort.objects.get_user_assignments(users[0]) == {}
+
+    list(Cohort.objects.iter_cohort_slugs([users[0].pk], split_test.uuid, assign=True))
+
+    assert Cohort.objects.get_user_assignments(users[0]) == {
+        str(split_test.uuid): (str(cohort_two.uuid),)
+    }
+
+
+@pytest.mark.django_db
+def test_iter_cohort_slugs_inactive_split_test(bulk_users, django_assert_num_queries):
+    """Test that users aren't looked up for a split test without active
+    cohorts.
+    """
+    users, split_test, _, _ = bulk_users
+    split_test.is_active = False
+    split_test.save()
+
+    with django_assert_num_queries(1):
+        results = list(
+            Cohort.objects.iter_cohort_slugs([users[0].pk], split_test.uuid, assign=True)
+        )
+
+    assert results == [(users[0].pk, None)]
+
+
+@pytest.mark.django_db
+def test_iter_cohort_slugs_only_assigns_eligible_users(bulk_users):
+    """Test that users are only assigned to a layered split test if their
+    bucket in the layer selects it, as in the middleware.
+    """
+    users, split_test, _, _ = bulk_users
+    layer = Layer.objects.create(name="Layer", slug="layer", site=split_test.site)
+    split_test.layer = layer
+    split_test.layer_allocation = 50
+    split_test.save()
+    user_ids = [user.pk for user in users]
+
+    results = dict(Cohort.objects.iter_cohort_slugs(user_ids, split_test.uuid, assign=True))
+
+    for user_id in user_ids:
+        is_eligible = get_bucket(str(layer.uuid), str(user_id)) < 50
+        assert (results[user_id] is not None) == is_eligible
+    assert Assignment.objects.count() == sum(slug is not None for slug in results.values())
+
+
+@pytest.mark.django_db
+def test_iter_cohort_slugs_doesnt_assign_split_tests_outside_the_snapshot(bulk_users):
+    """Test that users aren't assigned to a split test which hasn't started."""
+    users, split_test, _, _ = bulk_users
+    split_test.starts_at = timezone.now() + timedelta(days=1)
+    split_test.save()
+
+    results = list(Cohort.objects.iter_cohort_slugs([users[0].pk], split_test.uuid, assign=True))
+
+    assert results == [(users[0].pk, None)]
+    assert not Assignment.objects.exists()
+
+
+@pytest.mark.django_db
+def test_iter_cohort_slugs_refuses_to_assign_targeted_split_tests(bulk_users):
+    """Test that assigning users to a split test with targeting rules raises
+    a ValueError, but looking them up doesn't.
+    """
+    users, split_test, _, _ = bulk_users
+    split_test.targeting = [{"user": "is_staff"}]
+    split_test.save()
+
+    with pytest.raises(ValueError):
+        Cohort.objects.iter_cohort_slugs([users[0].pk], split_test.uuid, assign=True)
+
+    assert list(Cohort.objects.iter_cohort_slugs([users[0].pk], split_test.uuid)) == [
+        (users[0].pk, None)
+    ]
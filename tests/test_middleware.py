@@ -1,13 +1,16 @@
 import pytest
 
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.sessions.middleware import SessionMiddleware
 from django.contrib.sites.models import Site
 from django.http import HttpResponse
 from django.test import RequestFactory
 
+from split_tests.bucketing import get_bucket
 from split_tests.middleware import SplitTestMiddleware
-from split_tests.models import Cohort, SplitTest
+from split_tests.models import Cohort, Layer, SplitTest
+from split_tests.snapshot import Snapshot
 
 
 @pytest.fixture
@@ -55,16 +58,31 @@ def make_middleware():
     return SplitTestMiddleware(lambda request: HttpResponse())
 
 
-def set_cached_maps(middleware, split_tests, cohorts):
-    middleware.split_test_active_uuids = {str(split_test.uuid) for split_test in split_tests}
-    middleware.split_test_uuid_slug_map = {
-        str(split_test.uuid): split_test.slug for split_test in split_tests
-    }
-    middleware.cohort_active_uuids = {str(cohort.uuid) for cohort in cohorts}
-    middleware.cohort_uuid_slug_map = {str(cohort.uuid): cohort.slug for cohort in cohorts}
-    middleware.cohort_uuid_split_test_uuid_map = {
-        str(cohort.uuid): str(cohort.split_test.uuid) for cohort in cohorts
-    }
+def make_snapshot(split_tests, cohorts, layer_bucket_ranges=None):
+    split_test_indexes = {str(split_test.uuid): i for i, split_test in enumerate(split_tests)}
+    return Snapshot.from_rows(
+        [(str(split_test.uuid), split_test.slug) for split_test in split_tests],
+        [
+            (
+                str(cohort.uuid),
+                cohort.slug,
+                split_test_indexes[str(cohort.split_test.uuid)],
+                cohort.weight,
+            )
+            for cohort in cohorts
+            if str(cohort.split_test.uuid) in split_test_indexes
+        ],
+        [
+            (
+                layer_uuid,
+                upper_bounds,
+                tuple(
+                    split_test_indexes.get(split_test_uuid) for split_test_uuid in split_test_uuids
+                ),
+            )
+            for layer_uuid, (upper_bounds, split_test_uuids) in (layer_bucket_ranges or {}).items()
+        ],
+    )
 
 
 def get_session_cohort_uuid(request, session_key, split_test_uuid):
@@ -89,12 +107,14 @@ def test_get_cohort_uuid_from_cookie_rejects_mismatched_split_test(
     )
 
     middleware = make_middleware()
-    set_cached_maps(middleware, [split_test_one, split_test_two], [cohort_two])
+    snapshot = make_snapshot([split_test_one, split_test_two], [cohort_two])
     request = make_request()
     cookie_key = f"{middleware.cookie_prefix}{split_test_one.uuid}"
     request.COOKIES[cookie_key] = str(cohort_two.uuid)
 
-    assert middleware.get_cohort_uuid_from_cookie(request, str(split_test_one.uuid)) is None
+    assert (
+        middleware.get_cohort_uuid_from_cookie(request, snapshot, str(split_test_one.uuid)) is None
+    )
 
 
 @pytest.mark.django_db
@@ -105,12 +125,14 @@ def test_get_cohort_uuid_from_cookie_accepts_matching_split_test(
     cohort = cohort_factory(split_test)
 
     middleware = make_middleware()
-    set_cached_maps(middleware, [split_test], [cohort])
+    snapshot = make_snapshot([split_test], [cohort])
     request = make_request()
     cookie_key = f"{middleware.cookie_prefix}{split_test.uuid}"
     request.COOKIES[cookie_key] = str(cohort.uuid)
 
-    assert middleware.get_cohort_uuid_from_cookie(request, str(split_test.uuid)) == str(cohort.uuid)
+    assert middleware.get_cohort_uuid_from_cookie(request, snapshot, str(split_test.uuid)) == str(
+        cohort.uuid
+    )
 
 
 @pytest.mark.django_db
@@ -119,10 +141,10 @@ def test_check_cohort_assignments_creates_session_key(split_test_factory, cohort
     cohort = cohort_factory(split_test)
 
     middleware = make_middleware()
-    set_cached_maps(middleware, [split_test], [cohort])
+    snapshot = make_snapshot([split_test], [cohort])
     request = make_request()
 
-    middleware.check_cohort_assignments(request)
+    middleware.check_cohort_assignments(request, snapshot)
 
     assert middleware.session_key in request.session
 
@@ -143,14 +165,14 @@ def test_remove_inactive_split_tests_from_session_removes_inactive_uuid(
     )
 
     middleware = make_middleware()
-    middleware.split_test_active_uuids = {str(active_split_test.uuid)}
+    snapshot = make_snapshot([active_split_test], [])
     request = make_request()
     request.session[middleware.session_key] = {
         str(inactive_split_test.uuid): "stale",
         str(active_split_test.uuid): "active",
     }
 
-    middleware.remove_inactive_split_tests_from_session(request)
+    middleware.remove_inactive_split_tests_from_session(request, snapshot)
 
     assert str(inactive_split_test.uuid) not in request.session[middleware.session_key]
 
@@ -161,12 +183,12 @@ def test_check_cohort_assignments_sets_session_from_cookie(split_test_factory, c
     cohort = cohort_factory(split_test)
 
     middleware = make_middleware()
-    set_cached_maps(middleware, [split_test], [cohort])
+    snapshot = make_snapshot([split_test], [cohort])
     request = make_request()
     cookie_key = f"{middleware.cookie_prefix}{split_test.uuid}"
     request.COOKIES[cookie_key] = str(cohort.uuid)
 
-    middleware.check_cohort_assignments(request)
+    middleware.check_cohort_assignments(request, snapshot)
 
     assert get_session_cohort_uuid(request, middleware.session_key, split_test.uuid) == str(
         cohort.uuid
@@ -179,10 +201,10 @@ def test_check_cohort_assignments_assigns_cohort_when_no_cookie(split_test_facto
     cohort = cohort_factory(split_test)
 
     middleware = make_middleware()
-    set_cached_maps(middleware, [split_test], [cohort])
+    snapshot = make_snapshot([split_test], [cohort])
     request = make_request()
 
-    middleware.check_cohort_assignments(request)
+    middleware.check_cohort_assignments(request, snapshot)
 
     assert get_session_cohort_uuid(request, middleware.session_key, split_test.uuid) == str(
         cohort.uuid
@@ -195,11 +217,11 @@ def test_update_user_split_test_cohort_slug_map_sets_slug_map(split_test_factory
     cohort = cohort_factory(split_test)
 
     middleware = make_middleware()
-    set_cached_maps(middleware, [split_test], [cohort])
+    snapshot = make_snapshot([split_test], [cohort])
     request = make_request()
     request.session[middleware.session_key] = {str(split_test.uuid): str(cohort.uuid)}
 
-    middleware.update_user_split_test_cohort_slug_map(request)
+    middleware.update_user_split_test_cohort_slug_map(request, snapshot)
 
     assert request.user.split_test_slug_map == {split_test.slug: cohort.slug}
 
@@ -209,7 +231,7 @@ def test_update_split_test_cookies_no_session_key_no_cookies_set():
     request = make_request()
     response = HttpResponse()
 
-    middleware.update_split_test_cookies(request, response)
+    middleware.update_split_test_cookies(request, response, Snapshot())
 
     assert len(response.cookies) == 0
 
@@ -224,7 +246,7 @@ def test_update_split_test_cookies_sets_cookie_for_assignment(split_test_factory
     request.session[middleware.session_key] = {str(split_test.uuid): str(cohort.uuid)}
     response = HttpResponse()
 
-    middleware.update_split_test_cookies(request, response)
+    middleware.update_split_test_cookies(request, response, Snapshot())
 
     cookie_key = f"{middleware.cookie_prefix}{split_test.uuid}"
     assert response.cookies[cookie_key].value == str(cohort.uuid)
@@ -238,6 +260,296 @@ def test_update_split_test_cookies_deletes_stale_cookie():
     request.COOKIES[stale_key] = "stale"
     response = HttpResponse()
 
-    middleware.update_split_test_cookies(request, response)
+    middleware.update_split_test_cookies(request, response, Snapshot())
 
     assert response.cookies[stale_key]["max-age"] == 0
+
+
+@pytest.mark.django_db
+def test_check_cohort_assignments_assigns_one_split_test_per_layer(
+    split_test_factory, cohort_factory
+):
+    layer = Layer.objects.create(name="Layer", slug="layer", site=Site.objects.get_current())
+    split_test_one = split_test_factory(
+        name="Split Test One", slug="split-test-one", layer=layer, layer_allocation=50
+    )
+    split_test_two = split_test_factory(
+        name="Split Test Two", slug="split-test-two", layer=layer, layer_allocation=50
+    )
+    unlayered_split_test = split_test_factory(name="Unlayered", slug="unlayered")
+    cohorts = [
+        cohort_factory(split_test)
+        for split_test in (split_test_one, split_test_two, unlayered_split_test)
+    ]
+
+    middleware = make_middleware()
+    snapshot = make_snapshot(
+        [split_test_one, split_test_two, unlayered_split_test],
+        cohorts,
+        layer_bucket_ranges={
+            str(layer.uuid): ((50, 100), (str(split_test_one.uuid), str(split_test_two.uuid)))
+        },
+    )
+    request = make_request()
+    # Assign a stale cohort from the layer to ensure that it is removed if
+    # the user isn't eligible for it.
+    request.session[middleware.session_key] = {
+        str(split_test_one.uuid): str(cohorts[0].uuid),
+        str(split_test_two.uuid): str(cohorts[1].uuid),
+    }
+
+    middleware.check_cohort_assignments(request, snapshot)
+
+    bucket = get_bucket(str(layer.uuid), request.split_test_unit_id)
+    selected_split_test = split_test_one if bucket < 50 else split_test_two
+    assert set(request.session[middleware.session_key]) == {
+        str(selected_split_test.uuid),
+        str(unlayered_split_test.uuid),
+    }
+
+
+@pytest.mark.django_db
+def test_get_unit_id_uses_primary_key_for_authenticated_users(django_user_model):
+    middleware = make_middleware()
+    request = make_request()
+    request.user = django_user_model.objects.create_user(username="user")
+
+    assert middleware.get_unit_id(request) == str(request.user.pk)
+
+
+def test_get_unit_id_uses_cookie_for_anonymous_users():
+    middleware = make_middleware()
+    request = make_request()
+    request.COOKIES[middleware.unit_id_cookie_name] = "unit-id"
+
+    assert middleware.get_unit_id(request) == "unit-id"
+
+
+def test_update_split_test_cookies_sets_new_unit_id_cookie():
+    middleware = make_middleware()
+    request = make_request()
+    unit_id = middleware.get_unit_id(request)
+    response = HttpResponse()
+
+    middleware.update_split_test_cookies(request, response, Snapshot())
+
+    assert response.cookies[middleware.unit_id_cookie_name].value == unit_id
+
+
+def run_middleware(middleware, session_key=None, cookies=None, user=None):
+    request = RequestFactory().get("/")
+    if session_key is not None:
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = session_key
+    request.COOKIES.update(cookies or {})
+    SessionMiddleware(lambda req: None).process_request(request)
+    request.user = user or AnonymousUser()
+    response = middleware(request)
+    if request.session.modified:
+        request.session.save()
+    return request, response
+
+
+def get_cohort_cookies(middleware, response):
+    return {
+        key: morsel.value
+        for key, morsel in response.cookies.items()
+        if key.startswith(middleware.cookie_prefix)
+    }
+
+
+@pytest.mark.django_db
+def test_returning_session_skips_checking_assignments(
+    split_test_factory, cohort_factory, django_assert_num_queries, monkeypatch
+):
+    split_test = split_test_factory()
+    cohort = cohort_factory(split_test)
+    middleware = make_middleware()
+    request, response = run_middleware(middleware)
+    cookies = {key: morsel.value for key, morsel in response.cookies.items()}
+
+    assert request.session[middleware.session_state_key][0] == SplitTest.cache.snapshot().version
+
+    def fail(request):
+        raise AssertionError("The assignments were checked.")
+
+    monkeypatch.setattr(middleware, "get_eligible_split_test_uuids", fail)
+    with django_assert_num_queries(0):
+        request, response = run_middleware(middleware, request.session.session_key, cookies)
+
+    assert request.user.split_test_slug_map == {split_test.slug: cohort.slug}
+    assert not request.session.modified
+    assert get_cohort_cookies(middleware, response) == {}
+
+
+@pytest.mark.django_db
+def test_returning_session_is_checked_when_snapshot_changes(split_test_factory, cohort_factory):
+    split_test = split_test_factory()
+    cohort_factory(split_test)
+    middleware = make_middleware()
+    request, _ = run_middleware(middleware)
+
+    new_split_test = split_test_factory(slug="new-split-test")
+    new_cohort = cohort_factory(new_split_test)
+    request, _ = run_middleware(middleware, request.session.session_key)
+
+    assert request.user.split_test_slug_map[new_split_test.slug] == new_cohort.slug
+    assert request.session[middleware.session_state_key][0] == SplitTest.cache.snapshot().version
+
+
+@pytest.mark.django_db
+def test_returning_session_is_checked_when_unit_id_changes(
+    split_test_factory, cohort_factory, django_user_model
+):
+    split_test = split_test_factory()
+    cohort_factory(split_test)
+    middleware = make_middleware()
+    request, _ = run_middleware(middleware)
+    user = django_user_model.objects.create_user(username="user")
+
+    request, _ = run_middleware(middleware, request.session.session_key, user=user)
+
+    assert request.session[middleware.session_state_key][1] == str(user.pk)
+
+
+@pytest.mark.django_db
+def test_incomplete_assignments_are_checked_again(split_test_factory, cohort_factory):
+    split_test = split_test_factory()
+    cohort_factory(split_test, weight=0)
+    middleware = make_middleware()
+
+    request, _ = run_middleware(middleware)
+
+    assert middleware.session_state_key not in request.session
+
+
+@pytest.mark.django_db
+def test_targeted_split_tests_are_always_checked(split_test_factory, cohort_factory):
+    split_test = split_test_factory(targeting=[{"cookie": "beta"}])
+    cohort_factory(split_test)
+    middleware = make_middleware()
+    request, _ = run_middleware(middleware, cookies={"beta": "1"})
+    assert split_test.slug in request.user.split_test_slug_map
+
+    request, _ = run_middleware(middleware, request.session.session_key)
+
+    assert request.user.split_test_slug_map == {}
+
+
+@pytest.mark.django_db
+def test_middleware_without_active_split_tests(django_assert_num_queries):
+    SplitTest.cache.snapshot()
+    middleware = make_middleware()
+
+    with django_assert_num_queries(0):
+        request, response = run_middleware(middleware)
+
+    assert request.user.split_test_slug_map == {}
+    assert not request.session.modified
+    assert response.cookies == {}
+
+
+@pytest.mark.django_db
+def test_middleware_clears_assignments_without_active_split_tests(
+    split_test_factory, cohort_factory
+):
+    split_test = split_test_factory()
+    cohort_factory(split_test)
+    middleware = make_middleware()
+    request, response = run_middleware(middleware)
+    cookies = {key: morsel.value for key, morsel in response.cookies.items()}
+
+    split_test.is_active = False
+    split_test.save()
+    request, response = run_middleware(middleware, request.session.session_key, cookies)
+
+    assert request.session[middleware.session_key] == {}
+    assert middleware.session_state_key not in request.session
+    assert request.user.split_test_slug_map == {}
+    cookie_key = f"{middleware.cookie_prefix}{split_test.uuid}"
+    assert response.cookies[cookie_key]["max-age"] == 0
+
+
+@pytest.mark.django_db
+def test_update_split_test_cookies_skips_unchanged_cookies(split_test_factory, cohort_factory):
+    split_test = split_test_factory()
+    cohort = cohort_factory(split_test)
+    other_cohort = cohort_factory(split_test, slug="other")
+    other_split_test = split_test_factory(slug="other")
+
+    middleware = make_middleware()
+    request = make_request()
+    request.session[middleware.session_key] = {
+        str(split_test.uuid): str(cohort.uuid),
+        str(other_split_test.uuid): str(other_cohort.uuid),
+    }
+    request.COOKIES[f"{middleware.cookie_prefix}{split_test.uuid}"] = str(cohort.uuid)
+    request.COOKIES[f"{middleware.cookie_prefix}{other_split_test.uuid}"] = str(cohort.uuid)
+    response = HttpResponse()
+
+    middleware.update_split_test_cookies(request, response, Snapshot())
+
+    assert get_cohort_cookies(middleware, response) == {
+        f"{middleware.cookie_prefix}{other_split_test.uuid}": str(other_cohort.uuid)
+    }
+
+
+@pytest.mark.django_db
+def test_split_tests_without_layer_buckets_are_excluded(split_test_factory, cohort_factory):
+    layer = Layer.objects.create(name="Layer", slug="layer", site=Site.objects.get_current())
+    split_test = split_test_factory(layer=layer, layer_allocation=100)
+    unallocated_split_test = split_test_factory(
+        name="Unallocated", slug="unallocated", layer=layer, layer_allocation=0
+    )
+    clipped_split_test = split_test_factory(
+        name="Clipped", slug="clipped", layer=layer, layer_allocation=10
+    )
+    for layered_split_test in (split_test, unallocated_split_test, clipped_split_test):
+        cohort_factory(layered_split_test)
+
+    middleware = make_middleware()
+    for _ in range(20):
+        request, response = run_middleware(middleware)
+        assert set(request.session[middleware.session_key]) == {str(split_test.uuid)}
+
+
+@pytest.mark.django_db
+def test_requests_keep_their_snapshot_while_others_are_handled(
+    split_test_factory, cohort_factory, settings, monkeypatch
+):
+    settings.DJANGO_SPLIT_TESTS = {
+        "EXPOSURE_SINK": "tests.test_exposures.ListSink",
+        "SESSION_COMPACT": True,
+    }
+    split_test = split_test_factory()
+    cohort = cohort_factory(split_test)
+    snapshot = make_snapshot([split_test], [cohort])
+    snapshots = [snapshot, Snapshot()]
+    monkeypatch.setattr(
+        SplitTest.cache,
+        "snapshot",
+        lambda: snapshots.pop(0) if len(snapshots) > 1 else snapshots[0],
+    )
+    cohort_slugs = []
+
+    def view(request):
+        cohort_slugs.append(request.user.split_test_slug_map.get(split_test.slug))
+        return HttpResponse()
+
+    middleware = SplitTestMiddleware(view)
+    get_unit_id = middleware.get_unit_id
+
+    def get_unit_id_meanwhile(request):
+        if not cohort_slugs:
+            # Another thread handles a request with a newer snapshot
+            # meanwhile.
+            run_middleware(middleware)
+        return get_unit_id(request)
+
+    monkeypatch.setattr(middleware, "get_unit_id", get_unit_id_meanwhile)
+    request, response = run_middleware(middleware)
+
+    assert request.session[middleware.session_state_key][0] == snapshot.version
+    assert cohort_slugs == [None, cohort.slug]
+    assert get_cohort_cookies(middleware, response) == {
+        f"{middleware.cookie_prefix}{split_test.uuid}": str(cohort.uuid)
+    }
@@ -1,10 +1,14 @@
+from datetime import timedelta
+
 import pytest
 
 from django.contrib.sites.models import Site
 from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.utils import timezone
 
-from split_tests import cache as cache_config
-from split_tests.models import Cohort, SplitTest
+from split_tests import cache as cache_config, codec
+from split_tests.models import Cohort, Layer, SplitTest
 
 
 @pytest.mark.django_db
@@ -25,17 +29,15 @@ def test_split_test_save_refreshes_cache():
     )
 
     cache.clear()
-    assert cache.get(cache_config.SPLIT_TEST_ACTIVE_UUIDS_KEY) is None
-    assert cache.get(cache_config.SPLIT_TEST_UUID_SLUG_MAP_KEY) is None
-    assert cache.get(cache_config.COHORT_ACTIVE_UUIDS_KEY) is None
-    assert cache.get(cache_config.COHORT_UUID_SLUG_MAP_KEY) is None
+    assert cache.get(cache_config.SNAPSHOT_KEY) is None
 
     split_test.save()
 
-    split_test_active_uuids = cache.get(cache_config.SPLIT_TEST_ACTIVE_UUIDS_KEY)
-    split_test_uuid_slug_map = cache.get(cache_config.SPLIT_TEST_UUID_SLUG_MAP_KEY)
-    cohort_active_uuids = cache.get(cache_config.COHORT_ACTIVE_UUIDS_KEY)
-    cohort_uuid_slug_map = cache.get(cache_config.COHORT_UUID_SLUG_MAP_KEY)
+    snapshot = codec.decode(cache.get(cache_config.SNAPSHOT_KEY))
+    split_test_active_uuids = snapshot.split_test_active_uuids
+    split_test_uuid_slug_map = snapshot.split_test_uuid_slug_map
+    cohort_active_uuids = snapshot.cohort_active_uuids
+    cohort_uuid_slug_map = snapshot.cohort_uuid_slug_map
     assert str(split_test.uuid) in split_test_active_uuids
     assert split_test_uuid_slug_map[str(split_test.uuid)] == split_test.slug
     assert str(cohort.uuid) in cohort_active_uuids
@@ -59,10 +61,11 @@ def test_split_test_delete_refreshes_cache():
         is_active=True,
     )
 
-    split_test_active_uuids = cache.get(cache_config.SPLIT_TEST_ACTIVE_UUIDS_KEY)
-    split_test_uuid_slug_map = cache.get(cache_config.SPLIT_TEST_UUID_SLUG_MAP_KEY)
-    cohort_active_uuids = cache.get(cache_config.COHORT_ACTIVE_UUIDS_KEY)
-    cohort_uuid_slug_map = cache.get(cache_config.COHORT_UUID_SLUG_MAP_KEY)
+    snapshot = codec.decode(cache.get(cache_config.SNAPSHOT_KEY))
+    split_test_active_uuids = snapshot.split_test_active_uuids
+    split_test_uuid_slug_map = snapshot.split_test_uuid_slug_map
+    cohort_active_uuids = snapshot.cohort_active_uuids
+    cohort_uuid_slug_map = snapshot.cohort_uuid_slug_map
     assert str(split_test.uuid) in split_test_active_uuids
     assert split_test_uuid_slug_map[str(split_test.uuid)] == split_test.slug
     assert str(cohort.uuid) in cohort_active_uuids
@@ -70,10 +73,11 @@ def test_split_test_delete_refreshes_cache():
 
     split_test.delete()
 
-    split_test_active_uuids = cache.get(cache_config.SPLIT_TEST_ACTIVE_UUIDS_KEY)
-    split_test_uuid_slug_map = cache.get(cache_config.SPLIT_TEST_UUID_SLUG_MAP_KEY)
-    cohort_active_uuids = cache.get(cache_config.COHORT_ACTIVE_UUIDS_KEY)
-    cohort_uuid_slug_map = cache.get(cache_config.COHORT_UUID_SLUG_MAP_KEY)
+    snapshot = codec.decode(cache.get(cache_config.SNAPSHOT_KEY))
+    split_test_active_uuids = snapshot.split_test_active_uuids
+    split_test_uuid_slug_map = snapshot.split_test_uuid_slug_map
+    cohort_active_uuids = snapshot.cohort_active_uuids
+    cohort_uuid_slug_map = snapshot.cohort_uuid_slug_map
     assert str(split_test.uuid) not in split_test_active_uuids
     assert str(split_test.uuid) not in split_test_uuid_slug_map
     assert str(cohort.uuid) not in cohort_active_uuids
@@ -98,17 +102,15 @@ def test_cohort_save_refreshes_cache():
     )
 
     cache.clear()
-    assert cache.get(cache_config.SPLIT_TEST_ACTIVE_UUIDS_KEY) is None
-    assert cache.get(cache_config.SPLIT_TEST_UUID_SLUG_MAP_KEY) is None
-    assert cache.get(cache_config.COHORT_ACTIVE_UUIDS_KEY) is None
-    assert cache.get(cache_config.COHORT_UUID_SLUG_MAP_KEY) is None
+    assert cache.get(cache_config.SNAPSHOT_KEY) is None
 
     cohort.save()
 
-    split_test_active_uuids = cache.get(cache_config.SPLIT_TEST_ACTIVE_UUIDS_KEY)
-    split_test_uuid_slug_map = cache.get(cache_config.SPLIT_TEST_UUID_SLUG_MAP_KEY)
-    cohort_active_uuids = cache.get(cache_config.COHORT_ACTIVE_UUIDS_KEY)
-    cohort_uuid_slug_map = cache.get(cache_config.COHORT_UUID_SLUG_MAP_KEY)
+    snapshot = codec.decode(cache.get(cache_config.SNAPSHOT_KEY))
+    split_test_active_uuids = snapshot.split_test_active_uuids
+    split_test_uuid_slug_map = snapshot.split_test_uuid_slug_map
+    cohort_active_uuids = snapshot.cohort_active_uuids
+    cohort_uuid_slug_map = snapshot.cohort_uuid_slug_map
     assert str(split_test.uuid) in split_test_active_uuids
     assert split_test_uuid_slug_map[str(split_test.uuid)] == split_test.slug
     assert str(cohort.uuid) in cohort_active_uuids
@@ -132,10 +134,11 @@ def test_cohort_delete_refreshes_cache():
         is_active=True,
     )
 
-    split_test_active_uuids = cache.get(cache_config.SPLIT_TEST_ACTIVE_UUIDS_KEY)
-    split_test_uuid_slug_map = cache.get(cache_config.SPLIT_TEST_UUID_SLUG_MAP_KEY)
-    cohort_active_uuids = cache.get(cache_config.COHORT_ACTIVE_UUIDS_KEY)
-    cohort_uuid_slug_map = cache.get(cache_config.COHORT_UUID_SLUG_MAP_KEY)
+    snapshot = codec.decode(cache.get(cache_config.SNAPSHOT_KEY))
+    split_test_active_uuids = snapshot.split_test_active_uuids
+    split_test_uuid_slug_map = snapshot.split_test_uuid_slug_map
+    cohort_active_uuids = snapshot.cohort_active_uuids
+    cohort_uuid_slug_map = snapshot.cohort_uuid_slug_map
     assert str(split_test.uuid) in split_test_active_uuids
     assert split_test_uuid_slug_map[str(split_test.uuid)] == split_test.slug
     assert str(cohort.uuid) in cohort_active_uuids
@@ -143,11 +146,55 @@ def test_cohort_delete_refreshes_cache():
 
     cohort.delete()
 
-    split_test_active_uuids = cache.get(cache_config.SPLIT_TEST_ACTIVE_UUIDS_KEY)
-    split_test_uuid_slug_map = cache.get(cache_config.SPLIT_TEST_UUID_SLUG_MAP_KEY)
-    cohort_active_uuids = cache.get(cache_config.COHORT_ACTIVE_UUIDS_KEY)
-    cohort_uuid_slug_map = cache.get(cache_config.COHORT_UUID_SLUG_MAP_KEY)
+    snapshot = codec.decode(cache.get(cache_config.SNAPSHOT_KEY))
+    split_test_active_uuids = snapshot.split_test_active_uuids
+    split_test_uuid_slug_map = snapshot.split_test_uuid_slug_map
+    cohort_active_uuids = snapshot.cohort_active_uuids
+    cohort_uuid_slug_map = snapshot.cohort_uuid_slug_map
     assert str(split_test.uuid) not in split_test_active_uuids
     assert str(split_test.uuid) not in split_test_uuid_slug_map
     assert str(cohort.uuid) not in cohort_active_uuids
     assert str(cohort.uuid) not in cohort_uuid_slug_map
+
+
+def test_split_test_clean_rejects_end_before_start():
+    """Test that a split test can't end before it starts."""
+    now = timezone.now()
+    split_test = SplitTest(starts_at=now, ends_at=now - timedelta(hours=1))
+
+    with pytest.raises(ValidationError) as exc_info:
+        split_test.clean()
+
+    assert "ends_at" in exc_info.value.error_dict
+
+
+@pytest.mark.django_db
+def test_split_test_clean_validates_layer_allocation():
+    """Test that a layered split test needs an allocation, and that a layer
+    can't be allocated more than all of its buckets, nor the same bucket
+    twice.
+    """
+    site = Site.objects.get_current()
+    layer = Layer.objects.create(name="Layer", slug="layer", site=site)
+    first_split_test = SplitTest.objects.create(
+        name="One", slug="one", site=site, layer=layer, layer_allocation=70
+    )
+
+    for layer_allocation in (0, 31):
+        split_test = SplitTest(
+            name="Two", slug="two", site=site, layer=layer, layer_allocation=layer_allocation
+        )
+        with pytest.raises(ValidationError) as exc_info:
+            split_test.clean()
+        assert "layer_allocation" in exc_info.value.error_dict
+
+    SplitTest(name="Two", slug="two", site=site, layer=layer, layer_allocation=30).clean()
+
+    SplitTest.objects.create(name="Two", slug="two", site=site, layer=layer, layer_allocation=30)
+    split_test = SplitTest.objects.get(pk=first_split_test.pk)
+    split_test.layer_allocation = 71
+    with pytest.raises(ValidationError) as exc_info:
+        split_test.clean()
+    assert "layer_allocation" in exc_info.value.error_dict
+    split_test.layer_allocation = 50
+    split_test.clean()
@@ -0,0 +1,59 @@
+import pytest
+
+from django.contrib.auth import get_user_model
+from django.contrib.sites.models import Site
+from django.db import connection
+
+from split_tests.models import Assignment, Cohort, SplitTest
+from split_tests.paginator import EstimatedCountPaginator, estimate_count
+
+
+User = get_user_model()
+
+
+@pytest.fixture
+def assignments():
+    split_test = SplitTest.objects.create(
+        name="Test", slug="test", site=Site.objects.get_current(), is_active=True
+    )
+    cohort = Cohort.objects.create(
+        split_test=split_test, name="Control", slug="control", weight=1, is_active=True
+    )
+    for i in range(5):
+        Assignment.objects.create(cohort=cohort, user=User.objects.create(username=f"user-{i}"))
+    return Assignment.objects.order_by("-id")
+
+
+@pytest.mark.django_db
+def test_estimated_count_paginator_counts_small_lists_exactly(
+    assignments, django_assert_num_queries
+):
+    """Test that lists within the limit are counted exactly in one query."""
+    paginator = EstimatedCountPaginator(assignments, 2)
+
+    with django_assert_num_queries(1):
+        assert paginator.count == 5
+    assert paginator.num_pages == 3
+
+
+@pytest.mark.django_db
+def test_estimated_count_paginator_caps_large_lists(assignments):
+    """Test that lists beyond the limit are capped when the database can't
+    estimate their size.
+    """
+    paginator = EstimatedCountPaginator(assignments, 2)
+    paginator.exact_count_limit = 3
+
+    assert paginator.count == 3
+    assert list(paginator.page(2)) == list(assignments[2:3])
+
+
+@pytest.mark.django_db
+def test_estimate_count(assignments):
+    """Test that the planner's estimate is only used on PostgreSQL."""
+    estimate = estimate_count(assignments)
+
+    if connection.vendor == "postgresql":
+        assert isinstance(estimate, int)
+    else:
+        assert estimate is None
@@ -0,0 +1,282 @@
+import csv
+import gzip
+
+import pytest
+
+from django.contrib.auth import get_user_model
+from django.contrib.sites.models import Site
+from django.core.management import CommandError, call_command
+
+from split_tests import purge
+from split_tests.models import Assignment, Cohort, Exposure, GoalStatistics, SplitTest
+from split_tests.purge import (
+    ARCHIVE_FIELDS,
+    get_archive_path,
+    purge_assignments,
+    purge_split_test,
+)
+
+
+User = get_user_model()
+
+
+@pytest.fixture
+def split_test_factory():
+    def _create(slug, assignments=3, **kwargs):
+        split_test = SplitTest.objects.create(
+            name=slug.title(), slug=slug, site=Site.objects.get_current(), **kwargs
+        )
+        cohort = Cohort.objects.create(
+            split_test=split_test, name="Control", slug="control", weight=1, is_active=True
+        )
+        for i in range(assignments):
+            user, _ = User.objects.get_or_create(username=f"user-{i}")
+            Assignment.objects.create(cohort=cohort, user=user)
+        return split_test
+
+    return _create
+
+
+def read_archive(path):
+    with gzip.open(path, "rt", newline="") as f:
+        return list(csv.reader(f))
+
+
+@pytest.mark.django_db
+def test_delete_marks_split_test_for_purging(split_test_factory):
+    """Test that deleting a split test deactivates it and marks it for
+    purging, leaving its assignments in place.
+    """
+    split_test = split_test_factory("test", is_active=True)
+
+    split_test.delete()
+
+    split_test.refresh_from_db()
+    assert not split_test.is_active
+    assert split_test.deleted_at is not None
+    assert Assignment.objects.filter(cohort__split_test=split_test).count() == 3
+
+
+@pytest.mark.django_db
+def test_purge_assignments_archives_and_deletes_in_chunks(split_test_factory, tmp_path):
+    """Test that assignments are archived and then deleted in chunks."""
+    split_test = split_test_factory("test", assignments=5)
+    other_split_test = split_test_factory("other", assignments=2)
+    expected_rows = [
+        [str(pk), str(split_test.uuid), str(cohort_uuid), str(user_id), assigned_at.isoformat()]
+        for pk, cohort_uuid, user_id, assigned_at in Assignment.objects.filter(
+            cohort__split_test=split_test
+        )
+        .order_by("pk")
+        .values_list("pk", "cohort__uuid", "user_id", "assigned_at")
+    ]
+
+    deleted = purge_assignments(split_test, archive_dir=tmp_path, chunk_size=2)
+
+    assert deleted == 5
+    assert not Assignment.objects.filter(cohort__split_test=split_test).exists()
+    assert Assignment.objects.filter(cohort__split_test=other_split_test).count() == 2
+    assert read_archive(get_archive_path(tmp_path, split_test)) == [
+        list(ARCHIVE_FIELDS),
+        *expected_rows,
+    ]
+
+
+@pytest.mark.django_db
+def test_purge_assignments_appends_to_an_existing_archive(split_test_factory, tmp_path):
+    """Test that running a purge again appends to the archive, so that an
+    interrupted purge doesn't lose any rows.
+    """
+    split_test = split_test_factory("test", assignments=2)
+    purge_assignments(split_test, archive_dir=tmp_path)
+    Assignment.objects.create(cohort=split_test.cohorts.get(), user=User.objects.first())
+
+    purge_assignments(split_test, archive_dir=tmp_path)
+
+    rows = read_archive(get_archive_path(tmp_path, split_test))
+    assert rows[0] == list(ARCHIVE_FIELDS)
+    assert len(rows) == 4
+
+
+@pytest.mark.django_db
+def test_purge_assignments_doesnt_archive_rows_twice(split_test_factory, tmp_path, monkeypatch):
+    """Test that running an interrupted purge again doesn't archive the rows
+    it archived but didn't delete again.
+    """
+    split_test = split_test_factory("test", assignments=5)
+    delete_rows = purge.delete_rows
+    calls = []
+
+    def interrupt(model, pks, using):
+        calls.append(pks)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        delete_rows(model, pks, using)
+
+    monkeypatch.setattr(purge, "delete_rows", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        purge_assignments(split_test, archive_dir=tmp_path, chunk_size=2)
+    monkeypatch.setattr(purge, "delete_rows", delete_rows)
+
+    deleted = purge_assignments(split_test, archive_dir=tmp_path, chunk_size=2)
+
+    assert deleted == 3
+    rows = read_archive(get_archive_path(tmp_path, split_test))
+    ids = [row[0] for row in rows[1:]]
+    assert len(ids) == 5
+    assert len(set(ids)) == 5
+
+
+@pytest.mark.django_db
+def test_purge_split_tests_command(split_test_factory, tmp_path):
+    """Test that the command purges split tests marked for purging and leaves
+    the others alone.
+    """
+    deleted_split_test = split_test_factory("deleted")
+    deleted_cohort = deleted_split_test.cohorts.get()
+    Exposure.objects.create(cohort=deleted_cohort, unit_id="unit")
+    GoalStatistics.objects.create(cohort=deleted_cohort, goal="signup")
+    deleted_split_test.delete()
+    inactive_split_test = split_test_factory("inactive")
+    active_split_test = split_test_factory("active", is_active=True)
+
+    call_command("purge_split_tests", archive_dir=tmp_path, delay=0)
+
+    assert not SplitTest.objects.filter(pk=deleted_split_test.pk).exists()
+    assert not Exposure.objects.exists()
+    assert not GoalStatistics.objects.exists()
+    assert get_archive_path(tmp_path, deleted_split_test).exists()
+    assert Assignment.objects.filter(cohort__split_test=inactive_split_test).count() == 3
+    assert Assignment.objects.filter(cohort__split_test=active_split_test).count() == 3
+
+
+@pytest.mark.django_db
+def test_purge_split_tests_command_keeps_reactivated_split_tests(split_test_factory):
+    """Test that re-activating a deleted split test cancels its purge, even
+    if it was re-activated without saving the model.
+    """
+    reactivated_split_test = split_test_factory("reactivated")
+    reactivated_split_test.delete()
+    reactivated_split_test.is_active = True
+    reactivated_split_test.save(update_fields=["is_active"])
+    updated_split_test = split_test_factory("updated")
+    updated_split_test.delete()
+    SplitTest.objects.filter(pk=updated_split_test.pk).update(is_active=True)
+
+    reactivated_split_test.refresh_from_db()
+    assert reactivated_split_test.deleted_at is None
+
+    call_command("purge_split_tests", no_archive=True, delay=0)
+
+    for split_test in (reactivated_split_test, updated_split_test):
+        assert Assignment.objects.filter(cohort__split_test=split_test).count() == 3
+
+
+@pytest.mark.django_db
+def test_purge_split_test_keeps_split_test_reactivated_during_purge(split_test_factory):
+    """Test that a split test which is re-activated while its assignments are
+    purged isn't deleted.
+    """
+    split_test = split_test_factory("test")
+    split_test.delete()
+    SplitTest.objects.filter(pk=split_test.pk).update(is_active=True, deleted_at=None)
+
+    purge_split_test(split_test)
+
+    assert SplitTest.objects.filter(pk=split_test.pk).exists()
+
+
+@pytest.mark.django_db
+def test_delete_marks_cohort_for_purging(split_test_factory):
+    """Test that deleting a cohort deactivates it and marks it for purging,
+    leaving its assignments in place, and that re-activating it cancels the
+    purge.
+    """
+    cohort = split_test_factory("test").cohorts.get()
+
+    cohort.delete()
+
+    cohort.refresh_from_db()
+    assert not cohort.is_active
+    assert cohort.deleted_at is not None
+    assert Assignment.objects.filter(cohort=cohort).count() == 3
+
+    cohort.is_active = True
+    cohort.save(update_fields=["is_active"])
+
+    cohort.refresh_from_db()
+    assert cohort.deleted_at is None
+
+
+@pytest.mark.django_db
+def test_purge_split_tests_command_purges_deleted_cohorts(split_test_factory, tmp_path):
+    """Test that the command archives and deletes the assignments of deleted
+    cohorts and then the cohorts, keeping their split tests and other cohorts.
+    """
+    split_test = split_test_factory("test", is_active=True)
+    kept_cohort = split_test.cohorts.get()
+    deleted_cohort = Cohort.objects.create(
+        split_test=split_test, name="Variant", slug="variant", weight=1, is_active=True
+    )
+    Assignment.objects.create(cohort=deleted_cohort, user=User.objects.first())
+    Exposure.objects.create(cohort=deleted_cohort, unit_id="unit")
+    deleted_cohort.delete()
+
+    call_command("purge_split_tests", archive_dir=tmp_path, delay=0)
+
+    assert not Cohort.objects.filter(pk=deleted_cohort.pk).exists()
+    assert not Exposure.objects.exists()
+    assert len(read_archive(get_archive_path(tmp_path, split_test, deleted_cohort))) == 2
+    assert SplitTest.objects.filter(pk=split_test.pk).exists()
+    assert Assignment.objects.filter(cohort=kept_cohort).count() == 3
+
+
+@pytest.mark.django_db
+def test_purge_assignments_invalidates_each_chunk_at_once(
+    split_test_factory, django_assert_num_queries, monkeypatch
+):
+    """Test that each chunk is deleted with a single query and its users'
+    cached assignments are invalidated together.
+    """
+    split_test = split_test_factory("test", assignments=4)
+    invalidated = []
+    monkeypatch.setattr(
+        Cohort.objects,
+        "invalidate_user_assignments",
+        lambda *user_ids: invalidated.append(sorted(user_ids)),
+    )
+    user_ids = list(
+        Assignment.objects.filter(cohort__split_test=split_test)
+        .order_by("pk")
+        .values_list("user_id", flat=True)
+    )
+
+    # A select per chunk and a last one which finds no rows, then a
+    # savepoint, the delete and its release per chunk.
+    with django_assert_num_queries(3 + 2 * 3):
+        purge_assignments(split_test, chunk_size=2)
+
+    assert invalidated == [sorted(user_ids[:2]), sorted(user_ids[2:])]
+
+
+@pytest.mark.django_db
+def test_purge_split_tests_command_with_inactive(split_test_factory):
+    """Test that `--inactive` also purges the assignments of inactive split
+    tests, but keeps the split tests.
+    """
+    inactive_split_test = split_test_factory("inactive")
+    active_split_test = split_test_factory("active", is_active=True)
+
+    call_command("purge_split_tests", no_archive=True, inactive=True, delay=0)
+
+    assert SplitTest.objects.filter(pk=inactive_split_test.pk).exists()
+    assert not Assignment.objects.filter(cohort__split_test=inactive_split_test).exists()
+    assert Assignment.objects.filter(cohort__split_test=active_split_test).count() == 3
+
+
+def test_purge_split_tests_command_requires_archive_choice():
+    """Test that the command refuses to delete assignments without being
+    told whether to archive them.
+    """
+    with pytest.raises(CommandError):
+        call_command("purge_split_tests")
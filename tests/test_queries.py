@@ -0,0 +1,178 @@
+"""Regression tests for the number of queries and the query plans of the
+assignment lookups, which run on every request.
+"""
+
+import pytest
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.contrib.sites.models import Site
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from split_tests.middleware import SplitTestMiddleware
+from split_tests.models import Assignment, Cohort, SplitTest
+
+
+User = get_user_model()
+
+
+@pytest.fixture
+def split_test():
+    split_test = SplitTest.objects.create(
+        name="Split Test", slug="split-test", site=Site.objects.get_current(), is_active=True
+    )
+    for slug, weight in (("control", 1), ("variant", 1), ("inactive", 1)):
+        Cohort.objects.create(
+            split_test=split_test,
+            name=slug.title(),
+            slug=slug,
+            weight=weight,
+            is_active=slug != "inactive",
+        )
+    return split_test
+
+
+@pytest.fixture
+def user():
+    return User.objects.create_user(username="user", password="password")
+
+
+def make_request(user, session_key=None):
+    request = RequestFactory().get("/")
+    if session_key is not None:
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = session_key
+    SessionMiddleware(lambda req: None).process_request(request)
+    request.user = user
+    return request
+
+
+def capture_select(function, *args):
+    """Call the function and return the SQL of the first query it runs, which
+    must be a `SELECT`.
+    """
+    with CaptureQueriesContext(connection) as context:
+        function(*args)
+    sql = context.captured_queries[0]["sql"]
+    assert sql.startswith("SELECT"), sql
+    return sql
+
+
+def explain(sql):
+    """Return the query plan of the SQL, discouraging sequential scans on
+    PostgreSQL so that small test tables are planned as large ones would be.
+    """
+    if connection.vendor == "postgresql":
+        prefix = "EXPLAIN"
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+    elif connection.vendor == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN"
+    else:
+        pytest.skip(f"Query plans aren't checked on {connection.vendor}.")
+    with connection.cursor() as cursor:
+        cursor.execute(f"{prefix} {sql}")
+        return "\n".join(" ".join(map(str, row)) for row in cursor.fetchall())
+
+
+def assert_uses_index(plan, table, index=None):
+    """Assert that the query plan searches `table` through an index (or its
+    primary key) rather than scanning it, and uses `index` if given.
+    """
+    if connection.vendor == "sqlite":
+        lines = [line for line in plan.splitlines() if f" {table} " in f"{line} "]
+        assert lines, plan
+        assert all(f"SEARCH {table} USING" in line for line in lines), plan
+    else:
+        assert f"Seq Scan on {table}" not in plan, plan
+    if index is not None:
+        assert index in plan, plan
+
+
+@pytest.mark.django_db
+def test_get_for_user_and_split_test_assigned_user_queries(
+    split_test, user, django_assert_num_queries
+):
+    """Test that finding an existing assignment takes a single query."""
+    Cohort.objects.get_for_user_and_split_test(user, split_test.uuid)
+
+    with django_assert_num_queries(1):
+        Cohort.objects.get_for_user_and_split_test(user, split_test.uuid)
+
+
+@pytest.mark.django_db
+def test_get_for_user_and_split_test_new_user_queries(split_test, user, django_assert_num_queries):
+    """Test the number of queries needed to assign a new user: the lookup, the
+    cohorts, and a savepoint-wrapped `get_or_create`.
+    """
+    with django_assert_num_queries(6):
+        Cohort.objects.get_for_user_and_split_test(user, split_test.uuid)
+
+
+@pytest.mark.django_db
+def test_get_for_user_and_split_test_anonymous_user_queries(split_test, django_assert_num_queries):
+    """Test that assigning an anonymous user only reads the cohorts."""
+    with django_assert_num_queries(1):
+        Cohort.objects.get_for_user_and_split_test(AnonymousUser(), split_test.uuid)
+
+
+@pytest.mark.django_db
+def test_middleware_repeat_request_queries(split_test, user, django_assert_num_queries):
+    """Test that a request from a user whose assignments are already in their
+    session doesn't query the database.
+    """
+    middleware = SplitTestMiddleware(lambda request: HttpResponse())
+    request = make_request(user)
+    middleware(request)
+    request.session.save()
+    repeat_request = make_request(user, request.session.session_key)
+
+    with django_assert_num_queries(0):
+        middleware(repeat_request)
+
+
+@pytest.mark.django_db
+def test_middleware_new_session_queries(split_test, user, django_assert_num_queries):
+    """Test that a new session for an assigned user reads their assignments
+    in a single query, and none at all once they're cached.
+    """
+    middleware = SplitTestMiddleware(lambda request: HttpResponse())
+    middleware(make_request(user))
+
+    with django_assert_num_queries(1):
+        middleware(make_request(user))
+    with django_assert_num_queries(0):
+        middleware(make_request(user))
+
+
+@pytest.mark.django_db
+def test_assignment_lookup_uses_index(split_test, user):
+    """Test that finding a user's cohort reads the assignments through the
+    covering `(user, cohort, assigned_at)` index.
+    """
+    Cohort.objects.get_for_user_and_split_test(user, split_test.uuid)
+    sql = capture_select(Cohort.objects.get_for_user_and_split_test, user, split_test.uuid)
+
+    plan = explain(sql)
+
+    assert_uses_index(plan, Assignment._meta.db_table, "assignment_user_lookup_idx")
+    assert_uses_index(plan, Cohort._meta.db_table)
+
+
+@pytest.mark.django_db
+def test_cohort_assignment_uses_index(split_test):
+    """Test that choosing a cohort to assign reads the cohorts through an
+    index on their split test.
+    """
+    sql = capture_select(
+        Cohort.objects.get_for_user_and_split_test, AnonymousUser(), split_test.uuid
+    )
+
+    plan = explain(sql)
+
+    assert_uses_index(plan, Cohort._meta.db_table)
+    assert_uses_index(plan, SplitTest._meta.db_table)
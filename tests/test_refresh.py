@@ -0,0 +1,195 @@
+import io
+import time
+
+import pytest
+
+from django.contrib.sites.models import Site
+from django.core.management import CommandError, call_command
+from django.http import HttpResponse
+from django.test import override_settings
+
+from split_tests.middleware import SplitTestMiddleware
+from split_tests.models import Cohort, SplitTest
+from split_tests.refresh import SnapshotRefresher
+from split_tests.snapshot import Snapshot
+
+
+class FakeManager:
+    """Counts the snapshots built, optionally failing to build them."""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.updates = 0
+
+    def update(self):
+        self.updates += 1
+        if self.fail:
+            raise RuntimeError("The database is down.")
+        return Snapshot.from_rows()
+
+
+class FakeRefresher:
+    def __init__(self, running=True):
+        self.running = running
+        self.woken = False
+
+    def ensure_started(self):
+        pass
+
+    def is_running(self):
+        return self.running
+
+    def wake(self):
+        self.woken = True
+
+
+@pytest.fixture
+def refresher():
+    refreshers = []
+
+    def make_refresher(*args, **kwargs):
+        refresher = SnapshotRefresher(*args, **kwargs)
+        refreshers.append(refresher)
+        return refresher
+
+    yield make_refresher
+    for refresher in refreshers:
+        refresher.stop()
+
+
+@pytest.fixture
+def fake_refresher():
+    SplitTest.cache.refresher = FakeRefresher()
+    yield SplitTest.cache.refresher
+    SplitTest.cache.refresher = None
+
+
+def wait_for(condition):
+    for _ in range(100):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError("Timed out.")
+
+
+def test_refresher_rebuilds_in_the_background(refresher):
+    """Test that the snapshot is rebuilt as soon as the refresher starts and
+    whenever it's woken.
+    """
+    manager = FakeManager()
+    snapshot_refresher = refresher(manager, interval=60)
+
+    snapshot_refresher.ensure_started()
+    wait_for(lambda: manager.updates == 1)
+    assert snapshot_refresher.is_running()
+    snapshot_refresher.wake()
+    wait_for(lambda: manager.updates == 2)
+
+    snapshot_refresher.stop()
+    wait_for(lambda: not snapshot_refresher.is_running())
+
+
+@pytest.mark.django_db
+def test_refresher_survives_failures(refresher, caplog):
+    """Test that a failed rebuild is logged and retried."""
+    manager = FakeManager(fail=True)
+    snapshot_refresher = refresher(manager, interval=0.01)
+
+    assert snapshot_refresher.refresh() is None
+    snapshot_refresher.ensure_started()
+    wait_for(lambda: manager.updates >= 3)
+
+    assert snapshot_refresher.is_running()
+    assert "Failed to refresh the split test snapshot." in caplog.text
+
+
+def test_refresher_delay():
+    """Test that the snapshot is rebuilt at its expiry if that's sooner than
+    the interval.
+    """
+    snapshot_refresher = SnapshotRefresher(FakeManager(), interval=60)
+
+    assert snapshot_refresher.get_delay(None) == 60
+    assert snapshot_refresher.get_delay(Snapshot.from_rows()) == 60
+    assert 9 < snapshot_refresher.get_delay(Snapshot.from_rows(expires_at=time.time() + 10)) <= 10
+    assert snapshot_refresher.get_delay(Snapshot.from_rows(expires_at=time.time() - 10)) == 0
+
+
+@pytest.mark.django_db
+def test_snapshot_serves_local_snapshot_while_refreshing(fake_refresher, django_assert_num_queries):
+    """Test that a missing snapshot wakes the refresher rather than being
+    rebuilt by the request.
+    """
+    local_snapshot = Snapshot.from_rows([("a", "test")])
+    SplitTest.cache.local_snapshot = local_snapshot
+
+    with django_assert_num_queries(0):
+        assert SplitTest.cache.snapshot() is local_snapshot
+    assert fake_refresher.woken
+
+
+@pytest.mark.django_db
+def test_snapshot_serves_expired_snapshot_while_refreshing(fake_refresher):
+    """Test that an expired snapshot wakes the refresher and is served until
+    it's rebuilt.
+    """
+    expired_snapshot = Snapshot.from_rows(expires_at=time.time() - 1)
+    SplitTest.cache.set_snapshot(expired_snapshot)
+
+    assert SplitTest.cache.snapshot() is expired_snapshot
+    assert fake_refresher.woken
+
+
+@pytest.mark.django_db
+def test_snapshot_rebuilds_without_running_refresher(fake_refresher):
+    """Test that a request rebuilds the snapshot if the refresher isn't
+    running, or there's no local snapshot to serve meanwhile.
+    """
+    fake_refresher.running = False
+    SplitTest.cache.local_snapshot = Snapshot.from_rows([("a", "test")])
+
+    assert SplitTest.cache.snapshot() == Snapshot.from_rows()
+
+    fake_refresher.running = True
+    SplitTest.cache.store.set(b"unsupported", "0123456789abcdef")
+    SplitTest.cache.local_snapshot = None
+
+    assert SplitTest.cache.snapshot() == Snapshot.from_rows()
+    assert not fake_refresher.woken
+
+
+@override_settings(DJANGO_SPLIT_TESTS={"SNAPSHOT_REFRESH_INTERVAL": 30})
+def test_middleware_creates_refresher():
+    """Test that the middleware sets up a refresher if configured."""
+    try:
+        SplitTestMiddleware(lambda request: HttpResponse())
+
+        assert isinstance(SplitTest.cache.refresher, SnapshotRefresher)
+        assert SplitTest.cache.refresher.interval == 30
+    finally:
+        SplitTest.cache.refresher = None
+
+
+@pytest.mark.django_db
+def test_refresh_split_tests_command_once():
+    """Test that the command can rebuild the snapshot once."""
+    split_test = SplitTest.objects.create(
+        name="Test", slug="test", site=Site.objects.get_current(), is_active=True
+    )
+    Cohort.objects.create(
+        split_test=split_test, name="Control", slug="control", weight=1, is_active=True
+    )
+    SplitTest.cache.local_snapshot = None
+    stdout = io.StringIO()
+
+    call_command("refresh_split_tests", once=True, stdout=stdout)
+
+    snapshot = SplitTest.cache.local_snapshot
+    assert snapshot.get_split_test(str(split_test.uuid)) is not None
+    assert f"Refreshed snapshot {snapshot.version}." in stdout.getvalue()
+
+
+def test_refresh_split_tests_command_requires_positive_interval():
+    """Test that the interval must be positive."""
+    with pytest.raises(CommandError):
+        call_command("refresh_split_tests", interval=0)
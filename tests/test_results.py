@@ -0,0 +1,145 @@
+import math
+import statistics
+import sys
+
+import pytest
+
+from django.contrib.sites.models import Site
+from django.core.exceptions import ImproperlyConfigured
+
+from split_tests.models import Cohort, GoalStatistics, SplitTest
+from split_tests.results import get_results, record_values
+
+
+CONTROL_VALUES = [0.0, 1.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0, 0.0] * 10
+VARIANT_VALUES = [1.0, 1.0, 0.0, 1.0, 1.0, 0.0, 1.0, 0.0, 1.0, 0.0] * 10
+
+
+@pytest.fixture
+def cohorts():
+    split_test = SplitTest.objects.create(
+        name="Test", slug="test", site=Site.objects.get_current(), is_active=True
+    )
+    control = Cohort.objects.create(
+        split_test=split_test, name="Control", slug="control", weight=2, is_active=True
+    )
+    variant = Cohort.objects.create(
+        split_test=split_test, name="Variant", slug="variant", weight=1, is_active=True
+    )
+    return split_test, control, variant
+
+
+@pytest.mark.django_db
+def test_record_values(cohorts, django_assert_num_queries):
+    """Test that a batch of values is added to the running totals with one
+    update per cohort and goal.
+    """
+    _, control, variant = cohorts
+    record_values([(control.id, "signup", 1.0)])
+
+    with django_assert_num_queries(6):
+        record_values(
+            [
+                (control.id, "signup", 0.0),
+                (control.id, "signup", 1.0),
+                (variant.id, "signup", 1.0),
+                (variant.id, "revenue", 2.5),
+            ]
+        )
+
+    assert set(
+        GoalStatistics.objects.values_list(
+            "cohort__slug", "goal", "count", "total", "total_of_squares"
+        )
+    ) == {
+        ("control", "signup", 3, 2.0, 2.0),
+        ("variant", "signup", 1, 1.0, 1.0),
+        ("variant", "revenue", 1, 2.5, 6.25),
+    }
+
+
+@pytest.mark.django_db
+def test_record_values_without_values(django_assert_num_queries):
+    """Test that an empty batch doesn't query the database."""
+    with django_assert_num_queries(0):
+        record_values([])
+
+
+@pytest.mark.django_db
+def test_get_results(cohorts, django_assert_num_queries):
+    """Test that the results match those computed from the raw values, in
+    two queries.
+    """
+    split_test, control, variant = cohorts
+    record_values((control.id, "signup", value) for value in CONTROL_VALUES)
+    record_values((variant.id, "signup", value) for value in VARIANT_VALUES)
+
+    with django_assert_num_queries(2):
+        control_result, variant_result = get_results(split_test, "signup")
+
+    difference = statistics.mean(VARIANT_VALUES) - statistics.mean(CONTROL_VALUES)
+    std_error = math.sqrt(
+        statistics.variance(VARIANT_VALUES) / len(VARIANT_VALUES)
+        + statistics.variance(CONTROL_VALUES) / len(CONTROL_VALUES)
+    )
+    z = difference / std_error
+    assert control_result.slug == "control"
+    assert control_result.difference == 0.0
+    assert not control_result.is_significant
+    assert variant_result.slug == "variant"
+    assert variant_result.count == 100
+    assert variant_result.mean == pytest.approx(0.6)
+    assert variant_result.std == pytest.approx(statistics.stdev(VARIANT_VALUES))
+    assert variant_result.difference == pytest.approx(difference)
+    assert variant_result.z == pytest.approx(z)
+    assert variant_result.p_value == pytest.approx(2 * (1 - statistics.NormalDist().cdf(z)))
+    assert variant_result.lower == pytest.approx(difference - 1.959964 * std_error)
+    assert variant_result.upper == pytest.approx(difference + 1.959964 * std_error)
+    assert variant_result.boundary == pytest.approx(1.959964)
+    assert variant_result.is_significant
+
+
+@pytest.mark.django_db
+def test_get_results_sequential_boundary(cohorts):
+    """Test that the boundary is stricter before the planned number of values
+    have been collected.
+    """
+    split_test, control, variant = cohorts
+    record_values((control.id, "signup", value) for value in CONTROL_VALUES)
+    record_values((variant.id, "signup", value) for value in VARIANT_VALUES)
+
+    _, variant_result = get_results(split_test, "signup", planned_count=3200)
+
+    assert variant_result.boundary == pytest.approx(1.959964 * 4)
+    assert not variant_result.is_significant
+
+
+@pytest.mark.django_db
+def test_get_results_without_values(cohorts):
+    """Test that cohorts without values have no results rather than
+    erroring.
+    """
+    split_test, _, _ = cohorts
+
+    _, variant_result = get_results(split_test, "signup")
+
+    assert variant_result.count == 0
+    assert math.isnan(variant_result.mean)
+    assert not variant_result.is_significant
+
+
+@pytest.mark.django_db
+def test_get_results_requires_control(cohorts):
+    """Test that an unknown control cohort is an error."""
+    split_test, _, _ = cohorts
+
+    with pytest.raises(ValueError):
+        get_results(split_test, "signup", control="missing")
+
+
+def test_get_results_requires_numpy(monkeypatch):
+    """Test that a helpful error is raised if numpy isn't installed."""
+    monkeypatch.setitem(sys.modules, "numpy", None)
+
+    with pytest.raises(ImproperlyConfigured):
+        get_results(None, "signup")
@@ -0,0 +1,139 @@
+import time
+
+import pytest
+
+from django.contrib.auth import get_user_model
+from django.contrib.sites.models import Site
+from django.db import connections
+
+from split_tests.models import Assignment, Cohort, SplitTest
+from split_tests.refresh import SnapshotRefresher
+from split_tests.timing import Timings
+
+
+User = get_user_model()
+
+pytestmark = pytest.mark.django_db(transaction=True, databases=["default", "replica"])
+
+
+@pytest.fixture
+def replica(settings):
+    settings.DJANGO_SPLIT_TESTS = {"READ_DATABASE": "replica"}
+
+
+@pytest.fixture
+def split_test():
+    split_test = SplitTest.objects.create(
+        name="Test", slug="test", site=Site.objects.get_current(), is_active=True
+    )
+    Cohort.objects.create(
+        split_test=split_test, name="Control", slug="control", weight=1, is_active=True
+    )
+    return split_test
+
+
+@pytest.fixture
+def user():
+    return User.objects.create_user(username="user")
+
+
+def test_snapshot_rebuilds_read_from_replica(replica, split_test, django_assert_num_queries):
+    """Test that rebuilding a missing snapshot reads from the replica, while
+    saves rebuild it from the primary database.
+    """
+    with django_assert_num_queries(4, connection=connections["replica"]):
+        snapshot = SplitTest.cache.rebuild()
+    assert snapshot.get_split_test(str(split_test.uuid)) is not None
+
+    with django_assert_num_queries(0, connection=connections["replica"]):
+        split_test.save()
+
+
+def test_refresher_reads_from_primary(replica, split_test, django_assert_num_queries):
+    """Test that the refresher rebuilds the snapshot from the primary
+    database, so that a lagging replica can't replace a newer snapshot.
+    """
+    refresher = SnapshotRefresher(SplitTest.cache)
+
+    with django_assert_num_queries(0, connection=connections["replica"]):
+        snapshot = refresher.refresh()
+    assert snapshot.get_split_test(str(split_test.uuid)) is not None
+
+
+def test_assignment_reads_from_replica_and_writes_to_primary(
+    replica, split_test, user, django_assert_num_queries
+):
+    """Test that a new assignment is looked up on the replica and written to
+    the primary database.
+    """
+    with django_assert_num_queries(2, connection=connections["replica"]):
+        with django_assert_num_queries(4, connection=connections["default"]):
+            cohort = Cohort.objects.get_for_user_and_split_test(user, split_test.uuid)
+
+    assert Assignment.objects.using("default").get().cohort == cohort
+
+
+def test_user_reads_their_own_writes(replica, split_test, user, django_assert_num_queries):
+    """Test that a user's assignments are read from the primary database
+    just after they change.
+    """
+    Cohort.objects.get_for_user_and_split_test(user, split_test.uuid)
+
+    with django_assert_num_queries(0, connection=connections["replica"]):
+        Cohort.objects.get_user_assignments(user)
+        Cohort.objects.get_for_user_and_split_test(user, split_test.uuid)
+
+
+def test_user_reads_from_replica_once_caught_up(replica, split_test, user, settings):
+    """Test that a user's assignments are read from the replica once the
+    read-your-writes timeout has passed.
+    """
+    Cohort.objects.get_for_user_and_split_test(user, split_test.uuid)
+    assert Cohort.objects.get_read_database(user.pk) is None
+
+    settings.DJANGO_SPLIT_TESTS = {"READ_DATABASE": "replica", "READ_YOUR_WRITES_TIMEOUT": 0.001}
+    Cohort.objects.invalidate_user_assignments(user.pk)
+    time.sleep(0.01)
+
+    assert Cohort.objects.get_read_database(user.pk) == "replica"
+
+
+def test_reads_use_primary_by_default(split_test, user, django_assert_num_queries):
+    """Test that nothing is read from the replica unless configured."""
+    with django_assert_num_queries(0, connection=connections["replica"]):
+        SplitTest.cache.rebuild()
+        Cohort.objects.get_for_user_and_split_test(user, split_test.uuid)
+        Cohort.objects.get_user_assignments(user)
+
+
+def test_bulk_assignment_reads_assignments_from_primary(
+    replica, split_test, user, django_assert_num_queries
+):
+    """Test that bulk assignments read the existing assignments from the
+    primary database, so that recent ones aren't assigned again, while
+    lookups read them from the replica.
+    """
+    Cohort.objects.get_for_user_and_split_test(user, split_test.uuid)
+
+    with django_assert_num_queries(1, connection=connections["replica"]):
+        with django_assert_num_queries(1, connection=connections["default"]):
+            results = list(
+                Cohort.objects.iter_cohort_slugs([user.pk], split_test.uuid, assign=True)
+            )
+    assert results == [(user.pk, "control")]
+
+    with django_assert_num_queries(2, connection=connections["replica"]):
+        list(Cohort.objects.iter_cohort_slugs([user.pk], split_test.uuid))
+
+
+def test_timings_count_replica_queries(replica, split_test):
+    """Test that the middleware's timings include the queries made on the
+    replica.
+    """
+    timings = Timings()
+
+    with timings.track():
+        SplitTest.cache.rebuild()
+        Cohort.objects.filter(split_test=split_test).using("default").count()
+
+    assert timings.queries == 5
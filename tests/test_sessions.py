@@ -0,0 +1,180 @@
+import pytest
+
+from django.conf import settings as django_settings
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.contrib.sites.models import Site
+from django.http import HttpResponse
+from django.test import RequestFactory
+
+from split_tests.middleware import SplitTestMiddleware
+from split_tests.models import Cohort, SplitTest
+from split_tests.sessions import (
+    decode_assignments,
+    encode_assignments,
+    get_session_assignments,
+)
+from split_tests.signals import get_assigned_cohort_uuids
+from split_tests.snapshot import Snapshot
+
+
+SNAPSHOT = Snapshot.from_rows(
+    [
+        ("11111111-0000-4000-8000-000000000000", "one"),
+        ("22222222-0000-4000-8000-000000000000", "two"),
+    ],
+    [
+        ("aaaaaaaa-0000-4000-8000-000000000000", "control", 0, 1),
+        ("bbbbbbbb-0000-4000-8000-000000000000", "variant", 0, 1),
+        ("cccccccc-0000-4000-8000-000000000001", "control", 1, 1),
+        ("cccccccc-0000-4000-8000-000000000002", "variant", 1, 1),
+    ],
+)
+
+
+def test_encode_assignments():
+    """Test that cohorts are encoded by the start of their UUID and their
+    split test's, unless another cohort's would be encoded the same way.
+    """
+    assignments = {
+        "11111111-0000-4000-8000-000000000000": "bbbbbbbb-0000-4000-8000-000000000000",
+        "22222222-0000-4000-8000-000000000000": "cccccccc-0000-4000-8000-000000000002",
+    }
+
+    value = encode_assignments(assignments, SNAPSHOT)
+
+    assert value == "bbbbbbbb1111.cccccccc-0000-4000-8000-000000000002"
+    assert decode_assignments(value, SNAPSHOT) == assignments
+
+
+def test_decode_assignments_drops_inactive_cohorts():
+    """Test that decoding only keeps the snapshot's active cohorts, and takes
+    their split test from the snapshot.
+    """
+    value = "aaaaaaaa1111.dddddddd1111.cccccccc2222.eeeeeeee-0000-4000-8000-000000000000"
+
+    assert decode_assignments(value, SNAPSHOT) == {
+        "11111111-0000-4000-8000-000000000000": "aaaaaaaa-0000-4000-8000-000000000000",
+    }
+    assert decode_assignments("", SNAPSHOT) == {}
+    assert decode_assignments(None, SNAPSHOT) == {}
+
+
+def test_decode_assignments_after_colliding_cohort_is_added():
+    """Test that assignments encoded before another split test gets a cohort
+    whose UUID starts the same way are still decoded.
+    """
+    assignments = {"11111111-0000-4000-8000-000000000000": "aaaaaaaa-0000-4000-8000-000000000000"}
+    value = encode_assignments(assignments, SNAPSHOT)
+    split_test_rows, cohort_rows = SNAPSHOT.to_rows()[:2]
+    snapshot = Snapshot.from_rows(
+        [*split_test_rows, ("33333333-0000-4000-8000-000000000000", "three")],
+        [*cohort_rows, ("aaaaaaaa-0000-4000-8000-000000000003", "control", 2, 1)],
+    )
+
+    assert decode_assignments(value, snapshot) == assignments
+    assert encode_assignments(assignments, snapshot) == value
+
+
+def test_get_session_assignments_reads_either_encoding():
+    """Test that dicts are returned as is and strings are decoded once per
+    request.
+    """
+    request = RequestFactory().get("/")
+    SessionMiddleware(lambda request: None).process_request(request)
+    assignments = {"11111111-0000-4000-8000-000000000000": "aaaaaaaa-0000-4000-8000-000000000000"}
+
+    request.session["split_tests"] = assignments
+    assert get_session_assignments(request, "split_tests", SNAPSHOT) is assignments
+
+    request.session["split_tests"] = "aaaaaaaa1111"
+    decoded = get_session_assignments(request, "split_tests", SNAPSHOT)
+    assert decoded == assignments
+    assert get_session_assignments(request, "split_tests", SNAPSHOT) is decoded
+
+
+@pytest.fixture
+def cohorts():
+    cohorts = []
+    for i in range(3):
+        split_test = SplitTest.objects.create(
+            name=f"Test {i}", slug=f"test-{i}", site=Site.objects.get_current(), is_active=True
+        )
+        cohorts.append(
+            Cohort.objects.create(
+                split_test=split_test, name="Control", slug="control", weight=1, is_active=True
+            )
+        )
+    return cohorts
+
+
+def run_middleware(session_key=None, cookies=None):
+    request = RequestFactory().get("/")
+    if session_key is not None:
+        request.COOKIES[django_settings.SESSION_COOKIE_NAME] = session_key
+    request.COOKIES.update(cookies or {})
+    SessionMiddleware(lambda request: None).process_request(request)
+    request.user = AnonymousUser()
+    response = SplitTestMiddleware(lambda request: HttpResponse())(request)
+    if request.session.modified:
+        request.session.save()
+    return request, response
+
+
+def get_cookies(response):
+    return {key: morsel.value for key, morsel in response.cookies.items()}
+
+
+@pytest.mark.django_db
+def test_middleware_stores_compact_assignments(cohorts, settings):
+    """Test that the middleware stores assignments as a string of short IDs
+    and serves returning sessions from it.
+    """
+    settings.DJANGO_SPLIT_TESTS = {"SESSION_COMPACT": True}
+    expected = {str(cohort.split_test.uuid): str(cohort.uuid) for cohort in cohorts}
+
+    request, response = run_middleware()
+
+    value = request.session["split_tests"]
+    assert isinstance(value, str)
+    assert sorted(value.split(".")) == sorted(
+        str(cohort.uuid)[:8] + str(cohort.split_test.uuid)[:4] for cohort in cohorts
+    )
+    assert request.session["split_tests_state"][2] is None
+    assert request.user.split_test_slug_map == {f"test-{i}": "control" for i in range(3)}
+    assert {
+        key.removeprefix("dst:"): value
+        for key, value in get_cookies(response).items()
+        if key.startswith("dst:")
+    } == expected
+
+    request, response = run_middleware(request.session.session_key, get_cookies(response))
+
+    assert not request.session.modified
+    assert request.user.split_test_slug_map == {f"test-{i}": "control" for i in range(3)}
+    assert get_assigned_cohort_uuids(request) == list(expected.values())
+
+
+@pytest.mark.django_db
+def test_middleware_migrates_session_encoding(cohorts, settings):
+    """Test that sessions are rewritten in the configured encoding, keeping
+    their assignments.
+    """
+    request, response = run_middleware()
+    assignments = dict(request.session["split_tests"])
+    session_key = request.session.session_key
+    cookies = get_cookies(response)
+
+    settings.DJANGO_SPLIT_TESTS = {"SESSION_COMPACT": True}
+    request, response = run_middleware(session_key, cookies)
+
+    assert isinstance(request.session["split_tests"], str)
+    assert get_session_assignments(request, "split_tests", SplitTest.cache.snapshot()) == (
+        assignments
+    )
+    assert not response.cookies
+
+    settings.DJANGO_SPLIT_TESTS = {}
+    request, response = run_middleware(session_key, cookies)
+
+    assert request.session["split_tests"] == assignments
@@ -0,0 +1,181 @@
+import pytest
+
+from django.contrib.auth import get_user_model, login
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.contrib.sites.models import Site
+from django.test import RequestFactory
+
+from split_tests.models import Assignment, Cohort, Layer, SplitTest
+from split_tests.signals import persist_assignments_on_login
+
+
+User = get_user_model()
+
+
+@pytest.fixture
+def user():
+    return User.objects.create_user(username="user", password="password")
+
+
+@pytest.fixture
+def split_tests():
+    """Create two split tests, each with a control and a variant cohort."""
+    current_site = Site.objects.get_current()
+    split_tests = []
+    for slug in ("one", "two"):
+        split_test = SplitTest.objects.create(
+            name=slug.title(), slug=slug, site=current_site, is_active=True
+        )
+        for cohort_slug in ("control", "variant"):
+            Cohort.objects.create(
+                split_test=split_test,
+                name=cohort_slug.title(),
+                slug=cohort_slug,
+                weight=1,
+                is_active=True,
+            )
+        split_tests.append(split_test)
+    return split_tests
+
+
+def make_request(assignments=None, cookies=None):
+    request = RequestFactory().get("/")
+    request.COOKIES.update(cookies or {})
+    SessionMiddleware(lambda req: None).process_request(request)
+    request.session["split_tests"] = assignments or {}
+    request.user = AnonymousUser()
+    return request
+
+
+def get_user_cohorts(user):
+    return set(Cohort.objects.filter(users=user))
+
+
+@pytest.mark.django_db
+def test_login_persists_session_assignments(user, split_tests):
+    """Test that logging in persists the anonymous user's assignments."""
+    cohorts = [split_test.cohorts.get(slug="variant") for split_test in split_tests]
+    request = make_request({str(cohort.split_test.uuid): str(cohort.uuid) for cohort in cohorts})
+
+    login(request, user, backend="django.contrib.auth.backends.ModelBackend")
+
+    assert get_user_cohorts(user) == set(cohorts)
+
+
+@pytest.mark.django_db
+def test_persist_assignments_uses_a_single_write(user, split_tests, django_assert_num_queries):
+    """Test that all of the assignments are read and written in one query
+    each, however many split tests there are.
+    """
+    cohorts = [split_test.cohorts.get(slug="control") for split_test in split_tests]
+    request = make_request({str(cohort.split_test.uuid): str(cohort.uuid) for cohort in cohorts})
+    SplitTest.cache.update()
+
+    with django_assert_num_queries(2):
+        persist_assignments_on_login(sender=User, request=request, user=user)
+
+    assert get_user_cohorts(user) == set(cohorts)
+
+
+@pytest.mark.django_db
+def test_persist_assignments_falls_back_to_cookies(user, split_tests):
+    """Test that cohort cookies are persisted if the session has no assignment
+    for their split test.
+    """
+    session_cohort = split_tests[0].cohorts.get(slug="control")
+    cookie_cohort = split_tests[1].cohorts.get(slug="variant")
+    request = make_request(
+        {str(split_tests[0].uuid): str(session_cohort.uuid)},
+        {
+            f"dst:{split_tests[0].uuid}": str(split_tests[0].cohorts.get(slug="variant").uuid),
+            f"dst:{split_tests[1].uuid}": str(cookie_cohort.uuid),
+        },
+    )
+
+    persist_assignments_on_login(sender=User, request=request, user=user)
+
+    assert get_user_cohorts(user) == {session_cohort, cookie_cohort}
+
+
+@pytest.mark.django_db
+def test_persist_assignments_ignores_invalid_cohorts(user, split_tests):
+    """Test that inactive cohorts and cohorts of other split tests aren't
+    persisted.
+    """
+    inactive_cohort = split_tests[0].cohorts.get(slug="control")
+    inactive_cohort.is_active = False
+    inactive_cohort.save()
+    other_cohort = split_tests[0].cohorts.get(slug="variant")
+    request = make_request(
+        {
+            str(split_tests[0].uuid): str(inactive_cohort.uuid),
+            str(split_tests[1].uuid): str(other_cohort.uuid),
+        }
+    )
+
+    persist_assignments_on_login(sender=User, request=request, user=user)
+
+    assert not Assignment.objects.filter(user=user).exists()
+
+
+@pytest.mark.django_db
+def test_persist_assignments_keeps_existing_assignments(user, split_tests):
+    """Test that a split test the user is already assigned to keeps its
+    existing assignment.
+    """
+    existing_cohort = split_tests[0].cohorts.get(slug="control")
+    Assignment.objects.create(cohort=existing_cohort, user=user)
+    new_cohort = split_tests[1].cohorts.get(slug="variant")
+    request = make_request(
+        {
+            str(split_tests[0].uuid): str(split_tests[0].cohorts.get(slug="variant").uuid),
+            str(split_tests[1].uuid): str(new_cohort.uuid),
+        }
+    )
+
+    persist_assignments_on_login(sender=User, request=request, user=user)
+
+    assert get_user_cohorts(user) == {existing_cohort, new_cohort}
+
+
+@pytest.mark.django_db
+def test_persist_assignments_rechecks_layers(user, split_tests):
+    """Test that only the split test the user is bucketed into by their primary
+    key is persisted when the anonymous user was assigned to every split test
+    in a layer.
+    """
+    layer = Layer.objects.create(name="Layer", slug="layer", site=Site.objects.get_current())
+    for split_test in split_tests:
+        split_test.layer = layer
+        split_test.layer_allocation = 50
+        split_test.save()
+    cohorts = [split_test.cohorts.get(slug="variant") for split_test in split_tests]
+    request = make_request({str(cohort.split_test.uuid): str(cohort.uuid) for cohort in cohorts})
+
+    persist_assignments_on_login(sender=User, request=request, user=user)
+
+    assert len(get_user_cohorts(user)) == 1
+
+
+@pytest.mark.django_db
+def test_persist_assignments_rechecks_targeting(user, split_tests):
+    """Test that split tests whose targeting rules the user doesn't match
+    aren't persisted.
+    """
+    split_tests[0].targeting = [{"user": "is_staff"}]
+    split_tests[0].save()
+    cohorts = [split_test.cohorts.get(slug="variant") for split_test in split_tests]
+    request = make_request({str(cohort.split_test.uuid): str(cohort.uuid) for cohort in cohorts})
+
+    persist_assignments_on_login(sender=User, request=request, user=user)
+
+    assert get_user_cohorts(user) == {cohorts[1]}
+
+
+@pytest.mark.django_db
+def test_persist_assignments_without_request(user):
+    """Test that logins without a request (e.g. from tests) are ignored."""
+    persist_assignments_on_login(sender=User, request=None, user=user)
+
+    assert not Assignment.objects.filter(user=user).exists()
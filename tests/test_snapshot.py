@@ -0,0 +1,115 @@
+import pickle
+
+from dataclasses import FrozenInstanceError
+
+import pytest
+
+from split_tests.snapshot import Snapshot
+
+
+@pytest.fixture
+def snapshot():
+    return Snapshot.from_rows(
+        [("split-test-one", "one"), ("split-test-two", "two")],
+        [
+            ("cohort-one", "control", 0, 1),
+            ("cohort-two", "variant", 0, 3),
+            ("cohort-three", "control", 1, 1),
+        ],
+        [("layer", (50, 100), (1, None))],
+    )
+
+
+def test_snapshot_views(snapshot):
+    """Test that the snapshot's views match the maps the cache used to hold."""
+    assert snapshot.split_test_active_uuids == {"split-test-one", "split-test-two"}
+    assert snapshot.split_test_uuid_slug_map == {"split-test-one": "one", "split-test-two": "two"}
+    assert snapshot.cohort_active_uuids == {"cohort-one", "cohort-two", "cohort-three"}
+    assert snapshot.cohort_uuid_slug_map == {
+        "cohort-one": "control",
+        "cohort-two": "variant",
+        "cohort-three": "control",
+    }
+    assert snapshot.cohort_uuid_split_test_uuid_map == {
+        "cohort-one": "split-test-one",
+        "cohort-two": "split-test-one",
+        "cohort-three": "split-test-two",
+    }
+    assert snapshot.layer_bucket_ranges == {"layer": ((50, 100), ("split-test-two", None))}
+
+
+def test_snapshot_records_reference_each_other_by_index(snapshot):
+    """Test that split test and cohort records are linked by index."""
+    split_test = snapshot.get_split_test("split-test-one")
+    assert [snapshot.cohorts[index].uuid for index in split_test.cohorts] == [
+        "cohort-one",
+        "cohort-two",
+    ]
+    assert snapshot.split_tests[snapshot.get_cohort("cohort-three").split_test].slug == "two"
+    assert snapshot.get_split_test("missing") is None
+    assert snapshot.get_cohort("missing") is None
+
+
+def test_snapshot_interns_strings(snapshot):
+    """Test that repeated slugs share a single string object."""
+    assert snapshot.cohorts[0].slug is snapshot.cohorts[2].slug
+
+
+def test_snapshot_is_frozen(snapshot):
+    """Test that snapshots and their records cannot be modified."""
+    with pytest.raises(FrozenInstanceError):
+        snapshot.split_tests = ()
+    with pytest.raises(AttributeError):
+        snapshot.cohorts[0].slug = "changed"
+
+
+def test_snapshot_pickles_rows_only(snapshot):
+    """Test that a pickled snapshot is rebuilt, with its indexes, from its
+    rows.
+    """
+    unpickled = pickle.loads(pickle.dumps(snapshot))
+
+    assert unpickled == snapshot
+    assert unpickled.to_rows() == snapshot.to_rows()
+    assert unpickled.cohort_uuid_slug_map == snapshot.cohort_uuid_slug_map
+
+
+def test_snapshot_version_depends_on_contents(snapshot):
+    """Test that equal snapshots share a version and different ones don't."""
+    assert Snapshot.from_rows(*snapshot.to_rows()).version == snapshot.version
+    assert Snapshot.from_rows([("split-test-one", "one")]).version != snapshot.version
+
+
+def test_snapshot_pickle_keeps_version(snapshot):
+    """Test that the version is carried through pickling rather than
+    recomputed.
+    """
+    snapshot = Snapshot.from_rows(*snapshot.to_rows(), version="0123456789abcdef")
+
+    assert pickle.loads(pickle.dumps(snapshot)).version == "0123456789abcdef"
+
+
+def test_snapshot_version_depends_on_expiry(snapshot):
+    """Test that snapshots which expire at different times have different
+    versions, so a process never keeps a snapshot past its expiry.
+    """
+    rows = snapshot.to_rows()
+
+    assert Snapshot.from_rows(*rows, expires_at=1.0).version != snapshot.version
+    assert Snapshot.from_rows(*rows, expires_at=1.0).version == (
+        Snapshot.from_rows(*rows, expires_at=1.0).version
+    )
+
+
+def test_snapshot_is_expired():
+    """Test that a snapshot is expired from its expiry onwards."""
+    assert not Snapshot.from_rows().is_expired(100.0)
+    assert not Snapshot.from_rows(expires_at=100.0).is_expired(99.0)
+    assert Snapshot.from_rows(expires_at=100.0).is_expired(100.0)
+
+
+def test_snapshot_get_cohorts(snapshot):
+    """Test that a split test's cohorts are returned in order."""
+    assert [c.uuid for c in snapshot.get_cohorts("split-test-one")] == ["cohort-one", "cohort-two"]
+    assert [c.uuid for c in snapshot.get_cohorts("split-test-two")] == ["cohort-three"]
+    assert snapshot.get_cohorts("missing") == ()
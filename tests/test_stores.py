@@ -0,0 +1,313 @@
+import queue
+import sys
+import threading
+import time
+
+import pytest
+
+from django.contrib.sites.models import Site
+from django.core.exceptions import ImproperlyConfigured
+from django.test import override_settings
+
+from split_tests import cache as cache_config, codec
+from split_tests.managers import SplitTestCacheManager
+from split_tests.models import Cohort, SplitTest
+from split_tests.snapshot import Snapshot
+from split_tests.stores import (
+    CacheSnapshotStore,
+    FileSnapshotStore,
+    RedisSnapshotStore,
+    get_snapshot_store,
+)
+
+
+class FakeRedis:
+    """An in-process stand-in for the parts of a Redis client the store uses."""
+
+    def __init__(self):
+        self.data = {}
+        self.expiries = {}
+        self.subscribers = []
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, px=None):
+        self.data[key] = _to_bytes(value)
+        self.expiries[key] = px
+
+    def publish(self, channel, message):
+        for pubsub in self.subscribers:
+            if channel in pubsub.channels:
+                pubsub.messages.put(
+                    {"type": "message", "channel": channel, "data": _to_bytes(message)}
+                )
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        pubsub = FakePubSub(self)
+        self.subscribers.append(pubsub)
+        return pubsub
+
+
+class FakePubSub:
+    def __init__(self, client):
+        self.client = client
+        self.channels = set()
+        self.messages = queue.Queue()
+        self.subscribed = threading.Event()
+
+    def subscribe(self, channel):
+        self.channels.add(channel)
+        self.subscribed.set()
+
+    def get_message(self, timeout=0.0):
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.client.subscribers.remove(self)
+
+
+def _to_bytes(value):
+    return value.encode() if isinstance(value, str) else value
+
+
+@pytest.fixture
+def redis_client():
+    return FakeRedis()
+
+
+@pytest.fixture
+def make_store(redis_client):
+    stores = []
+
+    def make_store():
+        store = RedisSnapshotStore(client=redis_client)
+        stores.append(store)
+        return store
+
+    yield make_store
+    for store in stores:
+        store.close()
+
+
+def make_manager(store):
+    manager = SplitTestCacheManager()
+    manager.model = SplitTest
+    manager.store = store
+    return manager
+
+
+def wait_for_subscribers(redis_client, count):
+    """Wait for `count` stores to subscribe to the fake Redis client."""
+    for _ in range(100):
+        subscribers = list(redis_client.subscribers)
+        if len(subscribers) >= count:
+            break
+        time.sleep(0.01)
+    for pubsub in subscribers:
+        assert pubsub.subscribed.wait(timeout=1)
+
+
+def test_get_snapshot_store_defaults_to_the_cache():
+    """Test that snapshots are stored in the cache by default."""
+    assert isinstance(get_snapshot_store(), CacheSnapshotStore)
+
+
+@override_settings(
+    DJANGO_SPLIT_TESTS={
+        "SNAPSHOT_STORE": "split_tests.stores.RedisSnapshotStore",
+        "SNAPSHOT_STORE_OPTIONS": {"client": FakeRedis(), "channel": "custom"},
+    }
+)
+def test_get_snapshot_store_uses_settings():
+    """Test that the store class and its options are read from the settings."""
+    store = get_snapshot_store()
+
+    assert isinstance(store, RedisSnapshotStore)
+    assert store.channel == "custom"
+
+
+def test_redis_store_requires_redis(monkeypatch):
+    """Test that a helpful error is raised if redis isn't installed."""
+    monkeypatch.setitem(sys.modules, "redis", None)
+
+    with pytest.raises(ImproperlyConfigured):
+        RedisSnapshotStore()
+
+
+def test_redis_store_get_and_set(make_store):
+    """Test that the encoded snapshot and its version are stored in Redis."""
+    store = make_store()
+
+    assert store.get_version() is None
+    assert store.get() is None
+
+    store.set(b"data", "0123456789abcdef")
+
+    assert store.get() == b"data"
+    assert store.get_version() == "0123456789abcdef"
+
+
+def test_redis_store_notifies_subscribers(redis_client, make_store):
+    """Test that setting a snapshot notifies the subscribers of every other
+    store and that they then report the new version without asking Redis.
+    """
+    publisher = make_store()
+    subscriber = make_store()
+    received = queue.Queue()
+    subscriber.subscribe(received.put)
+    wait_for_subscribers(redis_client, 1)
+
+    publisher.set(b"data", "0123456789abcdef")
+
+    assert received.get(timeout=1) == "0123456789abcdef"
+    redis_client.data.clear()
+    for _ in range(100):
+        if subscriber.version is not None:
+            break
+        time.sleep(0.01)
+    assert subscriber.get_version() == "0123456789abcdef"
+
+
+def test_redis_store_catches_up_when_subscribing(redis_client, make_store):
+    """Test that a store picks up a version published before it subscribed."""
+    redis_client.set(cache_config.SNAPSHOT_VERSION_KEY, "0123456789abcdef")
+    store = make_store()
+    received = queue.Queue()
+
+    store.subscribe(received.put)
+
+    assert received.get(timeout=1) == "0123456789abcdef"
+
+
+@pytest.mark.django_db
+def test_cache_manager_swaps_local_snapshot_on_publish(redis_client, make_store):
+    """Test that a process swaps its local snapshot as soon as another process
+    publishes a new one, without waiting for a request to ask for it.
+    """
+    split_test = SplitTest.objects.create(
+        name="Test", slug="test", site=Site.objects.get_current(), is_active=True
+    )
+    Cohort.objects.create(
+        split_test=split_test, name="Control", slug="control", weight=1, is_active=True
+    )
+    publisher = make_manager(make_store())
+    subscriber = make_manager(make_store())
+    wait_for_subscribers(redis_client, 2)
+
+    snapshot = publisher.update()
+
+    for _ in range(100):
+        if subscriber.local_snapshot is not None:
+            break
+        time.sleep(0.01)
+    assert subscriber.local_snapshot == snapshot
+    assert subscriber.local_snapshot.version == snapshot.version
+
+
+def test_cache_manager_ignores_unsupported_published_snapshots(redis_client, make_store):
+    """Test that a published snapshot which can't be decoded is ignored,
+    leaving the next request to rebuild it.
+    """
+    manager = make_manager(make_store())
+    local_snapshot = Snapshot.from_rows()
+    manager.local_snapshot = local_snapshot
+    redis_client.set(cache_config.SNAPSHOT_KEY, b"unsupported")
+
+    manager._on_new_version("0123456789abcdef")
+
+    assert manager.local_snapshot is local_snapshot
+
+
+@pytest.fixture
+def snapshot_path(tmp_path):
+    return tmp_path / "split_tests.snapshot"
+
+
+def test_file_store_shares_snapshots_between_processes(snapshot_path):
+    """Test that a snapshot set by one process is read from the local file by
+    the others, without asking the upstream store.
+    """
+    snapshot = Snapshot.from_rows([("a", "test")], [("b", "control", 0, 1)])
+    data = codec.encode(snapshot)
+    writer = FileSnapshotStore(snapshot_path)
+    reader = FileSnapshotStore(snapshot_path)
+
+    writer.set(data, snapshot.version)
+    CacheSnapshotStore().set(b"stale", "0123456789abcdef")
+
+    assert reader.get_version() == snapshot.version
+    assert isinstance(reader.get(), memoryview)
+    assert codec.decode(reader.get()) == snapshot
+
+
+def test_file_store_remaps_when_the_file_is_replaced(snapshot_path):
+    """Test that a process maps the file again once another process replaces
+    it.
+    """
+    first = Snapshot.from_rows([("a", "first")])
+    second = Snapshot.from_rows([("a", "second")])
+    writer = FileSnapshotStore(snapshot_path)
+    reader = FileSnapshotStore(snapshot_path)
+    writer.set(codec.encode(first), first.version)
+    assert reader.get_version() == first.version
+
+    writer.set(codec.encode(second), second.version)
+
+    assert reader.get_version() == second.version
+    assert codec.decode(reader.get()) == second
+
+
+def test_file_store_fetches_missing_file_from_upstream(snapshot_path):
+    """Test that the file is created from the upstream store if it's missing."""
+    snapshot = Snapshot.from_rows([("a", "test")])
+    CacheSnapshotStore().set(codec.encode(snapshot), snapshot.version)
+    store = FileSnapshotStore(snapshot_path)
+
+    assert store.get_version() == snapshot.version
+    assert snapshot_path.read_bytes() == codec.encode(snapshot)
+
+
+def test_file_store_refreshes_stale_file_from_upstream(snapshot_path):
+    """Test that a file older than `max_age` is refreshed from the upstream
+    store.
+    """
+    first = Snapshot.from_rows([("a", "first")])
+    second = Snapshot.from_rows([("a", "second")])
+    store = FileSnapshotStore(snapshot_path, max_age=60)
+    store.set(codec.encode(first), first.version)
+    CacheSnapshotStore().set(codec.encode(second), second.version)
+
+    assert store.get_version() == first.version
+
+    store.max_age = -1
+
+    assert store.get_version() == second.version
+    assert codec.decode(store.get()) == second
+
+
+def test_file_store_without_snapshots(snapshot_path):
+    """Test that there's no version until a snapshot is stored."""
+    store = FileSnapshotStore(snapshot_path)
+
+    assert store.get_version() is None
+    assert not snapshot_path.exists()
+
+
+def test_file_store_refreshes_when_upstream_publishes(redis_client, make_store, snapshot_path):
+    """Test that the file is refreshed before subscribers are notified of a
+    new version.
+    """
+    snapshot = Snapshot.from_rows([("a", "test")])
+    store = FileSnapshotStore(snapshot_path, max_age=60)
+    store.upstream = make_store()
+    received = queue.Queue()
+    store.subscribe(lambda version: received.put(codec.decode(store.get())))
+    wait_for_subscribers(redis_client, 1)
+
+    make_store().set(codec.encode(snapshot), snapshot.version)
+
+    assert received.get(timeout=1) == snapshot
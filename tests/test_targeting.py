@@ -0,0 +1,305 @@
+import pytest
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser, Group
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.contrib.sites.models import Site
+from django.core.exceptions import ValidationError
+from django.http import HttpResponse
+from django.test import RequestFactory
+
+from split_tests import codec
+from split_tests.middleware import SplitTestMiddleware
+from split_tests.models import Cohort, SplitTest
+from split_tests.snapshot import Snapshot
+from split_tests.targeting import (
+    TargetingContext,
+    TargetingError,
+    compile_rules,
+    dumps,
+)
+
+
+User = get_user_model()
+
+
+class FakeUser:
+    is_authenticated = False
+    is_staff = True
+    email = "user@example.com"
+
+
+def make_request(user=None, **kwargs):
+    request = RequestFactory().get("/", **kwargs)
+    request.user = user or FakeUser()
+    return request
+
+
+def matches(rules, request, group_names=frozenset()):
+    return compile_rules(rules)(request, TargetingContext(request, group_names))
+
+
+@pytest.mark.parametrize(
+    "rules, expected",
+    [
+        ([], True),
+        ([{"user": "is_staff"}], True),
+        ([{"user": "is_staff", "not": True}], False),
+        ([{"user": "email", "equals": "user@example.com"}], True),
+        ([{"user": "missing"}], False),
+        ([{"header": "Accept-Language"}], True),
+        ([{"header": "Accept-Language", "contains": "fr"}], True),
+        ([{"header": "Accept-Language", "equals": "fr"}], False),
+        ([{"header": "Accept-Language", "matches": "^fr-"}], True),
+        ([{"header": "X-Missing"}], False),
+        ([{"cookie": "beta"}], True),
+        ([{"cookie": "beta", "equals": "0"}], False),
+        ([{"cookie": "missing"}], False),
+        ([{"any": [{"cookie": "missing"}, {"user": "is_staff"}]}], True),
+        ([{"user": "is_staff"}, {"cookie": "missing"}], False),
+    ],
+)
+def test_compile_rules(rules, expected):
+    """Test that compiled rules match requests as documented."""
+    request = make_request(HTTP_ACCEPT_LANGUAGE="fr-CH, fr;q=0.9")
+    request.COOKIES["beta"] = "1"
+
+    assert matches(rules, request) is expected
+
+
+@pytest.mark.parametrize(
+    "rules",
+    [
+        {"user": "is_staff"},
+        [{"user": "is_staff", "cookie": "beta"}],
+        [{"unknown": "rule"}],
+        [{"user": "_state"}],
+        [{"user": "profile.plan"}],
+        [{"user": "groups"}],
+        [{"user": "user_permissions"}],
+        [{"group": []}],
+        [{"header": "Accept-Language", "contains": "fr", "equals": "fr"}],
+        [{"header": "Accept-Language", "matches": "("}],
+        [{"cookie": "beta", "contains": "1"}],
+        [{"any": []}],
+    ],
+)
+def test_compile_rules_rejects_invalid_rules(rules):
+    """Test that invalid rules raise a TargetingError."""
+    with pytest.raises(TargetingError):
+        compile_rules(rules)
+
+
+def test_compile_rules_collects_groups():
+    """Test that a predicate knows which groups its rules check."""
+    predicate = compile_rules(
+        [{"group": "beta"}, {"any": [{"group": ["staff", "qa"]}, {"cookie": "beta"}]}]
+    )
+
+    assert predicate.groups == {"beta", "staff", "qa"}
+
+
+def test_group_rules_are_evaluated_last():
+    """Test that rules which might need a query are only evaluated if the
+    others match.
+    """
+    request = make_request()
+
+    class Context:
+        @property
+        def user_groups(self):
+            raise AssertionError("The groups were read.")
+
+    predicate = compile_rules([{"group": "beta"}, {"cookie": "missing"}])
+
+    assert predicate(request, Context()) is False
+
+
+@pytest.mark.django_db
+def test_targeting_context_reads_groups_once(django_assert_num_queries):
+    """Test that the user's groups are read with a single query, and only
+    the groups checked by the rules.
+    """
+    user = User.objects.create_user(username="user")
+    user.groups.add(Group.objects.create(name="beta"), Group.objects.create(name="other"))
+    request = make_request(user)
+    context = TargetingContext(request, frozenset({"beta", "staff"}))
+
+    with django_assert_num_queries(1):
+        assert context.user_groups == {"beta"}
+        assert context.user_groups == {"beta"}
+
+    anonymous_context = TargetingContext(make_request(AnonymousUser()), frozenset({"beta"}))
+    with django_assert_num_queries(0):
+        assert anonymous_context.user_groups == set()
+
+
+def test_targeting_context_without_groups():
+    """Test that users of a custom user model without groups aren't in any."""
+    user = FakeUser()
+    user.is_authenticated = True
+
+    assert TargetingContext(make_request(user), frozenset({"beta"})).user_groups == set()
+
+
+def test_snapshot_compiles_targeting_rules():
+    """Test that a snapshot compiles its targeting rules once, survives
+    encoding and doesn't apply invalid rules to anyone.
+    """
+    snapshot = Snapshot.from_rows(
+        [("split-test-one", "one"), ("split-test-two", "two"), ("split-test-three", "three")],
+        targeting_rows=[(0, dumps([{"group": "beta"}])), (2, '[{"unknown": "rule"}]')],
+    )
+
+    assert snapshot.targeting_predicates.keys() == {"split-test-one", "split-test-three"}
+    assert snapshot.targeting_group_names == {"beta"}
+    assert snapshot.get_targeting("split-test-one") == '[{"group":"beta"}]'
+    assert snapshot.get_targeting("split-test-two") is None
+    assert snapshot.targeting_predicates["split-test-three"](make_request(), None) is False
+
+    decoded = codec.decode(codec.encode(snapshot))
+    assert decoded == snapshot
+    assert decoded.version == snapshot.version
+    assert decoded.targeting_group_names == {"beta"}
+
+
+@pytest.mark.django_db
+def test_split_test_validates_targeting():
+    """Test that split tests with invalid targeting rules fail validation."""
+    split_test = SplitTest(
+        name="Test",
+        slug="test",
+        site=Site.objects.get_current(),
+        targeting=[{"user": "is_staff", "equals": True, "contains": "x"}],
+    )
+
+    with pytest.raises(ValidationError) as excinfo:
+        split_test.full_clean()
+
+    assert "targeting" in excinfo.value.message_dict
+
+
+@pytest.fixture
+def targeted_split_tests():
+    site = Site.objects.get_current()
+    split_tests = {
+        "everyone": SplitTest.objects.create(
+            name="Everyone", slug="everyone", site=site, is_active=True
+        ),
+        "beta": SplitTest.objects.create(
+            name="Beta",
+            slug="beta",
+            site=site,
+            is_active=True,
+            targeting=[{"group": "beta"}],
+        ),
+        "staff": SplitTest.objects.create(
+            name="Staff",
+            slug="staff",
+            site=site,
+            is_active=True,
+            targeting=[{"user": "is_staff"}, {"any": [{"group": "qa"}, {"cookie": "qa"}]}],
+        ),
+    }
+    for split_test in split_tests.values():
+        Cohort.objects.create(
+            split_test=split_test, name="Control", slug="control", weight=1, is_active=True
+        )
+    return split_tests
+
+
+def run_middleware(user, cookies=None):
+    request = RequestFactory().get("/")
+    request.COOKIES.update(cookies or {})
+    SessionMiddleware(lambda request: None).process_request(request)
+    request.user = user
+    SplitTestMiddleware(lambda request: HttpResponse())(request)
+    return request
+
+
+@pytest.mark.django_db
+def test_middleware_applies_targeting_rules(targeted_split_tests, django_assert_num_queries):
+    """Test that users are only assigned to the split tests they're targeted
+    by, and their groups are read with at most one query.
+    """
+    user = User.objects.create_user(username="user", is_staff=True)
+    user.groups.add(Group.objects.create(name="beta"), Group.objects.create(name="qa"))
+    SplitTest.cache.snapshot()
+    for split_test in targeted_split_tests.values():
+        Cohort.objects.get_for_user_and_split_test(user, split_test.uuid)
+    Cohort.objects.get_user_assignments(user)
+
+    # One query for the user's groups, none for their cached assignments.
+    with django_assert_num_queries(1):
+        request = run_middleware(user)
+    assert set(request.user.split_test_slug_map) == {"everyone", "beta", "staff"}
+
+    request = run_middleware(AnonymousUser())
+    assert set(request.user.split_test_slug_map) == {"everyone"}
+
+    request = run_middleware(AnonymousUser(), {"qa": "1"})
+    assert set(request.user.split_test_slug_map) == {"everyone"}
+
+
+@pytest.mark.django_db
+def test_middleware_skips_group_query_without_group_rules(
+    targeted_split_tests, django_assert_num_queries
+):
+    """Test that no query is made when the rules which don't need one rule
+    the user out.
+    """
+    targeted_split_tests["beta"].targeting = [{"cookie": "beta"}]
+    targeted_split_tests["beta"].save()
+    SplitTest.cache.snapshot()
+
+    with django_assert_num_queries(0):
+        request = run_middleware(AnonymousUser(), {"beta": "1"})
+
+    assert set(request.user.split_test_slug_map) == {"everyone", "beta"}
+
+
+@pytest.mark.django_db
+def test_returning_sessions_only_check_targeted_split_tests(targeted_split_tests, monkeypatch):
+    """Test that returning sessions keep skipping the checks while the
+    request still matches the targeting rules they were checked against, and
+    are checked again once it doesn't.
+    """
+    targeted_split_tests["beta"].targeting = [{"cookie": "beta"}]
+    targeted_split_tests["beta"].save()
+    middleware = SplitTestMiddleware(lambda request: HttpResponse())
+    get_eligible_split_test_uuids = middleware.get_eligible_split_test_uuids
+    checks = []
+
+    def count_checks(request, snapshot):
+        checks.append(request)
+        return get_eligible_split_test_uuids(request, snapshot)
+
+    monkeypatch.setattr(middleware, "get_eligible_split_test_uuids", count_checks)
+    session_key = None
+
+    def run(cookies):
+        nonlocal session_key
+        request = RequestFactory().get("/")
+        request.COOKIES.update(cookies)
+        if session_key is not None:
+            request.COOKIES[settings.SESSION_COOKIE_NAME] = session_key
+        SessionMiddleware(lambda request: None).process_request(request)
+        request.user = AnonymousUser()
+        middleware(request)
+        request.session.save()
+        session_key = request.session.session_key
+        return set(request.user.split_test_slug_map)
+
+    unit_id = {"dst_uid": "unit"}
+    assert run(unit_id) == {"everyone"}
+    assert run(unit_id) == {"everyone"}
+    assert run(unit_id | {"qa": "1"}) == {"everyone"}
+    assert len(checks) == 1
+
+    assert run(unit_id | {"beta": "1"}) == {"everyone", "beta"}
+    assert run(unit_id | {"beta": "1"}) == {"everyone", "beta"}
+    assert len(checks) == 2
+
+    assert run(unit_id) == {"everyone"}
+    assert len(checks) == 3
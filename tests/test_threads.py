@@ -0,0 +1,53 @@
+import os
+import threading
+
+import pytest
+
+from split_tests import threads
+from split_tests.threads import BackgroundThread, closing_old_connections
+
+
+def test_background_thread_starts_once_per_process(monkeypatch):
+    """Test that the thread is started once in each process, calling
+    `on_start` first, and runs in the background.
+    """
+    done = threading.Event()
+    ran_in = []
+    starts = []
+
+    def target():
+        ran_in.append(threading.current_thread())
+        done.set()
+
+    thread = BackgroundThread(target, "test-thread", on_start=lambda: starts.append(os.getpid()))
+    thread.ensure_started()
+    thread.ensure_started()
+    assert done.wait(5)
+
+    assert starts == [os.getpid()]
+    assert ran_in[0].name == "test-thread"
+    assert ran_in[0].daemon
+    assert ran_in[0] is not threading.current_thread()
+
+    # A forked process starts its own thread.
+    done.clear()
+    monkeypatch.setattr(threads.os, "getpid", lambda: -1)
+    assert not thread.is_running()
+    thread.ensure_started()
+    assert done.wait(5)
+
+    assert starts[1:] == [-1]
+
+
+def test_closing_old_connections(monkeypatch):
+    """Test that old connections are closed before and after the block, even
+    if it raises.
+    """
+    calls = []
+    monkeypatch.setattr(threads, "close_old_connections", lambda: calls.append("close"))
+
+    with pytest.raises(RuntimeError), closing_old_connections():
+        calls.append("block")
+        raise RuntimeError
+
+    assert calls == ["close", "block", "close"]
@@ -0,0 +1,116 @@
+import logging
+import re
+
+import pytest
+
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.contrib.sites.models import Site
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+
+from split_tests.middleware import SplitTestMiddleware
+from split_tests.models import Cohort, SplitTest
+from split_tests.timing import NULL_TIMINGS, Timings, count_cache_call, current_timings
+
+
+User = get_user_model()
+
+
+@pytest.fixture
+def split_test():
+    split_test = SplitTest.objects.create(
+        name="Test", slug="test", site=Site.objects.get_current(), is_active=True
+    )
+    Cohort.objects.create(
+        split_test=split_test, name="Control", slug="control", weight=1, is_active=True
+    )
+    return split_test
+
+
+def make_request(user):
+    request = RequestFactory().get("/page/")
+    SessionMiddleware(lambda req: None).process_request(request)
+    request.user = user
+    return request
+
+
+def view(request):
+    # Queries made by the view aren't counted.
+    list(User.objects.all())
+    response = HttpResponse()
+    response["Server-Timing"] = "view;dur=1"
+    return response
+
+
+def parse_header(header):
+    return dict(re.findall(r"([\w-]+);((?:desc=\"[^\"]*\";?)?(?:dur=[\d.]+)?)", header))
+
+
+@pytest.mark.django_db
+@override_settings(DJANGO_SPLIT_TESTS={"SERVER_TIMING": True})
+def test_middleware_server_timing(split_test):
+    """Test that each phase of the middleware, and its queries and cache
+    calls, are added to the `Server-Timing` header.
+    """
+    user = User.objects.create_user(username="user")
+    SplitTest.cache.local_snapshot = None
+
+    response = SplitTestMiddleware(view)(make_request(user))
+
+    metrics = parse_header(response["Server-Timing"])
+    assert {
+        "view",
+        "dst-snapshot",
+        "dst-session",
+        "dst-layers",
+        "dst-remove-inactive",
+        "dst-cookies",
+        "dst-user-assignments",
+        "dst-assign",
+        "dst-set-cookies",
+        "dst-db",
+        "dst-cache",
+    } <= metrics.keys()
+    # The user's assignments, then the assignment lookup, the cohorts and a
+    # savepoint-wrapped `get_or_create`.
+    assert metrics["dst-db"].startswith('desc="7 queries"')
+    # The snapshot and its version, then the user's assignments are read and
+    # set.
+    assert metrics["dst-cache"] == 'desc="4 calls"'
+
+
+@pytest.mark.django_db
+@override_settings(DJANGO_SPLIT_TESTS={"SERVER_TIMING": True, "SERVER_TIMING_LOG_SAMPLE_RATE": 1.0})
+def test_middleware_logs_timings(split_test, caplog):
+    """Test that sampled requests' timings are logged."""
+    user = User.objects.create_user(username="user")
+
+    with caplog.at_level(logging.INFO, logger="split_tests.middleware"):
+        SplitTestMiddleware(view)(make_request(user))
+
+    [record] = caplog.records
+    assert "/page/" in record.getMessage()
+    assert record.split_test_timings["queries"] == 7
+
+
+@pytest.mark.django_db
+def test_middleware_without_server_timing(split_test):
+    """Test that timings are disabled by default."""
+    user = User.objects.create_user(username="user")
+
+    response = SplitTestMiddleware(view)(make_request(user))
+
+    assert response["Server-Timing"] == "view;dur=1"
+
+
+def test_count_cache_call():
+    """Test that cache calls are only counted while tracked."""
+    timings = Timings()
+
+    count_cache_call()
+    with timings.track():
+        count_cache_call(2)
+
+    assert timings.cache_calls == 2
+    assert current_timings.get() is NULL_TIMINGS
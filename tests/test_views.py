@@ -0,0 +1,149 @@
+import json
+import time
+
+import pytest
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.contrib.sites.models import Site
+from django.test import RequestFactory
+
+from split_tests import views
+from split_tests.middleware import SplitTestMiddleware
+from split_tests.models import Cohort, SplitTest
+from split_tests.snapshot import Snapshot
+from tests.test_exposures import ListSink, wait_for_batches
+
+
+@pytest.fixture
+def split_test():
+    split_test = SplitTest.objects.create(
+        name="Test", slug="test", site=Site.objects.get_current(), is_active=True
+    )
+    Cohort.objects.create(
+        split_test=split_test, name="Control", slug="control", weight=1, is_active=True
+    )
+    return split_test
+
+
+@pytest.mark.django_db
+def test_document(split_test):
+    """Test that the document is served with an ETag and cache headers."""
+    response = views.document(RequestFactory().get("/"))
+
+    snapshot = SplitTest.cache.snapshot()
+    assert response.status_code == 200
+    assert response["ETag"] == f'"{snapshot.version}"'
+    assert response["Cache-Control"] == "public, max-age=60"
+    assert json.loads(response.content)["split_tests"][0]["uuid"] == str(split_test.uuid)
+
+
+@pytest.mark.django_db
+def test_document_not_modified(split_test):
+    """Test that a matching `If-None-Match` gets a 304 response."""
+    etag = views.document(RequestFactory().get("/"))["ETag"]
+
+    response = views.document(RequestFactory().get("/", headers={"if-none-match": etag}))
+
+    assert response.status_code == 304
+    assert response.content == b""
+
+
+@pytest.mark.django_db
+def test_document_max_age_is_capped_by_expiry(split_test, settings):
+    """Test that the document isn't cached past the snapshot's expiry."""
+    SplitTest.cache.set_snapshot(Snapshot.from_rows(expires_at=time.time() + 10.5))
+
+    response = views.document(RequestFactory().get("/"))
+
+    assert response["Cache-Control"] in {"public, max-age=10", "public, max-age=9"}
+
+
+def test_document_rejects_unsafe_methods():
+    """Test that the document is read-only."""
+    assert views.document(RequestFactory().post("/")).status_code == 405
+
+
+def get_client_config(session_key=None, **headers):
+    """Request the client config through the middleware, returning the
+    response and the request's session.
+    """
+    request = RequestFactory().get("/", headers=headers)
+    if session_key is not None:
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = session_key
+    SessionMiddleware(lambda req: None).process_request(request)
+    request.user = AnonymousUser()
+    response = SplitTestMiddleware(views.client_config)(request)
+    request.session.save()
+    return response, request.session
+
+
+@pytest.mark.django_db
+def test_client_config(split_test):
+    """Test that the client config lists the active split tests and the
+    user's cohorts, privately.
+    """
+    response, _ = get_client_config()
+
+    assert response.status_code == 200
+    assert json.loads(response.content) == {
+        "version": SplitTest.cache.snapshot().version,
+        "split_tests": ["test"],
+        "cohorts": {"test": "control"},
+    }
+    assert response["Cache-Control"] == "private, no-cache"
+    assert response["Vary"] == "Cookie"
+    assert response["ETag"]
+
+
+@pytest.mark.django_db
+def test_client_config_logs_exposures(split_test, settings):
+    """Test that serving the user's cohorts to the front end logs their
+    exposures.
+    """
+    settings.DJANGO_SPLIT_TESTS = {
+        "EXPOSURE_SINK": "tests.test_exposures.ListSink",
+        "EXPOSURE_BATCH_SIZE": 1,
+    }
+
+    ListSink.batches = []
+
+    get_client_config()
+
+    [[event]] = wait_for_batches(ListSink, 1)
+    assert event.cohort_uuid == str(split_test.cohorts.get().uuid)
+
+
+@pytest.mark.django_db
+def test_client_config_not_modified(split_test):
+    """Test that polling with a matching `If-None-Match` gets a 304 response
+    while neither the snapshot nor the user's assignments change.
+    """
+    response, session = get_client_config()
+
+    repeat_response, _ = get_client_config(session.session_key, if_none_match=response["ETag"])
+
+    assert repeat_response.status_code == 304
+    assert repeat_response.content == b""
+
+
+@pytest.mark.django_db
+def test_client_config_etag_changes_with_assignments(split_test):
+    """Test that the ETag changes with the user's assignments."""
+    response, session = get_client_config()
+    other_split_test = SplitTest.objects.create(
+        name="Other", slug="other", site=Site.objects.get_current(), is_active=True
+    )
+    Cohort.objects.create(
+        split_test=other_split_test, name="Control", slug="control", weight=1, is_active=True
+    )
+
+    repeat_response, _ = get_client_config(session.session_key, if_none_match=response["ETag"])
+
+    assert repeat_response.status_code == 200
+    assert repeat_response["ETag"] != response["ETag"]
+    assert json.loads(repeat_response.content)["cohorts"] == {
+        "test": "control",
+        "other": "control",
+    }